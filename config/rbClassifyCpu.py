@@ -0,0 +1,9 @@
+# Config override for lsst.meas.transiNet.RBTransiNetTask
+# Use the CPU-optimized (int8 quantized) variant of the dataset's model,
+# created by scripts/optimize_nn_model.py. Use this file instead of
+# rbClassify.py in a pipeline to select the variant.
+import os.path
+
+config.load(os.path.join(os.path.dirname(__file__), "rbClassify.py"))
+# Must match CPU_MODEL_TYPE in scripts/optimize_nn_model.py
+config.connections.pretrainedModel = "pretrainedModelPackageCpu"
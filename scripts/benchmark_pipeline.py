@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+# This file is part of ap_verify_dataset_template.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Script for recording and comparing AP pipeline performance baselines.
+
+The ``record`` command runs ``pipelines/ApVerify.yaml`` over the data IDs in
+``dataIds.list``, and stores the wall time, CPU time, and peak RSS increase of
+each quantum and each task in ``baselines/<version>.json``, where ``<version>`` is
+the version of the Science Pipelines used. Measurements are taken from the
+task metadata that every quantum writes, so the run is not slowed down.
+Because a process's peak RSS never decreases, memory is recorded as the
+amount by which each quantum raised it; a quantum that fits within the memory
+already used by earlier quanta in the same process records no increase.
+
+The ``compare`` command compares two baselines, and flags tasks whose wall or
+CPU time increased by more than a threshold. It exits with an error if any
+task was flagged. Per-quantum times shorter than a floor (``--min-time``) are
+raised to it before comparing, so that a task too fast to time, or with a
+zero time in the old baseline, is not flagged for noise. The peak RSS
+increase of the largest quantum is also reported, with a floor of 1 MiB, but
+never flags a task.
+
+This script requires that preloaded/ be complete.
+
+Example:
+$ python benchmark_pipeline.py record -w /scratch/me/bench
+$ python benchmark_pipeline.py compare baselines/w_2026_40.json baselines/w_2026_42.json
+See benchmark_pipeline.py -h for more options.
+"""
+
+import argparse
+import json
+import logging
+import os
+import shlex
+import sys
+import tempfile
+
+import lsst.log
+from lsst.daf.butler import Butler
+import lsst.utils.packages
+
+from pipeline_runner import run_pipeline
+from scratch_repo import RAW_RUN, make_preloaded_copy
+
+
+# Avoid explicit references to dataset package to maximize portability.
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+PACKAGE_DIR = os.path.normpath(os.path.join(SCRIPT_DIR, ".."))
+DATA_ID_FILE = os.path.join(PACKAGE_DIR, "dataIds.list")
+BASELINE_DIR = os.path.join(PACKAGE_DIR, "baselines")
+PIPELINE = "ApVerify.yaml"
+# Package whose version identifies the Science Pipelines release.
+VERSION_PACKAGE = "lsst_distrib"
+# Floors for per-quantum measurements in compare, in seconds and bytes.
+MIN_TIME = 0.01
+MIN_RSS_INCREASE = 1 << 20
+
+
+########################################
+# Command-line options
+
+def _make_parser():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    record = subparsers.add_parser("record", help="Run the pipeline and record a baseline.")
+    record.add_argument("-w", dest="workspace",
+                        help="Directory in which to create the repository. Defaults to a temporary "
+                             "directory that is deleted afterward.")
+    record.add_argument("-o", dest="output",
+                        help="Baseline file to write, defaults to baselines/<version>.json.")
+    record.add_argument("-j", dest="processes", type=int, default=1,
+                        help="Number of processes for pipetask, defaults to 1. Values other than 1 "
+                             "make timings less reproducible.")
+
+    compare = subparsers.add_parser("compare", help="Compare two baselines.")
+    compare.add_argument("old", help="Reference baseline.")
+    compare.add_argument("new", help="Baseline to check.")
+    compare.add_argument("-t", dest="threshold", type=float, default=0.1,
+                         help="Fractional slowdown above which to flag a task, defaults to 0.1.")
+    compare.add_argument("--min-time", type=float, default=MIN_TIME,
+                         help="Per-quantum time in seconds below which times are treated as equal to it, "
+                              f"defaults to {MIN_TIME}.")
+    return parser
+
+
+########################################
+# Recording
+
+def read_data_query(data_id_file=DATA_ID_FILE):
+    """Convert ``dataIds.list`` into a Butler query string.
+
+    Parameters
+    ----------
+    data_id_file : `str`, optional
+        A file with one ``--id key=value [key=value...]`` specification per
+        line. Values may be lists separated by ``^``.
+
+    Returns
+    -------
+    query : `str`
+        A query matching any of the data IDs in the file. An empty string
+        (match everything) if the file has no constraints.
+    """
+    terms = []
+    with open(data_id_file) as f:
+        for line in f:
+            words = [w for w in shlex.split(line) if w != "--id"]
+            clauses = []
+            for word in words:
+                key, value = word.split("=", 1)
+                values = ", ".join(v if v.isdigit() else f"'{v}'" for v in value.split("^"))
+                clauses.append(f"{key} IN ({values})")
+            if clauses:
+                terms.append("(" + " AND ".join(clauses) + ")")
+    return " OR ".join(terms)
+
+
+def _get_version():
+    """Return the version of the Science Pipelines being measured.
+    """
+    packages = lsst.utils.packages.getEnvironmentPackages()
+    return packages.get(VERSION_PACKAGE, "unknown")
+
+
+def _measure_quantum(metadata):
+    """Extract resource usage from a quantum's task metadata.
+
+    Parameters
+    ----------
+    metadata : `lsst.pipe.base.TaskMetadata`
+        The metadata written by a quantum.
+
+    Returns
+    -------
+    usage : `dict`
+        The wall time (``wall_time``, s), CPU time (``cpu_time``, s), and
+        increase in the process's peak resident set size (``rss_increase``,
+        bytes) during the quantum.
+    """
+    import astropy.time
+
+    quantum = metadata["quantum"]
+    start = astropy.time.Time(quantum["startUtc"], scale="utc")
+    end = astropy.time.Time(quantum["endUtc"], scale="utc")
+    return dict(wall_time=(end - start).sec,
+                cpu_time=quantum["endCpuTime"] - quantum["startCpuTime"],
+                # endMaxResidentSetSize alone is the high-water mark of every
+                # quantum run so far in the same process.
+                rss_increase=quantum["endMaxResidentSetSize"] - quantum["startMaxResidentSetSize"])
+
+
+def _collect_measurements(butler, run):
+    """Collect resource usage for all quanta in a run.
+
+    Parameters
+    ----------
+    butler : `lsst.daf.butler.Butler`
+        The repository containing the run.
+    run : `str`
+        The pipeline output run.
+
+    Returns
+    -------
+    tasks : `dict` [`str`, `dict`]
+        A mapping from task label to totals for that task, with the keys
+        ``n_quanta``, ``wall_time``, ``cpu_time``, ``rss_increase`` (the
+        largest of any quantum), and ``quanta`` (per-quantum measurements, keyed by
+        data ID).
+    """
+    tasks = {}
+    for dataset_type in butler.registry.queryDatasetTypes("*_metadata"):
+        label = dataset_type.name.removesuffix("_metadata")
+        quanta = {}
+        for ref in butler.query_datasets(dataset_type, collections=run, explain=False):
+            quanta[str(ref.dataId.required)] = _measure_quantum(butler.get(ref))
+        if not quanta:
+            continue
+        tasks[label] = dict(n_quanta=len(quanta),
+                            wall_time=sum(q["wall_time"] for q in quanta.values()),
+                            cpu_time=sum(q["cpu_time"] for q in quanta.values()),
+                            rss_increase=max(q["rss_increase"] for q in quanta.values()),
+                            quanta=quanta)
+    return tasks
+
+
+def _record(args):
+    import lsst.obs.base
+
+    data_query = read_data_query()
+    version = _get_version()
+    output = args.output or os.path.join(BASELINE_DIR, f"{version}.json")
+    output_run = "benchmark"
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        repo_dir = os.path.join(args.workspace or temp_dir, "repo")
+        logging.info("Creating repository in %s...", repo_dir)
+        repo = make_preloaded_copy(repo_dir)
+        inst_name = repo.query_data_ids("instrument")[0]["instrument"]
+        instrument = lsst.obs.base.Instrument.fromName(inst_name, repo.registry)
+        logging.info("Running %s...", PIPELINE)
+        run_pipeline(repo_dir, PIPELINE, [RAW_RUN, instrument.makeUmbrellaCollectionName()],
+                     output_run, data_query, args.processes)
+        tasks = _collect_measurements(Butler(repo_dir), output_run)
+
+    baseline = dict(version=version, pipeline=PIPELINE, data_query=data_query,
+                    processes=args.processes, tasks=tasks)
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+    logging.info("Baseline for %s written to %s.", version, output)
+
+
+########################################
+# Comparison
+
+def compare_baselines(old, new, threshold, min_time=MIN_TIME):
+    """Compare per-task resource usage between two baselines.
+
+    Parameters
+    ----------
+    old, new : `dict`
+        The baselines to compare, as written by the ``record`` command.
+    threshold : `float`
+        The fractional increase in wall or CPU time above which to flag a
+        task.
+    min_time : `float`, optional
+        The per-quantum wall or CPU time, in seconds, below which times are
+        treated as equal to it. Must be positive.
+
+    Returns
+    -------
+    rows : `list` [`dict`]
+        One entry per task present in both baselines, with the keys ``task``,
+        ``wall_ratio``, ``cpu_ratio`` (new/old, per quantum),
+        ``rss_increase_ratio`` (new/old, largest quantum), and ``flagged``.
+    """
+    rows = []
+    for label in sorted(old["tasks"].keys() & new["tasks"].keys()):
+        before = old["tasks"][label]
+        after = new["tasks"][label]
+        # Normalize by quanta, in case the data IDs changed.
+        ratios = {}
+        for key in ("wall_time", "cpu_time"):
+            per_before = max(before[key] / before["n_quanta"], min_time)
+            per_after = max(after[key] / after["n_quanta"], min_time)
+            ratios[key] = per_after / per_before
+        # Already a per-quantum maximum.
+        rss_ratio = (max(after["rss_increase"], MIN_RSS_INCREASE)
+                     / max(before["rss_increase"], MIN_RSS_INCREASE))
+        rows.append(dict(task=label,
+                         wall_ratio=ratios["wall_time"],
+                         cpu_ratio=ratios["cpu_time"],
+                         rss_increase_ratio=rss_ratio,
+                         flagged=max(ratios.values()) > 1.0 + threshold))
+    return rows
+
+
+def _compare(args):
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    rows = compare_baselines(old, new, args.threshold, args.min_time)
+    logging.info("Comparing %s (%s) to %s (%s):", args.new, new["version"], args.old, old["version"])
+    logging.info("%-30s %8s %8s %18s", "task", "wall", "cpu", "peak RSS increase")
+    for row in rows:
+        logging.info("%-30s %7.2fx %7.2fx %17.2fx%s", row["task"], row["wall_ratio"], row["cpu_ratio"],
+                     row["rss_increase_ratio"], "  SLOWER" if row["flagged"] else "")
+    for label in sorted(old["tasks"].keys() ^ new["tasks"].keys()):
+        logging.info("%-30s only in %s", label, args.old if label in old["tasks"] else args.new)
+
+    flagged = [row["task"] for row in rows if row["flagged"]]
+    if flagged:
+        sys.exit(f"Tasks slower by more than {args.threshold:.0%}: {', '.join(flagged)}")
+
+
+########################################
+# Put everything together
+
+def main(argv=None):
+    # Ensure logs from tasks are visible
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    lsst.log.configure_pylog_MDC("DEBUG", MDC_class=None)
+
+    args = _make_parser().parse_args(argv)
+    if args.command == "record":
+        _record(args)
+    else:
+        _compare(args)
+
+
+if __name__ == "__main__":
+    main()
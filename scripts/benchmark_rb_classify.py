@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# This file is part of ap_verify_dataset_template.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Script for measuring the throughput of this dataset's real/bogus model.
+
+The model is loaded from the ``models`` collection in preloaded/, using the
+same config override as the dataset's pipelines. Each combination of batch
+size and thread count is run in a fresh process on synthetic cutouts, so that
+the reported peak memory belongs to that combination alone.
+
+Example:
+$ python benchmark_rb_classify.py -s 1 -s 16 -s 256 -t 1 -t 8
+reports cutouts/s, per-batch latency percentiles, and peak memory for all six
+configurations. See benchmark_rb_classify.py -h for more options.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import queue as queue_module
+import resource
+import sys
+import time
+
+import lsst.log
+from lsst.daf.butler import Butler
+
+from optimize_nn_model import load_model
+
+
+MODEL_CHAIN = "models"  # Interface to make_all.sh
+
+# Avoid explicit references to dataset package to maximize portability.
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+DATASET_REPO = os.path.normpath(os.path.join(SCRIPT_DIR, "..", "preloaded"))
+CONFIG_DIR = os.path.normpath(os.path.join(SCRIPT_DIR, "..", "config"))
+
+
+########################################
+# Command-line options
+
+def _make_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", dest="config_file", default=os.path.join(CONFIG_DIR, "rbClassify.py"),
+                        help="RBTransiNetTask config override selecting the model, "
+                             "defaults to config/rbClassify.py.")
+    parser.add_argument("-s", dest="batch_sizes", type=int, action="append",
+                        help="Batch size to test; may be repeated. Defaults to 1, 8, 64, and 256.")
+    parser.add_argument("-t", dest="threads", type=int, action="append",
+                        help="Number of threads to test; may be repeated. "
+                             "Defaults to 1 and the number of CPUs.")
+    parser.add_argument("-n", dest="n_cutouts", type=int, default=1024,
+                        help="Number of synthetic cutouts per configuration, defaults to 1024.")
+    parser.add_argument("--timeout", type=float, default=600,
+                        help="Maximum time in seconds for each configuration, defaults to 600.")
+    parser.add_argument("-o", dest="output",
+                        help="JSON file in which to also store the results.")
+    return parser
+
+
+########################################
+# Model loading
+
+def _get_model_payload(butler, config_file):
+    """Read the model package selected by a task config.
+
+    Parameters
+    ----------
+    butler : `lsst.daf.butler.Butler`
+        A Butler pointing to this repository.
+    config_file : `str`
+        A config override for `lsst.meas.transiNet.RBTransiNetTask`.
+
+    Returns
+    -------
+    payload : `lsst.meas.transiNet.modelPackages.formatters.NNModelPackagePayload`
+        The model package that the task would load.
+    """
+    from lsst.meas.transiNet import RBTransiNetConfig
+
+    config = RBTransiNetConfig()
+    config.load(config_file)
+    if config.modelPackageStorageMode != "butler":
+        raise RuntimeError(f"{config_file} does not load models from the Butler.")
+    return butler.get(config.connections.pretrainedModel, collections=MODEL_CHAIN)
+
+
+########################################
+# Benchmarking
+
+def _run_configuration(payload, batch_size, threads, n_cutouts, results):
+    """Time one benchmark configuration.
+
+    This function is intended to be run in its own process.
+
+    Parameters
+    ----------
+    payload : `lsst.meas.transiNet.modelPackages.formatters.NNModelPackagePayload`
+        The model package to test.
+    batch_size : `int`
+        The number of cutouts per model call.
+    threads : `int`
+        The number of threads for PyTorch to use.
+    n_cutouts : `int`
+        The number of cutouts to classify.
+    results : `multiprocessing.Queue`
+        The queue on which to return a `dict` of measurements.
+    """
+    import numpy
+    import torch
+
+    torch.set_num_threads(threads)
+    model, input_shape = load_model(payload)
+    generator = torch.Generator().manual_seed(42)
+    cutouts = torch.rand((n_cutouts, *input_shape), generator=generator)
+
+    latencies = []
+    with torch.inference_mode():
+        model(cutouts[:batch_size])  # warm-up
+        start = time.perf_counter()
+        for batch in torch.split(cutouts, batch_size):
+            batch_start = time.perf_counter()
+            model(batch)
+            latencies.append(time.perf_counter() - batch_start)
+        elapsed = time.perf_counter() - start
+
+    # ru_maxrss is in KiB on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    p50, p90, p99 = numpy.percentile(latencies, [50, 90, 99]) * 1000
+    results.put(dict(batch_size=batch_size, threads=threads, cutouts_per_sec=n_cutouts / elapsed,
+                     latency_p50_ms=p50, latency_p90_ms=p90, latency_p99_ms=p99,
+                     peak_rss_mib=peak_rss))
+
+
+def _wait_for_result(process, queue, timeout):
+    """Return the measurements of a benchmark process.
+
+    Parameters
+    ----------
+    process : `multiprocessing.Process`
+        A running process executing `_run_configuration`.
+    queue : `multiprocessing.Queue`
+        The queue on which ``process`` returns its measurements.
+    timeout : `float`
+        The maximum time to wait for the process, in seconds.
+
+    Returns
+    -------
+    result : `dict`
+        The measurements returned by ``process``.
+
+    Raises
+    ------
+    RuntimeError
+        Raised if the process exits without returning measurements, or takes
+        longer than ``timeout``.
+    """
+    deadline = time.monotonic() + timeout
+    result = None
+    try:
+        while result is None:
+            # Poll, so that a crashed child is noticed promptly.
+            exited = not process.is_alive()
+            try:
+                result = queue.get(timeout=1.0)
+            except queue_module.Empty:
+                if exited:
+                    raise RuntimeError(f"Benchmark process failed with exit code {process.exitcode}.")
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"Benchmark process did not finish in {timeout} s.")
+    finally:
+        if result is None:
+            process.kill()
+        process.join()
+    return result
+
+
+def _benchmark(payload, batch_sizes, thread_counts, n_cutouts, timeout):
+    """Time all benchmark configurations.
+
+    Parameters
+    ----------
+    payload : `lsst.meas.transiNet.modelPackages.formatters.NNModelPackagePayload`
+        The model package to test.
+    batch_sizes : iterable [`int`]
+        The batch sizes to test.
+    thread_counts : iterable [`int`]
+        The thread counts to test.
+    n_cutouts : `int`
+        The number of cutouts to classify per configuration.
+    timeout : `float`
+        The maximum time for each configuration, in seconds.
+
+    Returns
+    -------
+    results : `list` [`dict`]
+        The measurements for each configuration.
+    """
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for threads in thread_counts:
+        for batch_size in batch_sizes:
+            logging.info("Timing batch size %d with %d threads...", batch_size, threads)
+            queue = context.Queue()
+            process = context.Process(target=_run_configuration,
+                                      args=(payload, batch_size, threads, n_cutouts, queue))
+            process.start()
+            results.append(_wait_for_result(process, queue, timeout))
+    return results
+
+
+def _report(results):
+    """Log benchmark results as a table.
+
+    Parameters
+    ----------
+    results : iterable [`dict`]
+        The measurements for each configuration.
+    """
+    logging.info("%7s %7s %11s %9s %9s %9s %9s",
+                 "threads", "batch", "cutouts/s", "p50 (ms)", "p90 (ms)", "p99 (ms)", "RSS (MiB)")
+    for r in results:
+        logging.info("%7d %7d %11.1f %9.2f %9.2f %9.2f %9.0f",
+                     r["threads"], r["batch_size"], r["cutouts_per_sec"],
+                     r["latency_p50_ms"], r["latency_p90_ms"], r["latency_p99_ms"], r["peak_rss_mib"])
+
+
+########################################
+# Put everything together
+
+def main(argv=None):
+    # Ensure logs from tasks are visible
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    lsst.log.configure_pylog_MDC("DEBUG", MDC_class=None)
+
+    args = _make_parser().parse_args(argv)
+
+    butler = Butler(DATASET_REPO)
+    payload = _get_model_payload(butler, args.config_file)
+    results = _benchmark(payload,
+                         args.batch_sizes or [1, 8, 64, 256],
+                         args.threads or sorted({1, os.cpu_count()}),
+                         args.n_cutouts, args.timeout)
+    _report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        logging.info("Results written to %s.", args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# This file is part of ap_verify_dataset_template.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Script for recording and checking the checksums of this dataset's files.
+
+The ``write`` command records the size and SHA-256 checksum of every file in
+preloaded/ and raw/ to ``checksums.json`` at the top of the dataset. The
+``verify`` command checks the files against that manifest, reading them in
+parallel over a pool of processes, so that corrupted or partially fetched
+files (in particular, Git LFS pointers that were never replaced by their
+contents) are caught before ap_verify copies and ingests the dataset. With
+``--quick``, only file sizes are checked, which takes seconds even for large
+datasets and still catches unfetched LFS files. With ``--partial-raws``,
+raws that were deliberately left unfetched or set aside by ``fetch_raws.py``
+are skipped instead of being reported.
+
+The manifest must be rewritten whenever preloaded/ or raw/ change.
+
+Example:
+$ python checksum_manifest.py verify --quick
+checks that all files listed in the manifest exist and have the right size.
+See checksum_manifest.py -h for more options.
+"""
+
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+
+
+# Avoid explicit references to dataset package to maximize portability.
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+DATASET_DIR = os.path.normpath(os.path.join(SCRIPT_DIR, ".."))
+MANIFEST_FILE = os.path.join(DATASET_DIR, "checksums.json")
+CHECKED_DIRS = ["preloaded", "raw"]
+BLOCK_SIZE = 1 << 20
+LFS_POINTER_PREFIX = b"version https://git-lfs"
+MISSING = "missing"
+NOT_FETCHED = "not fetched from Git LFS"
+
+
+########################################
+# Command-line options
+
+def _make_parser():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    write = subparsers.add_parser("write", help="Record the checksums of the current files.")
+    verify = subparsers.add_parser("verify", help="Check the files against the recorded checksums.")
+    verify.add_argument("--quick", action="store_true",
+                        help="Only check that files exist and have the recorded size.")
+    verify.add_argument("--partial-raws", action="store_true",
+                        help="Skip raws that are missing or not fetched, as left by fetch_raws.py.")
+    for subparser in (write, verify):
+        subparser.add_argument("-j", dest="processes", type=int, default=os.cpu_count(),
+                               help="Number of processes for reading files, defaults to the CPU count.")
+    return parser
+
+
+########################################
+# File checks
+
+def _list_files():
+    """Return the files covered by the manifest.
+
+    Returns
+    -------
+    files : `list` [`str`]
+        The paths of all non-hidden files in `CHECKED_DIRS`, relative to
+        `DATASET_DIR`, in sorted order.
+    """
+    files = []
+    for top in CHECKED_DIRS:
+        for dirpath, dirnames, filenames in os.walk(os.path.join(DATASET_DIR, top)):
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            files.extend(os.path.relpath(os.path.join(dirpath, f), DATASET_DIR)
+                         for f in filenames if not f.startswith("."))
+    return sorted(files)
+
+
+def _checksum(path):
+    """Return the size and SHA-256 checksum of a file.
+
+    Parameters
+    ----------
+    path : `str`
+        The file, relative to `DATASET_DIR`.
+
+    Returns
+    -------
+    size : `int`
+        The size of the file, in bytes.
+    checksum : `str`
+        The hex digest of the file contents.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    with open(os.path.join(DATASET_DIR, path), "rb") as f:
+        while block := f.read(BLOCK_SIZE):
+            digest.update(block)
+            size += len(block)
+    return size, digest.hexdigest()
+
+
+def _check_file(path, size, checksum=None):
+    """Check one file against its manifest entry.
+
+    Parameters
+    ----------
+    path : `str`
+        The file, relative to `DATASET_DIR`.
+    size : `int`
+        The expected size of the file, in bytes.
+    checksum : `str`, optional
+        The expected hex digest of the file. If not provided, only the size
+        is checked.
+
+    Returns
+    -------
+    problem : `str` or `None`
+        A description of what is wrong with the file, or `None` if it
+        matches the manifest.
+    """
+    full_path = os.path.join(DATASET_DIR, path)
+    try:
+        actual_size = os.path.getsize(full_path)
+    except FileNotFoundError:
+        return MISSING
+    if actual_size != size:
+        with open(full_path, "rb") as f:
+            if f.read(len(LFS_POINTER_PREFIX)) == LFS_POINTER_PREFIX:
+                return NOT_FETCHED
+        return f"has size {actual_size}, expected {size}"
+    if checksum is not None and _checksum(path)[1] != checksum:
+        return "has wrong checksum"
+    return None
+
+
+def _chunksize(n_items, processes):
+    # Large enough to amortize IPC over the many small files in preloaded/.
+    return max(1, n_items // (4 * processes))
+
+
+########################################
+# Commands
+
+def _write(processes):
+    """Record the size and checksum of every file in preloaded/ and raw/.
+
+    Parameters
+    ----------
+    processes : `int`
+        The number of processes for reading files.
+
+    Notes
+    -----
+    The manifest is written to `MANIFEST_FILE`, replacing any existing one.
+    """
+    files = _list_files()
+    logging.info("Checksumming %d files...", len(files))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        results = executor.map(_checksum, files, chunksize=_chunksize(len(files), processes))
+        manifest = {path: dict(size=size, sha256=checksum) for path, (size, checksum) in zip(files, results)}
+    with open(MANIFEST_FILE, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+        f.write("\n")
+    logging.info("Manifest written to %s.", MANIFEST_FILE)
+
+
+def _verify(processes, quick, partial_raws):
+    """Check the dataset against the manifest.
+
+    Parameters
+    ----------
+    processes : `int`
+        The number of processes for reading files.
+    quick : `bool`
+        If set, check only file sizes.
+    partial_raws : `bool`
+        If set, do not report raws that are missing or not fetched from
+        Git LFS.
+
+    Raises
+    ------
+    RuntimeError
+        Raised if any file does not match the manifest.
+    """
+    with open(MANIFEST_FILE) as f:
+        manifest = json.load(f)
+    paths = list(manifest)
+    sizes = [manifest[p]["size"] for p in paths]
+    checksums = [None if quick else manifest[p]["sha256"] for p in paths]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        problems = {path: problem for path, problem in zip(
+            paths, executor.map(_check_file, paths, sizes, checksums,
+                                chunksize=_chunksize(len(paths), processes)))
+                    if problem}
+    for path in sorted(set(_list_files()) - set(manifest)):
+        problems[path] = "not in manifest"
+    unfetched = set()
+    if partial_raws:
+        unfetched = {path for path, problem in problems.items()
+                     if path.startswith("raw" + os.sep) and problem in (MISSING, NOT_FETCHED)}
+        problems = {path: problem for path, problem in problems.items() if path not in unfetched}
+        logging.info("Skipped %d raw files that were not fetched.", len(unfetched))
+
+    for path, problem in sorted(problems.items()):
+        logging.error("%s %s.", path, problem)
+    if problems:
+        raise RuntimeError(f"{len(problems)} files do not match {MANIFEST_FILE}; "
+                           "rerun 'git lfs pull' or rebuild the dataset.")
+    logging.info("All %d checked files match the manifest.", len(manifest) - len(unfetched))
+
+
+########################################
+# Put everything together
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    args = _make_parser().parse_args(argv)
+
+    start = time.perf_counter()
+    if args.command == "write":
+        _write(args.processes)
+    else:
+        _verify(args.processes, args.quick, args.partial_raws)
+    logging.info("Took %.1f s.", time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+# This file is part of ap_verify_dataset_template.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Resumable, chunked dataset transfers between Butler repositories.
+
+Datasets are split into chunks, and each chunk is copied file by file with
+``Butler.transfer_from`` and committed to the destination registry on its
+own. Chunks are transferred one at a time: ``transfer_from`` copies files
+inside its registry transaction, so concurrent chunks would contend for the
+destination registry's write lock. Because transfers preserve dataset IDs, a
+rerun after a failure skips every dataset that already landed.
+
+This module is shared by the dataset scripts in this directory; it is not a
+script itself.
+"""
+
+__all__ = ["transfer_in_chunks"]
+
+import collections
+import logging
+
+from lsst.daf.butler import CollectionType, MissingDatasetTypeError
+
+
+_log = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 200
+
+
+def _sort_key(ref):
+    """Return a key that orders datasets consistently between runs.
+    """
+    return (ref.datasetType.name, ref.run, str(ref.dataId), str(ref.id))
+
+
+def _find_missing(dest, refs):
+    """Find the datasets not yet present in a repository.
+
+    Parameters
+    ----------
+    dest : `lsst.daf.butler.Butler`
+        The repository to search.
+    refs : iterable [`lsst.daf.butler.DatasetRef`]
+        The datasets to look for.
+
+    Returns
+    -------
+    missing : `list` [`lsst.daf.butler.DatasetRef`]
+        The elements of ``refs`` that are not in ``dest``, in a consistent
+        order.
+    """
+    runs = collections.defaultdict(set)
+    for ref in refs:
+        runs[ref.datasetType.name].add(ref.run)
+    # Explicit names that don't exist raise, so list every run instead.
+    existing_runs = set(dest.collections.query("*", collection_types={CollectionType.RUN}))
+
+    # One query per dataset type, rather than one per dataset.
+    present = set()
+    for name, type_runs in runs.items():
+        type_runs = sorted(type_runs & existing_runs)
+        if not type_runs:
+            continue
+        try:
+            found = dest.query_datasets(name, collections=type_runs, find_first=False, explain=False)
+            present.update(ref.id for ref in found)
+        except MissingDatasetTypeError:
+            pass
+    return sorted((ref for ref in refs if ref.id not in present), key=_sort_key)
+
+
+def _prepare_destination(dest, refs, register_dataset_types):
+    """Create the runs and dataset types needed to receive datasets.
+
+    Parameters
+    ----------
+    dest : `lsst.daf.butler.Butler`
+        The repository to which datasets will be transferred.
+    refs : iterable [`lsst.daf.butler.DatasetRef`]
+        The datasets to be transferred.
+    register_dataset_types : `bool`
+        Whether to register missing dataset types.
+    """
+    for run in {ref.run for ref in refs}:
+        dest.registry.registerRun(run)
+    if register_dataset_types:
+        for dataset_type in {ref.datasetType for ref in refs}:
+            dest.registry.registerDatasetType(dataset_type)
+
+
+def transfer_in_chunks(dest, src, refs, *, chunk_size=DEFAULT_CHUNK_SIZE, register_dataset_types=False,
+                       transfer_dimensions=False):
+    """Copy datasets between repositories in independently committed chunks.
+
+    This is a resumable replacement for ``dest.transfer_from(src, refs,
+    transfer="copy", ...)``.
+
+    Parameters
+    ----------
+    dest : `lsst.daf.butler.Butler`
+        A writeable Butler for the repository to copy into.
+    src : `lsst.daf.butler.Butler`
+        The repository to copy from.
+    refs : iterable [`lsst.daf.butler.DatasetRef`]
+        The datasets to copy.
+    chunk_size : `int`, optional
+        The maximum number of datasets to commit at once.
+    register_dataset_types : `bool`, optional
+        Whether to register missing dataset types in ``dest``.
+    transfer_dimensions : `bool`, optional
+        Whether to copy dimension records needed by ``refs`` to ``dest``.
+
+    Returns
+    -------
+    n_copied : `int`
+        The number of datasets copied. Datasets that were already present in
+        ``dest`` are not counted.
+    """
+    refs = set(refs)
+    missing = _find_missing(dest, refs)
+    if len(missing) < len(refs):
+        _log.info("%d of %d datasets already transferred; skipping them.",
+                  len(refs) - len(missing), len(refs))
+    if not missing:
+        return 0
+    _prepare_destination(dest, missing, register_dataset_types)
+
+    chunks = [missing[i:i + chunk_size] for i in range(0, len(missing), chunk_size)]
+    for i_chunk, chunk in enumerate(chunks):
+        dest.transfer_from(src, chunk, transfer="copy",
+                           transfer_dimensions=transfer_dimensions)
+        _log.debug("Committed chunk %d of %d (%d datasets).", i_chunk + 1, len(chunks), len(chunk))
+    return len(missing)
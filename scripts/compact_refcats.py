@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# This file is part of ap_verify_dataset_template.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Script for reducing the refcat shards in preloaded/ to the columns that the
+AP pipeline reads.
+
+Each shard copied by ``ingest_refcats.py`` is rewritten with only the columns
+used by astrometric and photometric calibration, and with uncertainties stored
+in single precision. The compact shards are stored under the same dataset
+types in a derived run, which goes in front of the original runs in the
+``refcats`` collection; with ``--remove-original``, the original runs are
+deleted instead. The script logs the shard size and load time for each detector in
+this dataset before and after compaction.
+
+This script must be run after ``ingest_refcats.py``.
+
+Example:
+$ python compact_refcats.py
+compacts the refcats in this dataset's preloaded repo. See compact_refcats.py
+-h for more options.
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+import lsst.log
+from lsst.daf.butler import Butler, CollectionType, MissingCollectionError
+
+from ingest_refcats import DATA_IDS
+
+
+# Avoid explicit references to dataset package to maximize portability.
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+DATASET_REPO = os.path.normpath(os.path.join(SCRIPT_DIR, "..", "preloaded"))
+STD_REFCAT = "refcats"
+DEST_RUN = STD_REFCAT + "/compact"
+
+# Columns read by the reference loaders in ApPipe, in addition to the minimal
+# schema (id, coord_ra, coord_dec). Columns missing from a shard are ignored.
+_ASTROMETRY_COLUMNS = ["coord_raErr", "coord_decErr", "coord_ra_coord_dec_Cov", "epoch",
+                       "pm_ra", "pm_dec", "pm_raErr", "pm_decErr", "pm_ra_pm_dec_Cov", "pm_flag",
+                       "parallax", "parallaxErr", "parallax_flag"]
+CONSUMED_COLUMNS = {
+    "gaia_dr2_20200414": _ASTROMETRY_COLUMNS + [f"phot_{band}_mean_{kind}" for band in ("g", "bp", "rp")
+                                                for kind in ("flux", "fluxErr")],
+    "ps1_pv3_3pi_20170110": ["coord_raErr", "coord_decErr"] + [f"{band}_{kind}" for band in "grizy"
+                                                               for kind in ("flux", "fluxErr")],
+}
+# Double-precision columns that are safe to store as single precision.
+NARROWED_SUFFIXES = ("Err", "_Cov")
+
+
+########################################
+# Command-line options
+
+def _make_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--remove-original", action="store_true",
+                        help=f"Delete the original shards after compacting. By default, they are kept in "
+                             f"{STD_REFCAT} behind the compact ones.")
+    return parser
+
+
+########################################
+# Compaction
+
+def _make_mapper(schema, columns):
+    """Create a mapping from a full refcat schema to a compact one.
+
+    Parameters
+    ----------
+    schema : `lsst.afw.table.Schema`
+        The schema of the original shard.
+    columns : iterable [`str`]
+        The columns to keep, in addition to the minimal schema.
+
+    Returns
+    -------
+    mapper : `lsst.afw.table.SchemaMapper`
+        A mapper for all columns that are copied unchanged.
+    narrowed : `list` [`str`]
+        The columns that must be copied separately, converting from double to
+        single precision.
+    """
+    import lsst.afw.table
+
+    mapper = lsst.afw.table.SchemaMapper(schema)
+    mapper.addMinimalSchema(lsst.afw.table.SimpleTable.makeMinimalSchema(), True)
+    narrowed = []
+    for name in columns:
+        if name not in schema.getNames():
+            continue
+        field = schema[name].asField()
+        if field.getTypeString() == "D" and name.endswith(NARROWED_SUFFIXES):
+            mapper.editOutputSchema().addField(name, type="F", doc=field.getDoc(), units=field.getUnits())
+            narrowed.append(name)
+        else:
+            mapper.addMapping(schema[name].asKey())
+    return mapper, narrowed
+
+
+def _compact(shard, columns):
+    """Reduce a refcat shard to a subset of its columns.
+
+    Parameters
+    ----------
+    shard : `lsst.afw.table.SimpleCatalog`
+        The shard to compact.
+    columns : iterable [`str`]
+        The columns to keep, in addition to the minimal schema.
+
+    Returns
+    -------
+    compact : `lsst.afw.table.SimpleCatalog`
+        A copy of ``shard`` with only the requested columns, and the same
+        metadata.
+    """
+    import lsst.afw.table
+
+    mapper, narrowed = _make_mapper(shard.schema, columns)
+    compact = lsst.afw.table.SimpleCatalog(mapper.getOutputSchema())
+    compact.extend(shard, mapper=mapper)
+    # Column assignment needs contiguous memory.
+    compact = compact.copy(deep=True)
+    for name in narrowed:
+        compact[name] = shard[name]
+    compact.setMetadata(shard.getMetadata())
+    return compact
+
+
+def _measure(butler, refs):
+    """Return the total size and load time of a set of shards.
+    """
+    size = sum(butler.getURI(ref).size() for ref in refs)
+    start = time.perf_counter()
+    for ref in refs:
+        butler.get(ref)
+    return size, time.perf_counter() - start
+
+
+def _find_shards(butler, collection, data_id):
+    """Return the refcat shards overlapping a detector.
+
+    Parameters
+    ----------
+    butler : `lsst.daf.butler.Butler`
+        The butler to query for the shards.
+    collection : `str`
+        The collection to search.
+    data_id : `dict`
+        The visit-detector for which refcats are needed.
+
+    Returns
+    -------
+    shards : `set` [`lsst.daf.butler.DatasetRef`]
+        The shards overlapping ``data_id``.
+    """
+    where = "instrument='{instrument}' and detector={detector} and visit={visit}".format(**data_id)
+    return set(butler.registry.queryDatasets(list(CONSUMED_COLUMNS), collections=collection, where=where))
+
+
+def _report(butler, src_runs):
+    """Log the shard size and load time per detector, before and after
+    compaction.
+
+    Parameters
+    ----------
+    butler : `lsst.daf.butler.Butler`
+        A Butler pointing to this repository.
+    src_runs : iterable [`str`]
+        The runs containing the original shards.
+    """
+    logging.info("%-30s %12s %12s %11s %11s", "detector", "size before", "size after",
+                 "load before", "load after")
+    for data_id in DATA_IDS:
+        size_before, time_before = _measure(butler, _find_shards(butler, list(src_runs), data_id))
+        size_after, time_after = _measure(butler, _find_shards(butler, DEST_RUN, data_id))
+        logging.info("%-30s %9.1f MB %9.1f MB %9.3f s %9.3f s",
+                     f"{data_id['visit']}, {data_id['detector']}",
+                     size_before / 1e6, size_after / 1e6, time_before, time_after)
+
+
+########################################
+# Put everything together
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    lsst.log.configure_pylog_MDC("DEBUG", MDC_class=None)
+
+    args = _make_parser().parse_args(argv)
+
+    butler = Butler(DATASET_REPO, writeable=True)
+    src_runs = [run for run in butler.registry.getCollectionChain(STD_REFCAT) if run != DEST_RUN]
+    if not src_runs:
+        raise RuntimeError(f"No original refcats in {STD_REFCAT}; run ingest_refcats.py first.")
+    try:
+        butler.registry.queryCollections(DEST_RUN)
+    except MissingCollectionError:
+        # First compaction
+        pass
+    else:
+        # Left over from a previous compaction
+        butler.registry.setCollectionChain(STD_REFCAT, src_runs)
+        butler.removeRuns([DEST_RUN], unstore=True)
+
+    logging.info("Compacting refcats...")
+    butler.registry.registerRun(DEST_RUN)
+    n_shards = 0
+    for name, columns in CONSUMED_COLUMNS.items():
+        for ref in set(butler.registry.queryDatasets(name, collections=src_runs)):
+            butler.put(_compact(butler.get(ref), columns), ref.datasetType, ref.dataId, run=DEST_RUN)
+            n_shards += 1
+    logging.debug("%d refcat shards compacted", n_shards)
+
+    _report(butler, src_runs)
+
+    butler.registry.registerCollection(STD_REFCAT, CollectionType.CHAINED)
+    # The compact shards shadow any original ones that are kept.
+    butler.registry.setCollectionChain(STD_REFCAT, [DEST_RUN] + ([] if args.remove_original else src_runs))
+    if args.remove_original:
+        butler.removeRuns(src_runs, unstore=True)
+
+    logging.info("%d compact refcat shards written to %s:%s", n_shards, DATASET_REPO, STD_REFCAT)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+# This file is part of ap_verify_dataset_template.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Script for compacting and tuning a SQLite registry.
+
+The other scripts insert and remove many datasets and collections, which
+leaves the registry of preloaded/ fragmented and without planner statistics.
+This script adds indexes for calibration and collection-chain lookups that the
+registry's own unique indexes do not already serve, then runs ``ANALYZE`` and
+``VACUUM``. It benchmarks a set of common dataset and dimension queries before
+and after.
+
+ap_verify does not query preloaded/ directly: it creates a new registry in its
+workspace from ``config/export.yaml``. To tune the registry that ap_verify
+queries, run this script on the workspace repository after ingestion, with
+``-b``.
+
+The indexes are ordinary SQLite indexes, and do not change the registry
+schema as seen by the Butler.
+
+Example:
+$ python compact_registry.py
+compacts this dataset's preloaded repo.
+$ python compact_registry.py -b /scratch/me/workspace/repo
+compacts the registry of an ap_verify workspace. See compact_registry.py -h
+for more options.
+"""
+
+import argparse
+import logging
+import os
+import sqlite3
+import statistics
+import sys
+import time
+
+import lsst.log
+from lsst.daf.butler import Butler
+
+
+# Avoid explicit references to dataset package to maximize portability.
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+DATASET_REPO = os.path.normpath(os.path.join(SCRIPT_DIR, "..", "preloaded"))
+REGISTRY_FILE = "gen3.sqlite3"
+INDEX_SUFFIX = "_covering_idx"
+
+
+########################################
+# Command-line options
+
+def _make_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-b", dest="repo", default=DATASET_REPO,
+                        help="Repository to compact, defaults to this dataset's preloaded/. Pass the "
+                             "repo directory of an ap_verify workspace to tune the registry that "
+                             "ap_verify queries.")
+    parser.add_argument("-n", dest="repeats", type=int, default=5,
+                        help="Number of times to run each benchmark query, defaults to 5.")
+    parser.add_argument("--no-benchmark", dest="benchmark", action="store_false",
+                        help="Compact the registry without benchmarking it.")
+    return parser
+
+
+########################################
+# Benchmarks
+
+def _make_queries(butler):
+    """Return the queries to benchmark.
+
+    Parameters
+    ----------
+    butler : `lsst.daf.butler.Butler`
+        A Butler pointing to this repository.
+
+    Returns
+    -------
+    queries : `dict` [`str`, callable]
+        A mapping from description to a function that takes a Butler and
+        runs the query.
+    """
+    import lsst.obs.base
+
+    inst_name = butler.query_data_ids("instrument")[0]["instrument"]
+    umbrella = lsst.obs.base.Instrument.fromName(inst_name, butler.registry).makeUmbrellaCollectionName()
+    dataset_types = [t.name for t in butler.registry.queryDatasetTypes()]
+
+    def find_datasets(b):
+        for t in dataset_types:
+            b.query_datasets(t, collections=umbrella, find_first=True, explain=False)
+
+    return {
+        "dataset types": lambda b: b.registry.queryDatasetTypes(),
+        "collection chains": lambda b: b.collections.query_info("*", include_chains=True,
+                                                                flatten_chains=True),
+        "find-first datasets": find_datasets,
+        "dataset URIs": lambda b: [b.getURI(ref) for ref in
+                                   b.query_datasets(dataset_types[0], collections=umbrella, explain=False)],
+        "visit-detector IDs": lambda b: b.query_data_ids(["visit", "detector"], explain=False),
+        "exposure records": lambda b: b.query_dimension_records("exposure", explain=False),
+        "region records": lambda b: b.query_dimension_records("visit_detector_region", explain=False),
+    }
+
+
+def _benchmark(repo, queries, repeats):
+    """Time a set of queries.
+
+    Parameters
+    ----------
+    repo : `str`
+        The repository to query.
+    queries : `dict` [`str`, callable]
+        The queries to run, as returned by `_make_queries`.
+    repeats : `int`
+        The number of times to run each query.
+
+    Returns
+    -------
+    times : `dict` [`str`, `float`]
+        The median time (seconds) of each query.
+    """
+    # Fresh Butler, so that no caches carry over from a previous benchmark.
+    butler = Butler(repo)
+    times = {}
+    for name, query in queries.items():
+        samples = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            query(butler)
+            samples.append(time.perf_counter() - start)
+        times[name] = statistics.median(samples)
+    return times
+
+
+########################################
+# Compaction
+
+def _index_columns(connection, table):
+    """Return the columns of a calibration table, in covering-index order.
+
+    Parameters
+    ----------
+    connection : `sqlite3.Connection`
+        A connection to the registry.
+    table : `str`
+        A ``dataset_calibs_*`` table.
+
+    Returns
+    -------
+    columns : `list` [`str`]
+        The collection and dataset type first, since they constrain every
+        lookup, then dimension and validity columns, then the dataset ID
+        (so that it can be read from the index alone).
+    """
+    columns = [row[1] for row in connection.execute(f"PRAGMA table_info({table})")]
+    leading = [c for c in ("collection_id", "dataset_type_id") if c in columns]
+    trailing = [c for c in ("dataset_id",) if c in columns]
+    middle = [c for c in columns if c not in leading and c not in trailing and c != "id"]
+    return leading + middle + trailing
+
+
+def _existing_indexes(connection, table):
+    """Return the columns of each existing index on a table.
+
+    Parameters
+    ----------
+    connection : `sqlite3.Connection`
+        A connection to the registry.
+    table : `str`
+        The table whose indexes to find.
+
+    Returns
+    -------
+    indexes : `list` [`list` [`str`]]
+        The columns of each index, in index order. Includes the indexes that
+        implement primary keys and unique constraints.
+    """
+    return [[row[2] for row in connection.execute(f"PRAGMA index_info({index[1]})")]
+            for index in connection.execute(f"PRAGMA index_list({table})")]
+
+
+def _is_redundant(columns, existing):
+    """Test whether a new index would duplicate the lookups served by an
+    existing one.
+
+    Parameters
+    ----------
+    columns : `list` [`str`]
+        The columns of the new index.
+    existing : iterable [`list` [`str`]]
+        The columns of the existing indexes on the same table.
+
+    Returns
+    -------
+    redundant : `bool`
+        `True` if an existing index has the same leading columns, in any
+        order, and contains all of ``columns``.
+    """
+    n_leading = min(2, len(columns))
+    for other in existing:
+        if set(other[:n_leading]) == set(columns[:n_leading]) and set(columns) <= set(other):
+            return True
+    return False
+
+
+def _add_indexes(connection):
+    """Add indexes for calibration and collection-chain lookups.
+
+    Parameters
+    ----------
+    connection : `sqlite3.Connection`
+        A connection to the registry.
+
+    Returns
+    -------
+    n_indexes : `int`
+        The number of indexes created.
+    """
+    # dataset_tags_* tables are not included: their unique indexes already
+    # lead with the collection and dataset type, and contain every column.
+    tables = [row[0] for row in connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'dataset_calibs_%'")]
+    indexes = {table: _index_columns(connection, table) for table in tables}
+    # Chain resolution, and dataset lookups by run.
+    indexes["collection_chain"] = ["parent", "position", "child"]
+    indexes["dataset"] = ["run_id", "dataset_type_id", "id"]
+
+    n_indexes = 0
+    existing = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    for table, columns in indexes.items():
+        name = table + INDEX_SUFFIX
+        if name in existing:
+            continue
+        if _is_redundant(columns, _existing_indexes(connection, table)):
+            logging.debug("Not indexing %s on %s; an existing index covers it.", table, columns)
+            continue
+        logging.debug("Indexing %s on %s", table, columns)
+        connection.execute(f"CREATE INDEX {name} ON {table} ({', '.join(columns)})")
+        n_indexes += 1
+    return n_indexes
+
+
+def _compact(registry_file):
+    """Index, analyze, and vacuum a SQLite registry.
+
+    Parameters
+    ----------
+    registry_file : `str`
+        The registry database.
+    """
+    # Autocommit mode, as VACUUM can't run in a transaction.
+    connection = sqlite3.connect(registry_file, isolation_level=None)
+    try:
+        connection.execute("BEGIN")
+        n_indexes = _add_indexes(connection)
+        connection.execute("COMMIT")
+        logging.info("%d indexes added.", n_indexes)
+        connection.execute("ANALYZE")
+        connection.execute("VACUUM")
+    finally:
+        connection.close()
+
+
+def _report(size_before, size_after, times_before, times_after):
+    """Log the effects of compaction.
+    """
+    logging.info("Registry size: %.1f MB before, %.1f MB after.", size_before / 1e6, size_after / 1e6)
+    if times_before:
+        logging.info("%-25s %10s %10s", "query", "before", "after")
+        for name in times_before:
+            logging.info("%-25s %8.1f ms %8.1f ms", name, 1e3 * times_before[name], 1e3 * times_after[name])
+
+
+########################################
+# Put everything together
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    lsst.log.configure_pylog_MDC("DEBUG", MDC_class=None)
+
+    args = _make_parser().parse_args(argv)
+    registry_file = os.path.join(args.repo, REGISTRY_FILE)
+    if not os.path.exists(registry_file):
+        raise RuntimeError(f"{registry_file} not found; only SQLite registries can be compacted.")
+
+    queries = _make_queries(Butler(args.repo)) if args.benchmark else {}
+    size_before = os.path.getsize(registry_file)
+    times_before = _benchmark(args.repo, queries, args.repeats)
+
+    logging.info("Compacting %s...", registry_file)
+    _compact(registry_file)
+
+    size_after = os.path.getsize(registry_file)
+    times_after = _benchmark(args.repo, queries, args.repeats)
+    _report(size_before, size_after, times_before, times_after)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# This file is part of ap_verify_dataset_template.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Single entry point for the dataset management scripts in this directory.
+
+Each Python script is available as a subcommand, taking the same arguments as
+the script itself. A script is only imported when its subcommand is run, so
+listing subcommands does not load the Science Pipelines. Several subcommands
+may be run in one process by separating them with ``+``; they then share
+a single interpreter and the imports of the Science Pipelines. If a step
+fails, the later steps are not run.
+
+The ``benchmark-startup`` subcommand measures the startup cost of the
+entry point and of each script.
+
+Example:
+$ python dataset.py import_calibs -c LSSTCam/calib + ingest_refcats -i refcats
+runs import_calibs.py and ingest_refcats.py in one process. See dataset.py -h
+for the available subcommands.
+"""
+
+import argparse
+import importlib
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+# Avoid explicit references to dataset package to maximize portability.
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+STEP_SEPARATOR = "+"
+# Must have the same name as the script, minus ".py". Descriptions are kept
+# here so that they can be listed without importing the scripts.
+STEPS = {
+    "benchmark_pipeline": "Record or compare performance baselines of pipelines/ApVerify.yaml.",
+    "benchmark_rb_classify": "Benchmark the pretrained model for different batch sizes and threads.",
+    "checksum_manifest": "Record or verify the checksums of the files in preloaded/ and raw/.",
+    "compact_refcats": "Reduce the refcats in preloaded/ to the columns the pipeline reads.",
+    "compact_registry": "Index, analyze, and vacuum a SQLite registry.",
+    "fetch_raws": "Materialize only the raws for the given exposures and detectors.",
+    "generate_group_dimensions": "Predefine the group dimensions corresponding to the input raws.",
+    "generate_isr_exposures": "Run ISR once and store the post-ISR exposures in preloaded/.",
+    "generate_quantum_graphs": "Generate and store the QuantumGraphs of this dataset's pipelines.",
+    "generate_self_preload": "Create preloaded APDB datasets by simulating a processing run.",
+    "generate_warped_templates": "Warp the templates onto each visit-detector once, in preloaded/.",
+    "get_ephemerides": "Download solar system ephemerides into preloaded/.",
+    "get_nn_models": "Transfer a pretrained model into preloaded/.",
+    "import_calibs": "Transfer calibs into preloaded/.",
+    "import_templates": "Transfer templates into preloaded/.",
+    "ingest_refcats": "Transfer refcats into preloaded/.",
+    "make_mini_dataset": "Create a reduced copy of this dataset.",
+    "make_preloaded_export": "Create an export file of preloaded/.",
+    "make_raw_manifest": "Record which exposures and detectors each raw file contains.",
+    "make_region_cache": "Cache the visit-detector regions of preloaded/ and their sky pixels.",
+    "optimize_nn_model": "Create an int8-quantized variant of the pretrained model.",
+    "partition_preloaded_catalogs": "Rewrite the preloaded DIA catalogs in spatially sorted form.",
+    "prefetch_source_refs": "Resolve the import scripts' source-repo queries into a manifest.",
+    "profile_pipeline": "Profile one of this dataset's pipelines.",
+    "setup_workspace": "Create a repository from this dataset, overlapping the setup steps.",
+}
+BENCHMARK = "benchmark-startup"
+
+
+########################################
+# Command-line options
+
+def _make_parser():
+    steps = "\n".join(f"  {name:30} {description}" for name, description in STEPS.items())
+    parser = argparse.ArgumentParser(
+        usage=f"%(prog)s STEP [ARGS ...] [{STEP_SEPARATOR} STEP [ARGS ...] ...]",
+        description="Run one or more dataset management steps. Use STEP -h for the arguments of "
+                    "each step.",
+        epilog=f"steps:\n{steps}\n  {BENCHMARK:30} Measure the startup time of this program and the "
+               "scripts.",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    return parser
+
+
+def _make_benchmark_parser():
+    parser = argparse.ArgumentParser(prog=f"{os.path.basename(sys.argv[0])} {BENCHMARK}")
+    parser.add_argument("-n", dest="repeats", type=int, default=5,
+                        help="Number of times to run each measurement, defaults to 5.")
+    parser.add_argument("-s", dest="steps", nargs="+", choices=list(STEPS), default=list(STEPS),
+                        help="Steps to measure, defaults to all.")
+    return parser
+
+
+def _split_steps(argv):
+    """Split a command line into individual steps.
+
+    Parameters
+    ----------
+    argv : sequence [`str`]
+        The command-line arguments, excluding the program name.
+
+    Returns
+    -------
+    steps : `list` [`tuple` [`str`, `list` [`str`]]]
+        The name and arguments of each step, in order.
+    """
+    steps = []
+    current = []
+    for arg in list(argv) + [STEP_SEPARATOR]:
+        if arg == STEP_SEPARATOR:
+            if current:
+                steps.append((current[0], current[1:]))
+            current = []
+        else:
+            current.append(arg)
+    return steps
+
+
+########################################
+# Step execution
+
+def run_step(name, args):
+    """Run one of the scripts in this directory, in this process.
+
+    Parameters
+    ----------
+    name : `str`
+        The name of the script, without ``.py``.
+    args : sequence [`str`]
+        The command-line arguments for the script.
+
+    Raises
+    ------
+    SystemExit
+        Raised if the script exits with an error. A script that exits
+        successfully (for example, after printing help) returns normally, so
+        that any following steps still run.
+    """
+    module = importlib.import_module(name)
+    # So that the step's usage and errors show its own name.
+    program = sys.argv[0]
+    sys.argv[0] = name + ".py"
+    try:
+        module.main(list(args))
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            logging.error("Step %s failed; skipping any later steps.", name)
+            raise
+    finally:
+        sys.argv[0] = program
+
+
+########################################
+# Startup benchmark
+
+def _time_command(command, repeats):
+    """Return the median wall time of a command, in seconds.
+
+    Raises
+    ------
+    RuntimeError
+        Raised if the command fails.
+    """
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        results = subprocess.run(command, cwd=SCRIPT_DIR, capture_output=True, shell=False, check=False)
+        samples.append(time.perf_counter() - start)
+        if results.returncode:
+            raise RuntimeError(f"{' '.join(command)} failed:\n{results.stderr.decode()}")
+    return statistics.median(samples)
+
+
+def _benchmark_startup(argv):
+    args = _make_benchmark_parser().parse_args(argv)
+    python = sys.executable
+
+    logging.info("%-30s %10s", "command", "time")
+    entry_time = _time_command([python, os.path.join(SCRIPT_DIR, "dataset.py"), "-h"], args.repeats)
+    logging.info("%-30s %8.2f s", "dataset.py -h", entry_time)
+
+    separate_time = 0.0
+    for step in args.steps:
+        step_time = _time_command([python, os.path.join(SCRIPT_DIR, f"{step}.py"), "-h"], args.repeats)
+        separate_time += step_time
+        logging.info("%-30s %8.2f s", f"{step}.py -h", step_time)
+
+    # Import cost of running all steps in one process, vs. one process each.
+    shared_time = _time_command([python, "-c", f"import {', '.join(args.steps)}"], args.repeats)
+    logging.info("%d steps as separate processes: %.2f s; in one process: %.2f s.",
+                 len(args.steps), separate_time, shared_time)
+
+
+########################################
+# Put everything together
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    argv = sys.argv[1:] if argv is None else argv
+
+    steps = _split_steps(argv)
+    if not steps or steps[0][0].startswith("-"):
+        _make_parser().parse_args(argv)
+        _make_parser().error("no step given")
+    for name, _ in steps:
+        if name not in STEPS and name != BENCHMARK:
+            _make_parser().error(f"unknown step {name!r}")
+
+    for name, args in steps:
+        logging.debug("Running step %s %s", name, " ".join(args))
+        if name == BENCHMARK:
+            _benchmark_startup(args)
+        else:
+            run_step(name, args)
+
+
+if __name__ == "__main__":
+    main()
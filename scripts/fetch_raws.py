@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# This file is part of ap_verify_dataset_template.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Script for materializing only the raws that a run needs.
+
+By default, Git LFS fetches all of raw/, even when a run processes only a few
+exposures or detectors. To avoid this, clone the dataset with
+``GIT_LFS_SKIP_SMUDGE=1``, which leaves raw/ as LFS pointer files, and run
+this script with the exposures and detectors to process. The script looks
+up the matching files in ``config/raw_manifest.json`` (written by
+``make_raw_manifest.py``), and materializes each one from a local object
+store, falling back to fetching it from the LFS server. Every materialized
+raw is checked against its LFS object ID, however it was transferred.
+
+Since ap_verify ingests everything in raw/, the pointer files of raws that
+were not fetched would fail ingestion. With ``--prune``, the script moves
+them out of raw/ into ``raw-unfetched/``, from which later runs restore them
+as needed. Run the script with ``--restore`` to put all of them back before
+using Git on raw/. Note that a ``GIT_LFS_SKIP_SMUDGE=1`` clone also leaves
+preloaded/ unfetched; fetch it with ``git lfs pull --include "preloaded/**"``.
+
+The object store is any directory laid out like ``.git/lfs/objects``, such
+as the LFS storage of another clone or a shared mirror. It is given with
+``-s`` or the ``AP_VERIFY_DATASET_RAW_STORE`` environment variable.
+
+This script does not need the Science Pipelines.
+
+Example:
+$ python fetch_raws.py -e 982985 943296 -d 164 168
+materializes the raws for detectors 164 and 168 of two exposures. See
+fetch_raws.py -h for more options.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+
+
+# Avoid explicit references to dataset package to maximize portability.
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+DATASET_DIR = os.path.normpath(os.path.join(SCRIPT_DIR, ".."))
+RAW_DIR = os.path.join(DATASET_DIR, "raw")
+UNFETCHED_DIR = os.path.join(DATASET_DIR, "raw-unfetched")
+# Must match make_raw_manifest.py
+MANIFEST_FILE = os.path.join(DATASET_DIR, "config", "raw_manifest.json")
+STORE_VARIABLE = "AP_VERIFY_DATASET_RAW_STORE"
+
+
+########################################
+# Command-line options
+
+def _make_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", dest="instrument",
+                        help="Instrument of the raws to fetch, defaults to all.")
+    parser.add_argument("-e", dest="exposures", type=int, nargs="+",
+                        help="Exposure IDs of the raws to fetch, defaults to all.")
+    parser.add_argument("-d", dest="detectors", type=int, nargs="+",
+                        help="Detector IDs of the raws to fetch, defaults to all.")
+    parser.add_argument("-s", dest="store", default=os.environ.get(STORE_VARIABLE),
+                        help=f"Local object store to materialize raws from, defaults to ${STORE_VARIABLE}.")
+    parser.add_argument("-t", dest="transfer", choices=["copy", "link", "symlink"], default="copy",
+                        help="How to materialize raws from the object store, defaults to 'copy'.")
+    parser.add_argument("--no-lfs", dest="lfs", action="store_false",
+                        help="Do not fetch raws missing from the object store from the LFS server.")
+    parser.add_argument("-n", "--dry-run", action="store_true",
+                        help="List the matching raws without materializing them.")
+    parser.add_argument("--prune", action="store_true",
+                        help="Move raws that are still LFS pointers out of raw/, so that they are not "
+                             "ingested.")
+    parser.add_argument("--restore", action="store_true",
+                        help="Move all raws moved by --prune back into raw/, and do nothing else.")
+    return parser
+
+
+########################################
+# File selection
+
+def _matches(data_id, instrument, exposures, detectors):
+    """Test whether a data ID satisfies the requested constraints.
+    """
+    return ((instrument is None or data_id["instrument"] == instrument)
+            and (exposures is None or data_id["exposure"] in exposures)
+            and (detectors is None or data_id["detector"] in detectors))
+
+
+def _select(manifest, instrument, exposures, detectors):
+    """Return the raw files containing any requested data ID.
+
+    Parameters
+    ----------
+    manifest : `dict` [`str`, `dict`]
+        The contents of the raw manifest.
+    instrument : `str` or `None`
+        The instrument to select, or `None` for all.
+    exposures, detectors : collection [`int`] or `None`
+        The exposures and detectors to select, or `None` for all.
+
+    Returns
+    -------
+    files : `dict` [`str`, `dict`]
+        The subset of ``manifest`` that matches.
+    """
+    return {path: entry for path, entry in manifest.items()
+            if any(_matches(id, instrument, exposures, detectors) for id in entry["data_ids"])}
+
+
+def _is_materialized(path, entry):
+    """Test whether a raw file has its real contents.
+
+    Since LFS pointer files are much smaller than any raw, checking the size
+    is enough.
+    """
+    try:
+        return os.path.getsize(os.path.join(RAW_DIR, path)) == entry["size"]
+    except FileNotFoundError:
+        return False
+
+
+########################################
+# Materialization
+
+def _get_object(store, oid):
+    """Return the location of an object in an LFS-style store.
+    """
+    return os.path.join(store, oid[0:2], oid[2:4], oid)
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _materialize(store, path, entry, transfer):
+    """Replace a raw file with its contents from the object store.
+
+    Parameters
+    ----------
+    store : `str`
+        The object store.
+    path : `str`
+        The raw file, relative to `RAW_DIR`.
+    entry : `dict`
+        The manifest entry of ``path``.
+    transfer : {"copy", "link", "symlink"}
+        How to create the file from the stored object.
+
+    Returns
+    -------
+    found : `bool`
+        `True` if the file was materialized, `False` if the object store
+        does not have a valid copy of it.
+    """
+    source = _get_object(store, entry["oid"])
+    if not os.path.exists(source) or os.path.getsize(source) != entry["size"]:
+        return False
+
+    dest = os.path.join(RAW_DIR, path)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    # Replace atomically, so that an interrupted run never leaves a partial raw.
+    temp = dest + ".partial"
+    match transfer:
+        case "copy":
+            shutil.copyfile(source, temp)
+        case "link":
+            os.link(source, temp)
+        case "symlink":
+            os.symlink(os.path.abspath(source), temp)
+    # For links, this hashes the stored object itself; removing temp leaves it in place.
+    if _hash_file(temp) != entry["oid"]:
+        os.remove(temp)
+        logging.warning("Stored object for %s is corrupt; skipping.", path)
+        return False
+    os.replace(temp, dest)
+    return True
+
+
+def _pull_from_lfs(paths):
+    """Fetch raw files from the LFS server.
+
+    Parameters
+    ----------
+    paths : iterable [`str`]
+        The raw files to fetch, relative to `RAW_DIR`.
+
+    Raises
+    ------
+    RuntimeError
+        Raised if Git LFS fails.
+    """
+    include = ",".join(os.path.relpath(os.path.join(RAW_DIR, p), DATASET_DIR) for p in paths)
+    results = subprocess.run(["git", "lfs", "pull", "--include", include], cwd=DATASET_DIR,
+                             capture_output=False, shell=False, check=False)
+    if results.returncode:
+        raise RuntimeError("git lfs pull failed; see log for details.")
+
+
+########################################
+# Pruning
+
+def _move(paths, source_dir, dest_dir):
+    """Move raw files between directories, keeping their relative paths.
+
+    Parameters
+    ----------
+    paths : iterable [`str`]
+        The raw files to move, relative to both directories. Files not in
+        ``source_dir`` are ignored.
+    source_dir, dest_dir : `str`
+        The directories to move the files from and to.
+
+    Returns
+    -------
+    n_moved : `int`
+        The number of files moved.
+    """
+    n_moved = 0
+    for path in paths:
+        source = os.path.join(source_dir, path)
+        if os.path.lexists(source):
+            dest = os.path.join(dest_dir, path)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            os.replace(source, dest)
+            n_moved += 1
+    return n_moved
+
+
+def _prune(manifest):
+    """Move all unmaterialized raw files out of `RAW_DIR`.
+
+    Parameters
+    ----------
+    manifest : `dict` [`str`, `dict`]
+        The contents of the raw manifest.
+    """
+    unfetched = [path for path, entry in manifest.items() if not _is_materialized(path, entry)]
+    n_moved = _move(unfetched, RAW_DIR, UNFETCHED_DIR)
+    logging.info("Moved %d unfetched raw files to %s.", n_moved, UNFETCHED_DIR)
+
+
+def _restore(paths):
+    """Move raw files set aside by `_prune` back into `RAW_DIR`.
+
+    Parameters
+    ----------
+    paths : iterable [`str`]
+        The raw files to restore, relative to `RAW_DIR`.
+    """
+    n_moved = _move(paths, UNFETCHED_DIR, RAW_DIR)
+    if n_moved:
+        logging.info("Restored %d raw files from %s.", n_moved, UNFETCHED_DIR)
+
+
+########################################
+# Put everything together
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    args = _make_parser().parse_args(argv)
+
+    with open(MANIFEST_FILE) as f:
+        manifest = json.load(f)
+    if args.restore:
+        _restore(manifest)
+        return
+    selected = _select(manifest, args.instrument, args.exposures, args.detectors)
+    if not selected:
+        raise RuntimeError("No raws match the requested data IDs.")
+    total_size = sum(entry["size"] for entry in manifest.values())
+    selected_size = sum(entry["size"] for entry in selected.values())
+    logging.info("%d of %d raw files (%.1f of %.1f MB) match.",
+                 len(selected), len(manifest), selected_size / 1e6, total_size / 1e6)
+    if args.dry_run:
+        for path in selected:
+            logging.info("%s", path)
+        return
+
+    # Git LFS can only fetch files whose pointers are in raw/.
+    _restore(selected)
+    missing = {path: entry for path, entry in selected.items() if not _is_materialized(path, entry)}
+    logging.info("%d files already materialized.", len(selected) - len(missing))
+    if args.store:
+        from_store = {path for path, entry in missing.items()
+                      if _materialize(args.store, path, entry, args.transfer)}
+        logging.info("%d files materialized from %s.", len(from_store), args.store)
+        missing = {path: entry for path, entry in missing.items() if path not in from_store}
+    if missing and args.lfs:
+        logging.info("Fetching %d files from Git LFS...", len(missing))
+        _pull_from_lfs(missing)
+        missing = {path: entry for path, entry in missing.items() if not _is_materialized(path, entry)}
+
+    if missing:
+        raise RuntimeError(f"{len(missing)} raw files could not be materialized: {', '.join(missing)}")
+    logging.info("All %d requested raw files are materialized.", len(selected))
+    if args.prune:
+        _prune(manifest)
+
+
+if __name__ == "__main__":
+    main()
@@ -31,14 +31,13 @@ Example:
 $ python generate_group_dimensions.py
 """
 
+import argparse
 import logging
 import os
 import sys
 
 from lsst.daf.butler import Butler
 
-logging.basicConfig(level=logging.INFO, stream=sys.stdout)
-
 
 INSTRUMENT = "LSSTCam"
 # The group IDs to generate. For precursor instruments they equal the exposure
@@ -52,10 +51,26 @@ DATASET_REPO = os.path.normpath(os.path.join(SCRIPT_DIR, "..", "preloaded"))
 
 
 ########################################
+# Command-line options
+
+def _make_parser():
+    return argparse.ArgumentParser()
+
+
+########################################
+# Put everything together
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    _make_parser().parse_args(argv)
+
+    records = [{"name": group, "instrument": INSTRUMENT} for group in GROUP_IDS]
+
+    repo = Butler(DATASET_REPO, writeable=True)
+    repo.registry.insertDimensionData("group", *records, replace=True, skip_existing=False)
 
-records = [{"name": group, "instrument": INSTRUMENT} for group in GROUP_IDS]
+    logging.info(f"Records for groups {GROUP_IDS} stored in {DATASET_REPO}.")
 
-repo = Butler(DATASET_REPO, writeable=True)
-repo.registry.insertDimensionData("group", *records, replace=True, skip_existing=False)
 
-logging.info(f"Records for groups {GROUP_IDS} stored in {DATASET_REPO}.")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# This file is part of ap_verify_dataset_template.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Script for running ISR once on this dataset's raws and storing the results.
+
+The post-ISR exposures are stored in the ``isr`` collection of preloaded/,
+where ``pipelines/ApPipeFromPostIsr.yaml`` can use them in place of running
+ISR. Since the raws and calibs are fixed, the exposures are identical to those
+that ApPipe would create.
+
+This script requires that the calibs are already in preloaded/. It must be
+rerun whenever the calibs or the ISR configuration change.
+
+Example:
+$ python generate_isr_exposures.py
+"""
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+
+import lsst.log
+from lsst.daf.butler import Butler, CollectionType, MissingCollectionError
+
+from chunked_transfer import transfer_in_chunks
+from pipeline_runner import run_pipeline
+from scratch_repo import RAW_RUN, make_preloaded_copy
+
+
+# Avoid explicit references to dataset package to maximize portability.
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+PIPE_DIR = os.path.normpath(os.path.join(SCRIPT_DIR, "..", "pipelines"))
+DEST_DIR = os.path.normpath(os.path.join(SCRIPT_DIR, "..", "preloaded"))
+# Must match the label in ApPipe.yaml and the exclusion in
+# ApPipeFromPostIsr.yaml.
+ISR_LABEL = "isr"
+DEST_COLLECTION = "isr"
+DEST_RUN = DEST_COLLECTION + "/post_isr"
+
+
+########################################
+# Command-line options
+
+def _make_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-j", dest="processes", type=int, default=6,
+                        help="Number of processes for pipetask, defaults to 6.")
+    return parser
+
+
+########################################
+# Processing steps
+
+def _clear_exposures(butler):
+    """Remove previous post-ISR exposures from this repository.
+
+    Parameters
+    ----------
+    butler : `lsst.daf.butler.Butler`
+        A writeable Butler pointing to this repository.
+    """
+    try:
+        runs = butler.registry.getCollectionChain(DEST_COLLECTION)
+    except MissingCollectionError:
+        # No prior exposures
+        return
+    butler.registry.setCollectionChain(DEST_COLLECTION, [])
+    butler.removeRuns(runs, unstore=True)
+
+
+def _get_exposure_type():
+    """Return the dataset type of the post-ISR exposures made by ApPipe.
+
+    Returns
+    -------
+    dataset_type : `str`
+        The name of the dataset type.
+    """
+    import lsst.pipe.base
+
+    pipeline = lsst.pipe.base.Pipeline.fromFile(os.path.join(PIPE_DIR, f"ApPipe.yaml#{ISR_LABEL}"))
+    pipeline.addConfigOverride("parameters", "apdb_config", "foo")
+    task = pipeline.to_graph().tasks[ISR_LABEL]
+    return task.config.connections.outputExposure
+
+
+########################################
+# Put everything together
+
+def main(argv=None):
+    import lsst.obs.base
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    lsst.log.configure_pylog_MDC("DEBUG", MDC_class=None)
+    args = _make_parser().parse_args(argv)
+
+    preloaded = Butler(DEST_DIR, writeable=True)
+    logging.info("Removing old exposures...")
+    _clear_exposures(preloaded)
+    exposure_type = _get_exposure_type()
+
+    logging.info("Creating temporary repository...")
+    with tempfile.TemporaryDirectory() as workspace:
+        temp_repo = make_preloaded_copy(workspace, DEST_DIR)
+        inst_name = temp_repo.query_data_ids("instrument")[0]["instrument"]
+        instrument = lsst.obs.base.Instrument.fromName(inst_name, temp_repo.registry)
+        logging.info("Running ISR...")
+        run_pipeline(workspace, f"ApPipe.yaml#{ISR_LABEL}",
+                     [RAW_RUN, instrument.makeUmbrellaCollectionName()], DEST_RUN, "", args.processes)
+        temp_repo.registry.refresh()    # Pipeline added dataset types
+        logging.info("Transferring %s to data set...", exposure_type)
+        exposures = temp_repo.query_datasets(exposure_type, collections=DEST_RUN, explain=False)
+        transfer_in_chunks(preloaded, temp_repo, exposures,
+                           register_dataset_types=True, transfer_dimensions=True)
+
+    preloaded.registry.registerCollection(DEST_COLLECTION, CollectionType.CHAINED)
+    preloaded.registry.setCollectionChain(DEST_COLLECTION, [DEST_RUN])
+
+    logging.info("%d post-ISR exposures stored in %s:%s", len(exposures), DEST_DIR, DEST_COLLECTION)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# This file is part of ap_verify_dataset_template.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Script for generating the QuantumGraphs of this dataset's pipelines ahead
+of time.
+
+Scripts that run pipelines through ``pipeline_runner.py`` load a stored graph
+whenever one matches the run (see ``pipeline_runner.get_graph_key``), and
+otherwise generate one and store it. This script fills that cache for the
+given pipelines, output run, and data query, so that the next such runs skip
+graph generation entirely. Graphs are built against a copy of the scratch
+repository, so they stay valid until the raws, preloaded/, the pipelines,
+the configs, or the software change.
+
+This script requires that preloaded/ be complete.
+
+Example:
+$ python generate_quantum_graphs.py -p ApVerify.yaml -o profile
+$ python profile_pipeline.py -p ApVerify.yaml -o profile -w /scratch/me/profile
+profiles ApVerify.yaml from a stored graph. See generate_quantum_graphs.py -h
+for more options.
+"""
+
+import argparse
+import glob
+import logging
+import os
+import sys
+import tempfile
+
+import lsst.log
+
+from pipeline_runner import GRAPH_DIR, GRAPH_EXTENSION, build_graph, get_graph_file, get_graph_key
+from scratch_repo import RAW_RUN, make_preloaded_copy
+
+
+PIPELINES = ["ApPipe.yaml", "ApPipeFromPostIsr.yaml", "ApPipeWithWarpedTemplates.yaml",
+             "ApVerify.yaml", "ApVerifyWithFakes.yaml"]
+
+
+########################################
+# Command-line options
+
+def _make_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", dest="pipelines", action="append", choices=PIPELINES,
+                        help="Pipeline for which to generate a graph; may be repeated. "
+                             "Defaults to all pipelines.")
+    parser.add_argument("-o", dest="output_run", required=True,
+                        help="Output run of the runs that will use the graphs.")
+    parser.add_argument("-d", dest="data_query", default="",
+                        help="Query string of the runs that will use the graphs.")
+    parser.add_argument("--clear", action="store_true",
+                        help=f"Delete all stored graphs in {GRAPH_DIR} first.")
+    return parser
+
+
+########################################
+# Put everything together
+
+def main(argv=None):
+    import lsst.obs.base
+
+    # Ensure logs from tasks are visible
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    lsst.log.configure_pylog_MDC("DEBUG", MDC_class=None)
+
+    args = _make_parser().parse_args(argv)
+
+    if args.clear:
+        old_files = glob.glob(os.path.join(GRAPH_DIR, f"*{GRAPH_EXTENSION}"))
+        for old_file in old_files:
+            os.remove(old_file)
+        logging.info("Deleted %d stored graphs.", len(old_files))
+
+    logging.info("Creating temporary repository...")
+    with tempfile.TemporaryDirectory() as workspace:
+        repo = make_preloaded_copy(workspace)
+        inst_name = repo.query_data_ids("instrument")[0]["instrument"]
+        instrument = lsst.obs.base.Instrument.fromName(inst_name, repo.registry)
+        inputs = [RAW_RUN, instrument.makeUmbrellaCollectionName()]
+        for pipeline_name in args.pipelines or PIPELINES:
+            graph_file = get_graph_file(
+                pipeline_name, get_graph_key(repo, pipeline_name, inputs, args.output_run, args.data_query))
+            if os.path.exists(graph_file):
+                logging.info("Graph for %s is up to date.", pipeline_name)
+                continue
+            logging.info("Generating graph for %s...", pipeline_name)
+            build_graph(workspace, pipeline_name, inputs, args.output_run, args.data_query, graph_file)
+            logging.info("Graph for %s stored in %s.", pipeline_name, graph_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -31,34 +31,99 @@ but does not require that export.yaml be up to date. It (or rather, the
 pipeline configs) require that the repository be set up.
 
 This script takes roughly <TBD> minutes to run on rubin-devl.
+
+The catalogs may optionally be rewritten into a smaller, spatially sorted form
+by running ``partition_preloaded_catalogs.py`` afterward.
+
+If the AP_VERIFY_DATASET_PROFILE_DIR environment variable is set, every
+quantum is profiled, and a per-task report of the hottest functions is
+written to that directory. The report is also stored with the catalogs in the
+simulated run's repository (which is kept with ``--cache``), as a
+``quantum_profile_report`` dataset. Profiling runs every pipetask in a single
+process, so it is much slower than a normal run.
+
+With ``--cache``, the repository used for the simulated run is kept in the
+scratch directory (see ``scratch_repo.py``), next to the scratch repositories.
+A later run with
+``--reassociate`` then replays only the APDB-dependent tasks of ApPipe, in
+visit order and against a new APDB, reusing the cached DIA sources. This is
+much faster than a full run, but is only valid if nothing upstream of
+association has changed since the cached run.
+
+Visits are associated strictly in order, but the tasks that do not depend on
+the APDB (such as ISR, image subtraction, and detection) are run ahead for
+the next ``--lookahead`` visits while the current visit is associated. With
+``--check-overlap``, the script instead runs the simulation both with and
+without overlap in temporary repositories, and checks that the catalogs are
+the same.
+
+Example:
+$ python generate_self_preload.py --cache
+$ python generate_self_preload.py --reassociate
+See generate_self_preload.py -h for more options.
 """
 
-import glob
+import argparse
+import concurrent.futures
+import contextlib
 import logging
 import os
+import shutil
 import subprocess
 import sys
 import tempfile
 
 import lsst.log
 from lsst.daf.butler import Butler, CollectionType, MissingCollectionError
-import lsst.obs.base
-import lsst.dax.apdb
-
 
-logging.basicConfig(level=logging.INFO, stream=sys.stdout)
-lsst.log.configure_pylog_MDC("DEBUG", MDC_class=None)
+from chunked_transfer import transfer_in_chunks
+from quantum_profiler import PROFILE_ENV, aggregate_profiles, clear_profiles, format_report, \
+    pipetask_command, write_report
+from scratch_repo import RAW_RUN, SCRATCH_DIR, get_fingerprint, make_preloaded_copy
 
 
 # Avoid explicit references to dataset package to maximize portability.
 SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
 PIPE_DIR = os.path.join(SCRIPT_DIR, "..", "pipelines")
-RAW_DIR = os.path.join(SCRIPT_DIR, "..", "raw")
-RAW_RUN = "raw"
 PRELOAD_TYPES = ["preloaded_*"]
 DEST_DIR = os.path.join(SCRIPT_DIR, "..", "preloaded")
 DEST_COLLECTION = "dia_catalogs"
 DEST_RUN = DEST_COLLECTION + "/apdb"
+# Not a scratch repository, so it is kept when the raws change; the marker
+# file records which raws it was made from.
+CACHE_DIR = os.path.join(SCRATCH_DIR, "self_preload")
+CACHE_MARKER = "complete"
+REPLAY_RUN = DEST_COLLECTION + "/reassociated"
+# The ApPipe tasks that read or write the APDB; must match the labels in
+# ApPipe.yaml.
+REPLAY_LABELS = ["loadDiaCatalogs", "diaPipe"]
+# Suffix of the chain holding the outputs of APDB-independent tasks, when
+# they are run ahead of association.
+PREP_SUFFIX = "/prep"
+PROCESSES = 6
+# Columns that record when a row was written, rather than anything derived
+# from the data; ignored when comparing catalogs.
+VOLATILE_COLUMNS = {"time_processed", "time_withdrawn"}
+
+
+########################################
+# Command-line options
+
+def _make_parser():
+    parser = argparse.ArgumentParser()
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--cache", action="store_true",
+                      help=f"Keep the simulated run's repository in {CACHE_DIR} for use with --reassociate. "
+                           "The directory may be moved by setting AP_VERIFY_DATASET_SCRATCH.")
+    mode.add_argument("--reassociate", action="store_true",
+                      help="Rerun only association, using the DIA sources from the last run with --cache.")
+    mode.add_argument("--check-overlap", action="store_true",
+                      help="Check that the catalogs do not depend on --lookahead, without changing this "
+                           "repository.")
+    parser.add_argument("--lookahead", type=int, default=2,
+                        help="Number of visits to process up to association while the current visit is "
+                             "being associated, defaults to 2. Use 0 to process one visit at a time.")
+    return parser
 
 
 ########################################
@@ -84,74 +149,223 @@ def _clear_preloaded(butler):
     butler.removeRuns([DEST_RUN], unstore=True)
 
 
-def _copy_repo_to(src_butler, repo_dir):
-    """Create a repository that's a copy of this one.
+def _check_pipeline(butler):
+    """Confirm that the pipeline is correctly configured.
 
     Parameters
     ----------
-    src_butler : `lsst.daf.butler.Butler`
+    butler : `lsst.daf.butler.Butler`
         A Butler pointing to this repository.
-    repo_dir : `str`
-        The directory in which to create the new repository.
+    """
+    import lsst.pipe.base
+
+    pipeline_file = os.path.join(PIPE_DIR, "ApPipe.yaml")
+    pipeline = lsst.pipe.base.Pipeline.fromFile(pipeline_file)
+    pipeline.addConfigOverride("parameters", "apdb_config", "foo")
+    # Check that the configs load correctly; raises if there's a setup missing
+    pipeline.to_graph()
+
+
+def _split_pipeline():
+    """Divide ApPipe into the tasks that do and do not depend on the APDB.
 
     Returns
     -------
-    butler : `lsst.daf.butler.Butler`
-        A writeable Butler to the new repo.
-    """
-    # Don't use ap_verify code, to avoid dependency on potentially out-of-date export.yaml
-    repo_config = Butler.makeRepo(repo_dir)
-    dest_butler = Butler(repo_config, writeable=True)
-    logging.debug("Temporary repo has universe version %d.", dest_butler.dimensions.version)
-    # Use export/import to preserve chained and calibration collections
-    with tempfile.NamedTemporaryFile(suffix=".yaml") as export_file:
-        with src_butler.export(filename=export_file.name, transfer=None) as contents:
-            for t in src_butler.registry.queryDatasetTypes():
-                contents.saveDatasets(
-                    src_butler.query_datasets(t, collections="*", find_first=False, explain=False))
-            # runs and dimensions included automatically
-            for coll in src_butler.collections.query("*", include_chains=True):
-                contents.saveCollection(coll)
-        dest_butler.import_(directory=DEST_DIR, filename=export_file.name, transfer="auto")
-    return dest_butler
-
-
-def _ingest_raws(repo, raw_dir, run):
-    """Ingest this dataset's raws into a specific repo.
-
-    Parameters
-    ---------
-    repo : `lsst.daf.butler.Butler`
-        A writeable Butler for the repository to ingest into.
-    raw_dir : `str`
-        The directory containing raw files.
-    run : `str`
-        The name of the run into which to import the raws.
+    independent : `list` [`str`]
+        The labels of the tasks that neither use the APDB nor depend on a
+        task that does.
+    dependent : `list` [`str`]
+        The labels of all other tasks.
     """
-    raws = glob.glob(os.path.join(raw_dir, '**', '*.fits*'), recursive=True)
-    ingester = lsst.obs.base.RawIngestTask(butler=repo, config=lsst.obs.base.RawIngestConfig())
-    ingester.run(raws, run=run)
-    exposures = set(repo.registry.queryDataIds(["exposure"]))
-    definer = lsst.obs.base.DefineVisitsTask(butler=repo, config=lsst.obs.base.DefineVisitsConfig())
-    definer.run(exposures)
+    import lsst.pipe.base
 
+    pipeline = lsst.pipe.base.Pipeline.fromFile(os.path.join(PIPE_DIR, "ApPipe.yaml"))
+    pipeline.addConfigOverride("parameters", "apdb_config", "foo")
+    graph = pipeline.to_graph()
+
+    dependent = set(REPLAY_LABELS)
+    changed = True
+    while changed:
+        changed = False
+        for label, task in graph.tasks.items():
+            if label in dependent:
+                continue
+            producers = {graph.producer_of(edge.parent_dataset_type_name) for edge in task.inputs.values()}
+            if any(producer is not None and producer.label in dependent for producer in producers):
+                dependent.add(label)
+                changed = True
+    independent = [label for label in graph.tasks if label not in dependent]
+    return independent, sorted(dependent)
+
+
+def _run_pipetask(repo_dir, apdb_config_file, data_query, pipeline_file, input_collections, output_run,
+                  extend_run=False, processes=PROCESSES):
+    """Run ApPipe or a subset of it.
 
-def _check_pipeline(butler):
-    """Confirm that the pipeline is correctly configured.
+    Parameters
+    ----------
+    repo_dir : `str`
+        The repository on which to run the pipeline.
+    apdb_config_file : `str`
+        The APDB config file.
+    data_query : `str`
+        The query restricting the data to process.
+    pipeline_file : `str`
+        The pipeline to run, including any subset.
+    input_collections : iterable [`str`]
+        The collections containing inputs.
+    output_run : `str`
+        The run into which to write outputs.
+    extend_run : `bool`, optional
+        Whether ``output_run`` already exists.
+    processes : `int`, optional
+        The number of processes for pipetask. Ignored if profiling is enabled,
+        as quanta in worker processes cannot be profiled.
+
+    Raises
+    ------
+    RuntimeError
+        Raised on any pipeline failure.
+    """
+    profile_dir = os.environ.get(PROFILE_ENV)
+    if profile_dir:
+        pipetask = pipetask_command(profile_dir)
+        processes = 1
+    else:
+        pipetask = ["pipetask"]
+    pipeline_args = pipetask + ["run",
+                                "--butler-config", repo_dir,
+                                "--pipeline", pipeline_file,
+                                "--config", f"parameters:apdb_config='{apdb_config_file}'",
+                                "--input", ",".join(input_collections),
+                                "--output-run", output_run,
+                                "--data-query", data_query,
+                                "--processes", str(processes),
+                                "--register-dataset-types",
+                                ]
+    if extend_run:
+        pipeline_args.append("--extend-run")
+    results = subprocess.run(pipeline_args, capture_output=False, shell=False, check=False)
+    if results.returncode:
+        raise RuntimeError("Pipeline failed to run; see log for details.")
+
+
+def _run_in_order(run_visit, visits, pipeline_file, input_collections, output_collection):
+    """Run a pipeline one visit at a time.
 
     Parameters
     ----------
-    butler : `lsst.daf.butler.Butler`
-        A Butler pointing to this repository.
+    run_visit : callable
+        A function that takes a visit and the remaining arguments of
+        `_run_pipetask`, and runs the pipeline on that visit.
+    visits : iterable [`int`]
+        The visits to process, in order.
+    pipeline_file : `str`
+        The pipeline to run, including any subset.
+    input_collections : iterable [`str`]
+        The collections containing inputs.
+    output_collection : `str`
+        The run into which to write outputs.
     """
-    pipeline_file = os.path.join(PIPE_DIR, "ApPipe.yaml")
-    pipeline = lsst.pipe.base.Pipeline.fromFile(pipeline_file)
-    pipeline.addConfigOverride("parameters", "apdb_config", "foo")
-    # Check that the configs load correctly; raises if there's a setup missing
-    pipeline.to_graph()
+    run_exists = False
+    for visit in visits:
+        logging.info("Generating catalogs for visit %d...", visit)
+        # Can reuse collection as long as data IDs don't overlap
+        run_visit(visit, pipeline_file, input_collections, output_collection, extend_run=run_exists)
+        run_exists = True
+
 
+def _share_processes(lookahead):
+    """Divide `PROCESSES` among the pipetasks that run at once when visits
+    are overlapped.
 
-def _build_catalogs(repo_dir, input_collections, output_collection):
+    Parameters
+    ----------
+    lookahead : `int`
+        The number of visits whose APDB-independent tasks run at once.
+
+    Returns
+    -------
+    prep_processes : `int`
+        The number of processes for each pipetask of APDB-independent tasks.
+    association_processes : `int`
+        The number of processes for the pipetask of APDB-dependent tasks.
+
+    Notes
+    -----
+    Every pipetask gets at least one process, so ``lookahead`` values of
+    `PROCESSES` or more use more than `PROCESSES` processes in total.
+    """
+    association_processes = max(1, PROCESSES // (lookahead + 1))
+    prep_processes = max(1, (PROCESSES - association_processes) // lookahead)
+    return prep_processes, association_processes
+
+
+def _run_overlapped(repo_dir, run_visit, visits, input_collections, output_collection, lookahead):
+    """Run ApPipe with the APDB-independent tasks of upcoming visits
+    overlapping the association of the current visit.
+
+    The APDB-independent tasks of each visit write to their own run, so that
+    several visits can be processed at once. The APDB-dependent tasks of
+    each visit start only once those of the previous visit have finished,
+    so the APDB sees the same sequence of visits as in `_run_in_order`.
+
+    Parameters
+    ----------
+    repo_dir : `str`
+        The repository on which to run the pipeline.
+    run_visit : callable
+        A function that takes a visit and the remaining arguments of
+        `_run_pipetask`, and runs the pipeline on that visit.
+    visits : sequence [`int`]
+        The visits to process, in order.
+    input_collections : iterable [`str`]
+        The collections containing inputs.
+    output_collection : `str`
+        The run into which to write the outputs of APDB-dependent tasks. The
+        outputs of other tasks are written to runs in the
+        ``<output_collection>/prep`` chain.
+    lookahead : `int`
+        The maximum number of visits whose APDB-independent tasks run at
+        once, alongside the APDB-dependent tasks of the current visit. The
+        pipetasks share `PROCESSES` (see `_share_processes`).
+    """
+    if not visits:
+        return
+    independent, dependent = _split_pipeline()
+    logging.debug("APDB-independent tasks: %s; APDB-dependent tasks: %s", independent, dependent)
+    pipeline_file = os.path.join(PIPE_DIR, "ApPipe.yaml")
+    prep_runs = {visit: f"{output_collection}{PREP_SUFFIX}/{visit}" for visit in visits}
+    prep_processes, association_processes = _share_processes(lookahead)
+
+    def prepare(visit, processes=prep_processes):
+        logging.info("Processing visit %d up to association...", visit)
+        run_visit(visit, pipeline_file + "#" + ",".join(independent), input_collections, prep_runs[visit],
+                  processes=processes)
+
+    # The first visit runs alone, so that concurrent pipetasks don't race to
+    # register the same dataset types.
+    prepare(visits[0], processes=PROCESSES)
+    prepared = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=lookahead) as executor:
+        for i, visit in enumerate(visits):
+            for upcoming in visits[i + 1:i + 1 + lookahead]:
+                if upcoming not in prepared:
+                    prepared[upcoming] = executor.submit(prepare, upcoming)
+            if visit in prepared:
+                prepared[visit].result()
+            logging.info("Associating visit %d...", visit)
+            run_visit(visit, pipeline_file + "#" + ",".join(dependent),
+                      [prep_runs[visit]] + list(input_collections), output_collection, extend_run=i > 0,
+                      processes=association_processes)
+
+    butler = Butler(repo_dir, writeable=True)
+    butler.collections.register(output_collection + PREP_SUFFIX, CollectionType.CHAINED)
+    butler.collections.redefine_chain(output_collection + PREP_SUFFIX, [prep_runs[v] for v in visits])
+
+
+def _build_catalogs(repo_dir, input_collections, output_collection, labels=None, apdb_name="apdb.db",
+                    lookahead=0):
     """Simulate an AP pipeline run.
 
     Parameters
@@ -162,47 +376,52 @@ def _build_catalogs(repo_dir, input_collections, output_collection):
         The collection containing inputs.
     output_collection : `str`
         The collection into which to generate preloaded catalogs.
+    labels : iterable [`str`], optional
+        The tasks to run. If not provided, runs all of ApPipe.
+    apdb_name : `str`, optional
+        The file name of the APDB to create in ``repo_dir``. Any existing
+        APDB with that name is replaced.
+    lookahead : `int`, optional
+        If positive, the number of upcoming visits to process up to
+        association while the current visit is associated (see
+        `_run_overlapped`). Ignored if ``labels`` is provided. If zero,
+        each visit is processed in full before the next one.
 
     Raises
     ------
     RuntimeError
         Raised on any pipeline failure.
     """
+    import lsst.dax.apdb
+
     # Should be only one instrument
     butler = Butler(repo_dir)
     instrument = butler.query_data_ids("instrument")[0]["instrument"]
-    visits = [coord["visit"] for coord in butler.query_data_ids("visit")]
+    # Guarantee execution in observation order
+    visits = sorted(coord["visit"] for coord in butler.query_data_ids("visit"))
     pipeline_file = os.path.join(PIPE_DIR, "ApPipe.yaml")
+    if labels:
+        pipeline_file += "#" + ",".join(labels)
 
     # Create temporary APDB
-    apdb_location = f"sqlite:///{repo_dir}/apdb.db"
+    apdb_file = os.path.join(repo_dir, apdb_name)
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(apdb_file)
+    apdb_location = f"sqlite:///{apdb_file}"
     logging.debug("Creating apdb at %s...", apdb_location)
     apdb_config = lsst.dax.apdb.ApdbSql.init_database(db_url=apdb_location)
 
     with tempfile.NamedTemporaryFile(suffix=".py") as config_file:
         apdb_config.save(config_file.name)
 
-        # Guarantee execution in observation order
-        run_exists = False
-        for visit in sorted(visits):
-            logging.info("Generating catalogs for visit %d...", visit)
-            pipeline_args = ["pipetask", "run",
-                             "--butler-config", repo_dir,
-                             "--pipeline", pipeline_file,
-                             "--config", f"parameters:apdb_config='{config_file.name}'",
-                             "--input", ",".join(input_collections),
-                             # Can reuse collection as long as data IDs don't overlap
-                             "--output-run", output_collection,
-                             "--data-query", f"instrument='{instrument}' and visit={visit}",
-                             "--processes", "6",
-                             "--register-dataset-types",
-                             ]
-            if run_exists:
-                pipeline_args.append("--extend-run")
-            results = subprocess.run(pipeline_args, capture_output=False, shell=False, check=False)
-            run_exists = True
-            if results.returncode:
-                raise RuntimeError("Pipeline failed to run; see log for details.")
+        def run_visit(visit, *args, **kwargs):
+            _run_pipetask(repo_dir, config_file.name, f"instrument='{instrument}' and visit={visit}",
+                          *args, **kwargs)
+
+        if lookahead > 0 and not labels:
+            _run_overlapped(repo_dir, run_visit, visits, input_collections, output_collection, lookahead)
+        else:
+            _run_in_order(run_visit, visits, pipeline_file, input_collections, output_collection)
 
 
 def _transfer_catalogs(catalog_types, src_repo, run, dest_repo):
@@ -224,31 +443,270 @@ def _transfer_catalogs(catalog_types, src_repo, run, dest_repo):
     datasets = set()
     for t in expanded_types:
         datasets.update(src_repo.query_datasets(t, collections=run, explain=False))
-    dest_repo.transfer_from(src_repo, datasets, transfer="copy",
-                            register_dataset_types=True, transfer_dimensions=True)
+    transfer_in_chunks(dest_repo, src_repo, datasets,
+                       register_dataset_types=True, transfer_dimensions=True)
 
 
-########################################
-# Put everything together
+def _copy_catalogs(catalog_types, src_repo, src_run, dest_repo, dest_run):
+    """Copy preloaded catalogs between two repositories, changing their run.
+
+    Parameters
+    ----------
+    catalog_types : iterable [`str`]
+        A query expression for dataset types for preloaded catalogs.
+    src_repo : `lsst.daf.butler.Butler`
+        The repository from which to copy the datasets.
+    src_run : `str`
+        The name of the run containing the catalogs in ``src_repo``.
+    dest_repo : `lsst.daf.butler.Butler`
+        The repository to which to copy the datasets. Must already have the
+        dataset types and dimension records of the catalogs.
+    dest_run : `str`
+        The name of the run in which to store the catalogs in ``dest_repo``.
+    """
+    dest_repo.registry.registerRun(dest_run)
+    for t in src_repo.registry.queryDatasetTypes(catalog_types):
+        for ref in src_repo.query_datasets(t, collections=src_run, explain=False):
+            dest_repo.put(src_repo.get(ref), t, ref.dataId, run=dest_run)
+
 
-preloaded = Butler(DEST_DIR, writeable=True)
-_check_pipeline(preloaded)
-logging.info("Removing old catalogs...")
-_clear_preloaded(preloaded)
-logging.info("Creating temporary repository...")
-with tempfile.TemporaryDirectory() as workspace:
-    temp_repo = _copy_repo_to(preloaded, workspace)
-    logging.info("Ingesting raws...")
-    _ingest_raws(temp_repo, RAW_DIR, RAW_RUN)
+def _run_simulation(workspace, lookahead):
+    """Run the full AP pipeline in a copy of this repository.
+
+    Parameters
+    ----------
+    workspace : `str`
+        An empty directory in which to create a repository and APDB.
+    lookahead : `int`
+        The number of visits to process ahead of association, as for
+        `_build_catalogs`.
+
+    Returns
+    -------
+    temp_repo : `lsst.daf.butler.Butler`
+        A Butler pointing to the new repository, with the catalogs in
+        ``DEST_RUN``.
+    """
+    import lsst.obs.base
+
+    temp_repo = make_preloaded_copy(workspace, DEST_DIR)
     logging.info("Simulating DIA analysis...")
     inst_name = temp_repo.query_data_ids("instrument")[0]["instrument"]
     instrument = lsst.obs.base.Instrument.fromName(inst_name, temp_repo.registry)
-    _build_catalogs(workspace, [RAW_RUN, instrument.makeUmbrellaCollectionName()], DEST_RUN)
+    _build_catalogs(workspace, [RAW_RUN, instrument.makeUmbrellaCollectionName()], DEST_RUN,
+                    lookahead=lookahead)
     temp_repo.registry.refresh()    # Pipeline added dataset types
+    return temp_repo
+
+
+def _store_profile_report(butler, run):
+    """Store the profiling report of a simulated run with its outputs, if
+    profiling is enabled.
+
+    Parameters
+    ----------
+    butler : `lsst.daf.butler.Butler`
+        A writeable Butler pointing to the repository of the simulated run.
+    run : `str`
+        The output run of the simulated run.
+    """
+    profile_dir = os.environ.get(PROFILE_ENV)
+    if not profile_dir:
+        return
+    report = aggregate_profiles(profile_dir)
+    write_report(report, butler, run)
+    profile_file = os.path.join(profile_dir, "report.txt")
+    with open(profile_file, "w") as f:
+        f.write(format_report(report))
+    logging.info("Profiling report stored in run %s and in %s.", run, profile_file)
+
+
+def _simulate(preloaded, workspace, lookahead=0):
+    """Run the full AP pipeline and copy its catalogs to this repository.
+
+    Parameters
+    ----------
+    preloaded : `lsst.daf.butler.Butler`
+        A writeable Butler pointing to this repository.
+    workspace : `str`
+        An empty directory in which to create a repository and APDB.
+    lookahead : `int`, optional
+        The number of visits to process ahead of association, as for
+        `_build_catalogs`.
+    """
+    temp_repo = _run_simulation(workspace, lookahead)
+    _store_profile_report(temp_repo, DEST_RUN)
     logging.debug("Preloaded repo has universe version %d.", preloaded.dimensions.version)
     logging.info("Transferring catalogs to data set...")
     _transfer_catalogs(PRELOAD_TYPES, temp_repo, DEST_RUN, preloaded)
-preloaded.collections.register(DEST_COLLECTION, CollectionType.CHAINED)
-preloaded.collections.prepend_chain(DEST_COLLECTION, DEST_RUN)
 
-logging.info("Preloaded APDB catalogs copied to %s:%s", DEST_DIR, DEST_COLLECTION)
+
+def _check_cache(workspace):
+    """Confirm that a cached run can be used with ``--reassociate``.
+
+    Parameters
+    ----------
+    workspace : `str`
+        The directory in which the run was cached.
+
+    Raises
+    ------
+    RuntimeError
+        Raised if there is no completed run in ``workspace``, or if the raws
+        have changed since it was made.
+    """
+    marker = os.path.join(workspace, CACHE_MARKER)
+    if not os.path.exists(marker):
+        raise RuntimeError(f"No cached run in {workspace}; run with --cache first.")
+    with open(marker) as f:
+        if f.read().strip() != get_fingerprint():
+            raise RuntimeError("Raws have changed since the cached run; run with --cache first.")
+
+
+def _reassociate(preloaded, workspace):
+    """Rerun association on the DIA sources of a cached run, and copy the
+    resulting catalogs to this repository.
+
+    Parameters
+    ----------
+    preloaded : `lsst.daf.butler.Butler`
+        A writeable Butler pointing to this repository.
+    workspace : `str`
+        A repository from a previous call to `_simulate`, which has passed
+        `_check_cache`.
+    """
+    import lsst.obs.base
+
+    temp_repo = Butler(workspace, writeable=True)
+    try:
+        temp_repo.collections.query(REPLAY_RUN)
+    except MissingCollectionError:
+        # First replay on this cache
+        pass
+    else:
+        temp_repo.removeRuns([REPLAY_RUN], unstore=True)
+    logging.info("Replaying association...")
+    inst_name = temp_repo.query_data_ids("instrument")[0]["instrument"]
+    instrument = lsst.obs.base.Instrument.fromName(inst_name, temp_repo.registry)
+    # DEST_RUN (or, if the cached run overlapped visits, its prep chain) has
+    # the cached DIA sources; REPLAY_RUN's outputs shadow its old catalogs.
+    try:
+        prep_chain = list(temp_repo.collections.query(DEST_RUN + PREP_SUFFIX))
+    except MissingCollectionError:
+        # Cached run was made with --lookahead 0
+        prep_chain = []
+    cached_runs = [DEST_RUN] + prep_chain
+    _build_catalogs(workspace, cached_runs + [RAW_RUN, instrument.makeUmbrellaCollectionName()], REPLAY_RUN,
+                    labels=REPLAY_LABELS, apdb_name="apdb-reassociated.db")
+    temp_repo.registry.refresh()
+    _store_profile_report(temp_repo, REPLAY_RUN)
+    logging.info("Transferring catalogs to data set...")
+    _copy_catalogs(PRELOAD_TYPES, temp_repo, REPLAY_RUN, preloaded, DEST_RUN)
+
+
+def _compare_catalogs(catalog_types, expected_repo, actual_repo, run):
+    """Compare the preloaded catalogs of two simulated runs.
+
+    Parameters
+    ----------
+    catalog_types : iterable [`str`]
+        A query expression for dataset types for preloaded catalogs.
+    expected_repo, actual_repo : `lsst.daf.butler.Butler`
+        The repositories containing the catalogs.
+    run : `str`
+        The name of the run containing the catalogs in both repositories.
+
+    Returns
+    -------
+    differences : `list` [`str`]
+        A description of each catalog that differs, or is missing from one
+        of the repositories.
+    """
+    differences = []
+    for t in expected_repo.registry.queryDatasetTypes(catalog_types):
+        expected = {ref.dataId: ref
+                    for ref in expected_repo.query_datasets(t, collections=run, explain=False)}
+        actual = {ref.dataId: ref
+                  for ref in actual_repo.query_datasets(t, collections=run, explain=False)}
+        for data_id in expected.keys() ^ actual.keys():
+            differences.append(f"{t.name} {data_id} is only in one run")
+        for data_id in expected.keys() & actual.keys():
+            expected_table = expected_repo.get(expected[data_id])
+            actual_table = actual_repo.get(actual[data_id])
+            if list(expected_table.columns) != list(actual_table.columns):
+                differences.append(f"{t.name} {data_id} has different columns")
+                continue
+            columns = [c for c in expected_table.columns if c not in VOLATILE_COLUMNS]
+            if not expected_table[columns].equals(actual_table[columns]):
+                differences.append(f"{t.name} {data_id} has different contents")
+    return differences
+
+
+def _check_overlap(lookahead):
+    """Check that overlapped processing gives the same catalogs as
+    processing one visit at a time.
+
+    Parameters
+    ----------
+    lookahead : `int`
+        The number of visits to process ahead of association.
+
+    Raises
+    ------
+    RuntimeError
+        Raised if the catalogs differ.
+    """
+    with tempfile.TemporaryDirectory() as serial_dir, tempfile.TemporaryDirectory() as overlapped_dir:
+        logging.info("Running visits one at a time...")
+        serial = _run_simulation(serial_dir, 0)
+        logging.info("Running visits overlapped, with lookahead %d...", lookahead)
+        overlapped = _run_simulation(overlapped_dir, lookahead)
+        differences = _compare_catalogs(PRELOAD_TYPES, serial, overlapped, DEST_RUN)
+    for difference in differences:
+        logging.error("%s.", difference)
+    if differences:
+        raise RuntimeError(f"Overlapped run differs from serial run in {len(differences)} catalogs.")
+    logging.info("Overlapped and serial runs give identical catalogs.")
+
+
+########################################
+# Put everything together
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    lsst.log.configure_pylog_MDC("DEBUG", MDC_class=None)
+    args = _make_parser().parse_args(argv)
+
+    preloaded = Butler(DEST_DIR, writeable=True)
+    _check_pipeline(preloaded)
+    if args.check_overlap:
+        _check_overlap(args.lookahead)
+        return
+    if args.reassociate:
+        # Before anything is removed from this repository.
+        _check_cache(CACHE_DIR)
+    logging.info("Removing old catalogs...")
+    if os.environ.get(PROFILE_ENV):
+        clear_profiles(os.environ[PROFILE_ENV])
+    _clear_preloaded(preloaded)
+    if args.reassociate:
+        _reassociate(preloaded, CACHE_DIR)
+    elif args.cache:
+        logging.info("Creating repository in %s...", CACHE_DIR)
+        shutil.rmtree(CACHE_DIR, ignore_errors=True)
+        _simulate(preloaded, CACHE_DIR, args.lookahead)
+        # Written last, so that an interrupted run is not reused.
+        with open(os.path.join(CACHE_DIR, CACHE_MARKER), "w") as f:
+            f.write(get_fingerprint() + "\n")
+    else:
+        logging.info("Creating temporary repository...")
+        with tempfile.TemporaryDirectory() as workspace:
+            _simulate(preloaded, workspace, args.lookahead)
+    preloaded.collections.register(DEST_COLLECTION, CollectionType.CHAINED)
+    preloaded.collections.prepend_chain(DEST_COLLECTION, DEST_RUN)
+
+    logging.info("Preloaded APDB catalogs copied to %s:%s", DEST_DIR, DEST_COLLECTION)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# This file is part of ap_verify_dataset_template.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Script for warping this dataset's templates onto its visits once, and
+storing the results.
+
+ApPipe warps and stitches the coadds in ``templates/goodSeeing`` onto each
+visit-detector on every run, with identical results each time, since the
+visits are fixed. This script runs the template retrieval (and the tasks it
+depends on) once, and stores the per-detector templates in the
+``templates/warped`` collection of preloaded/, where
+``pipelines/ApPipeWithWarpedTemplates.yaml`` can use them in place of
+retrieving templates.
+
+This script requires that the templates and calibs are already in preloaded/.
+It must be rerun whenever the templates, the calibs, or the configuration of
+template retrieval or of the tasks that determine the visit WCS change.
+
+Example:
+$ python generate_warped_templates.py
+"""
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+
+import lsst.log
+from lsst.daf.butler import Butler, CollectionType, MissingCollectionError
+
+from chunked_transfer import transfer_in_chunks
+from pipeline_runner import run_pipeline
+from scratch_repo import RAW_RUN, make_preloaded_copy
+
+
+# Avoid explicit references to dataset package to maximize portability.
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+PIPE_DIR = os.path.normpath(os.path.join(SCRIPT_DIR, "..", "pipelines"))
+DEST_DIR = os.path.normpath(os.path.join(SCRIPT_DIR, "..", "preloaded"))
+# Must match the label in ApPipe.yaml and the exclusion in
+# ApPipeWithWarpedTemplates.yaml.
+TEMPLATE_LABEL = "retrieveTemplate"
+DEST_COLLECTION = "templates/warped"
+DEST_RUN = DEST_COLLECTION + "/per_detector"
+
+
+########################################
+# Command-line options
+
+def _make_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-j", dest="processes", type=int, default=6,
+                        help="Number of processes for pipetask, defaults to 6.")
+    return parser
+
+
+########################################
+# Processing steps
+
+def _clear_templates(butler):
+    """Remove previous warped templates from this repository.
+
+    Parameters
+    ----------
+    butler : `lsst.daf.butler.Butler`
+        A writeable Butler pointing to this repository.
+    """
+    try:
+        runs = butler.registry.getCollectionChain(DEST_COLLECTION)
+    except MissingCollectionError:
+        # No prior templates
+        return
+    butler.registry.setCollectionChain(DEST_COLLECTION, [])
+    butler.removeRuns(runs, unstore=True)
+
+
+def _get_template_subset():
+    """Return the ApPipe tasks needed to make warped templates.
+
+    Returns
+    -------
+    labels : `list` [`str`]
+        The labels of the template retrieval task and of all tasks upstream
+        of it, in no particular order.
+    dataset_type : `str`
+        The name of the dataset type of the warped templates.
+    """
+    import lsst.pipe.base
+
+    pipeline = lsst.pipe.base.Pipeline.fromFile(os.path.join(PIPE_DIR, "ApPipe.yaml"))
+    pipeline.addConfigOverride("parameters", "apdb_config", "foo")
+    graph = pipeline.to_graph()
+
+    labels = set()
+    pending = [TEMPLATE_LABEL]
+    while pending:
+        label = pending.pop()
+        if label in labels:
+            continue
+        labels.add(label)
+        for edge in graph.tasks[label].inputs.values():
+            producer = graph.producer_of(edge.parent_dataset_type_name)
+            if producer is not None:
+                pending.append(producer.label)
+    dataset_type = graph.tasks[TEMPLATE_LABEL].outputs["template"].parent_dataset_type_name
+    return sorted(labels), dataset_type
+
+
+########################################
+# Put everything together
+
+def main(argv=None):
+    import lsst.obs.base
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    lsst.log.configure_pylog_MDC("DEBUG", MDC_class=None)
+    args = _make_parser().parse_args(argv)
+
+    preloaded = Butler(DEST_DIR, writeable=True)
+    logging.info("Removing old templates...")
+    _clear_templates(preloaded)
+    labels, template_type = _get_template_subset()
+    logging.debug("Running %s to make %s.", labels, template_type)
+
+    logging.info("Creating temporary repository...")
+    with tempfile.TemporaryDirectory() as workspace:
+        temp_repo = make_preloaded_copy(workspace, DEST_DIR)
+        inst_name = temp_repo.query_data_ids("instrument")[0]["instrument"]
+        instrument = lsst.obs.base.Instrument.fromName(inst_name, temp_repo.registry)
+        logging.info("Warping templates...")
+        run_pipeline(workspace, "ApPipe.yaml#" + ",".join(labels),
+                     [RAW_RUN, instrument.makeUmbrellaCollectionName()], DEST_RUN, "", args.processes)
+        temp_repo.registry.refresh()    # Pipeline added dataset types
+        logging.info("Transferring %s to data set...", template_type)
+        # Only the templates; the other outputs are not used by
+        # ApPipeWithWarpedTemplates.yaml.
+        templates = temp_repo.query_datasets(template_type, collections=DEST_RUN, explain=False)
+        transfer_in_chunks(preloaded, temp_repo, templates,
+                           register_dataset_types=True, transfer_dimensions=True)
+
+    preloaded.registry.registerCollection(DEST_COLLECTION, CollectionType.CHAINED)
+    preloaded.registry.setCollectionChain(DEST_COLLECTION, [DEST_RUN])
+
+    logging.info("%d warped templates stored in %s:%s", len(templates), DEST_DIR, DEST_COLLECTION)
+
+
+if __name__ == "__main__":
+    main()
@@ -30,30 +30,23 @@ This script takes no command-line arguments; it infers everything it needs from
 the `preloaded/` repository.
 """
 
-import glob
+import argparse
 import logging
 import os
 import subprocess
 import sys
 import tempfile
 
-import pandas
-
 import lsst.log
-import lsst.sphgeom
 from lsst.daf.butler import Butler, CollectionType, DatasetType
-import lsst.obs.base
-
 
-logging.basicConfig(level=logging.INFO, stream=sys.stdout)
-lsst.log.configure_pylog_MDC("DEBUG", MDC_class=None)
+from chunked_transfer import transfer_in_chunks
+from scratch_repo import RAW_RUN, make_scratch_copy
 
 
 # Avoid explicit references to dataset package to maximize portability.
 SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
 PIPE_DIR = os.path.normpath(os.path.join(SCRIPT_DIR, "..", "pipelines"))
-RAW_DIR = os.path.normpath(os.path.join(SCRIPT_DIR, "..", "raw"))
-RAW_RUN = "raw"
 VISIT_DATASET = "visit_dummy"
 EPHEM_DATASET = "preloaded_SsObjects"
 DEST_DIR = os.path.normpath(os.path.join(SCRIPT_DIR, "..", "preloaded"))
@@ -61,6 +54,13 @@ DEST_COLLECTION = "sso"
 DEST_RUN = DEST_COLLECTION + "/mpsky"
 
 
+########################################
+# Command-line options
+
+def _make_parser():
+    return argparse.ArgumentParser()
+
+
 ########################################
 # Set up temp repository
 
@@ -76,58 +76,13 @@ def _get_instruments(repo_dir):
     -------
     instruments : `list` [`lsst.obs.base.Instrument`]
     """
+    import lsst.obs.base
+
     registry = Butler(repo_dir, writeable=False).registry
     ids = registry.queryDataIds("instrument")
     return [lsst.obs.base.Instrument.fromName(id["instrument"], registry) for id in ids]
 
 
-def _make_repo_with_instruments(repo_dir, instruments):
-    """Create a repository and populate it with instrument registrations from
-    an existing repository.
-
-    Parameters
-    ----------
-    repo_dir : `str`
-        The directory in which to create the new repository.
-    instrument : iterable [`lsst.obs.base.Instrument`]
-        The instruments to register in the new repository.
-
-    Returns
-    -------
-    butler : `lsst.daf.butler.Butler`
-        A writeable Butler to the new repo.
-    """
-    config = Butler.makeRepo(repo_dir)
-    repo = Butler(config, writeable=True)
-    logging.debug("Temporary repo has universe version %d.", repo.dimensions.version)
-    for instrument in instruments:
-        instrument.register(repo.registry)
-    return repo
-
-
-########################################
-# Ingest raws (needed for visit records)
-
-def _ingest_raws(repo, raw_dir, run):
-    """Ingest this dataset's raws into a specific repo.
-
-    Parameters
-    ---------
-    repo : `lsst.daf.butler.Butler`
-        A writeable Butler for the repository to ingest into.
-    raw_dir : `str`
-        The directory containing raw files.
-    run : `str`
-        The name of the run into which to import the raws.
-    """
-    raws = glob.glob(os.path.join(raw_dir, '**', '*.fits*'), recursive=True)
-    ingester = lsst.obs.base.RawIngestTask(butler=repo, config=lsst.obs.base.RawIngestConfig())
-    ingester.run(raws, run=run)
-    exposures = set(repo.registry.queryDataIds(["exposure"]))
-    definer = lsst.obs.base.DefineVisitsTask(butler=repo, config=lsst.obs.base.DefineVisitsConfig())
-    definer.run(exposures)
-
-
 ########################################
 # Dummy pipeline inputs
 
@@ -141,6 +96,8 @@ def _make_visit_datasets(repo, run):
     run : `str`
         The name of the run into which to create datasets.
     """
+    import pandas
+
     dummy_type = DatasetType(VISIT_DATASET, {"instrument", "visit", "detector"}, "DataFrame")
     repo.registry.registerDatasetType(dummy_type)
     # Exclude unused detectors
@@ -187,7 +144,7 @@ def _get_ephem(repo_dir, raw_collection, ephem_collection):
 ########################################
 # Import/export
 
-def _transfer_ephems(ephem_type, src_repo, src_dir, run, dest_repo):
+def _transfer_ephems(ephem_type, src_repo, run, dest_repo):
     """Copy ephemerides between two repositories.
 
     Parameters
@@ -196,41 +153,45 @@ def _transfer_ephems(ephem_type, src_repo, src_dir, run, dest_repo):
         The dataset type of the ephemerides.
     src_repo : `lsst.daf.butler.Butler`
         The repository from which to copy the datasets.
-    src_dir : `str`
-        The location of ``src_repo``.
     run : `str`
         The name of the run containing the ephemerides in both ``src_repo``
         and ``dest_repo``.
     dest_repo : `lsst.daf.butler.Butler`
         The repository to which to copy the datasets.
     """
-    # Need to transfer group definitions as well; Butler.export is the easiest
-    # way to do this.
-    with tempfile.NamedTemporaryFile(suffix=".yaml") as export_file:
-        with src_repo.export(filename=export_file.name, transfer=None) as contents:
-            contents.saveDatasets(src_repo.registry.queryDatasets(ephem_type, collections=run),
-                                  elements=["group"])
-            # runs included automatically by saveDatasets
-        dest_repo.import_(directory=src_dir, filename=export_file.name, transfer="copy")
+    # Need to transfer group definitions as well, even if they're not part of
+    # the ephemerides' data IDs.
+    dest_repo.registry.insertDimensionData("group", *src_repo.registry.queryDimensionRecords("group"),
+                                           skip_existing=True)
+    transfer_in_chunks(dest_repo, src_repo, src_repo.registry.queryDatasets(ephem_type, collections=run),
+                       register_dataset_types=True, transfer_dimensions=True)
 
 
 ########################################
 # Put everything together
 
-logging.info("Creating temporary repository...")
-with tempfile.TemporaryDirectory() as workspace:
-    temp_repo = _make_repo_with_instruments(workspace, _get_instruments(DEST_DIR))
-    logging.info("Ingesting raws...")
-    _ingest_raws(temp_repo, RAW_DIR, RAW_RUN)
-    _make_visit_datasets(temp_repo, RAW_RUN)
-    logging.info("Downloading ephemerides...")
-    _get_ephem(workspace, RAW_RUN, DEST_RUN)
-    temp_repo.registry.refresh()    # Pipeline added dataset types
-    preloaded = Butler(DEST_DIR, writeable=True)
-    logging.debug("Preloaded repo has universe version %d.", preloaded.dimensions.version)
-    logging.info("Transferring ephemerides to dataset...")
-    _transfer_ephems(EPHEM_DATASET, temp_repo, workspace, DEST_RUN, preloaded)
-preloaded.registry.registerCollection(DEST_COLLECTION, CollectionType.CHAINED)
-preloaded.registry.setCollectionChain(DEST_COLLECTION, [DEST_RUN])
-
-logging.info("Solar system catalogs copied to %s:%s", DEST_DIR, DEST_COLLECTION)
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    lsst.log.configure_pylog_MDC("DEBUG", MDC_class=None)
+    _make_parser().parse_args(argv)
+
+    logging.info("Creating temporary repository...")
+    with tempfile.TemporaryDirectory() as workspace:
+        # Raws are already ingested in the scratch repository.
+        temp_repo = make_scratch_copy(workspace, _get_instruments(DEST_DIR))
+        _make_visit_datasets(temp_repo, RAW_RUN)
+        logging.info("Downloading ephemerides...")
+        _get_ephem(workspace, RAW_RUN, DEST_RUN)
+        temp_repo.registry.refresh()    # Pipeline added dataset types
+        preloaded = Butler(DEST_DIR, writeable=True)
+        logging.debug("Preloaded repo has universe version %d.", preloaded.dimensions.version)
+        logging.info("Transferring ephemerides to dataset...")
+        _transfer_ephems(EPHEM_DATASET, temp_repo, DEST_RUN, preloaded)
+    preloaded.registry.registerCollection(DEST_COLLECTION, CollectionType.CHAINED)
+    preloaded.registry.setCollectionChain(DEST_COLLECTION, [DEST_RUN])
+
+    logging.info("Solar system catalogs copied to %s:%s", DEST_DIR, DEST_COLLECTION)
+
+
+if __name__ == "__main__":
+    main()
@@ -27,7 +27,9 @@ Running this script allows for updates or replacements of the existing model.
 Example:
 $ python get_nn_models.py -m rbResnet50-DC2
 imports rbResnet50-DC2 from /repo/main to this dataset's preloaded repo. See
-get_nn_models.py -h for more options.
+get_nn_models.py -h for more options. If the model was already looked up by
+prefetch_source_refs.py, pass its manifest with --manifest to skip querying
+/repo/main.
 """
 
 import argparse
@@ -36,15 +38,12 @@ import os
 import sys
 
 import lsst.log
-import lsst.skymap
-from lsst.daf.butler import Butler, CollectionType
-from lsst.meas.transiNet.modelPackages.storageAdapterButler import StorageAdapterButler
+from lsst.daf.butler import Butler, CollectionType, MissingCollectionError
 
-logging.basicConfig(level=logging.INFO, stream=sys.stdout)
-lsst.log.configure_pylog_MDC("DEBUG", MDC_class=None)
+from chunked_transfer import transfer_in_chunks
+from source_manifest import read_section
 
 
-MODEL_PREFIX = StorageAdapterButler.packages_parent_collection
 MODEL_CHAIN = "models"  # Interface to make_all.sh
 
 # Avoid explicit references to dataset package to maximize portability.
@@ -61,12 +60,11 @@ def _make_parser():
                         help="Repo to import from, defaults to '/repo/main'.")
     parser.add_argument("-m", dest="model_name", required=True,
                         help="Model package to import.")
+    parser.add_argument("--manifest",
+                        help="Manifest from prefetch_source_refs.py to use instead of querying the repo.")
     return parser
 
 
-args = _make_parser().parse_args()
-
-
 ########################################
 # Clean up existing model
 
@@ -80,7 +78,7 @@ def _clean_dataset(butler):
     """
     try:
         model_runs = butler.registry.getCollectionChain(MODEL_CHAIN)
-    except lsst.daf.butler.registry.MissingCollectionError:
+    except MissingCollectionError:
         # No prior collections
         return
 
@@ -88,20 +86,34 @@ def _clean_dataset(butler):
     butler.removeRuns(model_runs, unstore=True)
 
 
-dest = Butler(DATASET_REPO, writeable=True)
-_clean_dataset(dest)
+########################################
+# Put everything together
 
+def main(argv=None):
+    from lsst.meas.transiNet.modelPackages.storageAdapterButler import StorageAdapterButler
 
-########################################
-# Transfer
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    lsst.log.configure_pylog_MDC("DEBUG", MDC_class=None)
+    args = _make_parser().parse_args(argv)
+
+    dest = Butler(DATASET_REPO, writeable=True)
+    _clean_dataset(dest)
+
+    model_collect = f"{StorageAdapterButler.packages_parent_collection}/{args.model_name}"
+
+    src = Butler(args.src_dir, writeable=False)
+    if args.manifest:
+        models = read_section(args.manifest, "models", args.src_dir, src.dimensions,
+                              collection=model_collect)["refs"]
+    else:
+        models = src.registry.queryDatasets(..., collections=model_collect)
+    transfer_in_chunks(dest, src, models, register_dataset_types=True)
 
-MODEL_COLLECT = f"{MODEL_PREFIX}/{args.model_name}"
+    dest.registry.registerCollection(MODEL_CHAIN, CollectionType.CHAINED)
+    dest.registry.setCollectionChain(MODEL_CHAIN, [model_collect])
 
-src = Butler(args.src_dir, writeable=False)
-dest.transfer_from(src, src.registry.queryDatasets(..., collections=MODEL_COLLECT),
-                   transfer="copy", register_dataset_types=True)
+    logging.info(f"Model {args.model_name} stored in {DATASET_REPO}:{MODEL_CHAIN}.")
 
-dest.registry.registerCollection(MODEL_CHAIN, CollectionType.CHAINED)
-dest.registry.setCollectionChain(MODEL_CHAIN, [MODEL_COLLECT])
 
-logging.info(f"Model {args.model_name} stored in {DATASET_REPO}:{MODEL_CHAIN}.")
+if __name__ == "__main__":
+    main()
@@ -30,6 +30,13 @@ Example:
 $ python import_calibs.py -c "u/me/DM-123456-calib-chain"
 imports image calibrations from (the calibration collections in)
 u/me/DM-123456-calib in /repo/main to calibs in this dataset's preloaded repo.
+If the calibs were already looked up by prefetch_source_refs.py, pass its
+manifest with --manifest to skip querying /repo/main.
+
+By default, the calibration collections are exported with all their
+validity ranges, including those of calibs that were not imported. With
+--trim-validities, only the validity ranges of the imported calibs are
+copied.
 """
 
 import argparse
@@ -39,12 +46,9 @@ import sys
 import tempfile
 
 import lsst.log
-import lsst.skymap
 from lsst.daf.butler import Butler, CollectionType
 
-
-logging.basicConfig(level=logging.INFO, stream=sys.stdout)
-lsst.log.configure_pylog_MDC("DEBUG", MDC_class=None)
+from source_manifest import find_validities, read_section
 
 
 # raw-like data IDs used to query for calibs, since we can't query them directly.
@@ -68,16 +72,18 @@ def _make_parser():
                         help="Repo to import from, defaults to '/repo/main'.")
     parser.add_argument("-c", dest="src_collection", required=True,
                         help="Calib collection to import from. Must be a chained collection before DM-37409.")
+    parser.add_argument("--manifest",
+                        help="Manifest from prefetch_source_refs.py to use instead of querying the repo.")
+    parser.add_argument("--trim-validities", action="store_true",
+                        help="Copy only the validity ranges of the imported calibs, instead of the "
+                             "entire calibration collections.")
     return parser
 
 
-args = _make_parser().parse_args()
-
-
 ########################################
 # Export/Import
 
-def _export(butler, export_file):
+def _export(butler, export_file, prefetched=None, save_validities=True):
     """Export the files to be copied.
 
     Parameters
@@ -87,22 +93,39 @@ def _export(butler, export_file):
         exported from.
     export_file : `str`
         A path pointing to a file to contain the export results.
+    prefetched : `dict`, optional
+        The ``calibs`` section of a manifest from
+        ``prefetch_source_refs.py``. If provided, ``butler`` is not queried.
+    save_validities : `bool`, optional
+        Whether to export the calibration collections. If `False`, they
+        are found but not exported.
 
     Returns
     -------
     calib_collections : iterable [`str`]
         The names of the calibration collections containing validities.
+    calibs : `set` [`lsst.daf.butler.DatasetRef`]
+        The calibs that were exported.
     """
     with butler.export(filename=export_file, transfer=None) as contents:
+        exporter = contents if save_validities else None
+        if prefetched:
+            contents.saveDatasets(prefetched["refs"])
+            if exporter:
+                for collection in prefetched["calib_collections"]:
+                    exporter.saveCollection(collection)
+            return set(prefetched["calib_collections"]), set(prefetched["refs"])
+
+        calibs = set()
         for data_id in DATA_IDS:
-            calibs = butler.registry.queryDatasets(CALIB_NAMES, dataId=data_id,
-                                                   collections=butler.collections)
-            contents.saveDatasets(calibs)
+            calibs.update(butler.registry.queryDatasets(CALIB_NAMES, dataId=data_id,
+                                                        collections=butler.collections))
+        contents.saveDatasets(calibs)
 
         calib_collections = set()
         for collection in butler.collections:
-            calib_collections.update(_save_validities(butler.registry, contents, collection))
-        return calib_collections
+            calib_collections.update(_save_validities(butler.registry, exporter, collection))
+        return calib_collections, calibs
 
 
 def _save_validities(registry, exporter, collection):
@@ -115,8 +138,9 @@ def _save_validities(registry, exporter, collection):
     ----------
     registry : `lsst.daf.butler.Registry`
         The registry managing the collections.
-    exporter : `lsst.daf.butler.transfers.RepoExportContext`
-        The export manager to which to copy validities.
+    exporter : `lsst.daf.butler.transfers.RepoExportContext` or `None`
+        The export manager to which to copy validities. If `None`, the
+        calibration collections are only found, not exported.
     collection : `str`
         The collection from which to copy validities.
 
@@ -127,7 +151,8 @@ def _save_validities(registry, exporter, collection):
     """
     match registry.getCollectionType(collection):
         case CollectionType.CALIBRATION:
-            exporter.saveCollection(collection)
+            if exporter:
+                exporter.saveCollection(collection)
             return {collection}
         case CollectionType.CHAINED:
             calib_collections = set()
@@ -138,6 +163,26 @@ def _save_validities(registry, exporter, collection):
             return []
 
 
+def _copy_validities(dest_registry, validities):
+    """Copy the validity ranges of specific calibs to a repository.
+
+    Parameters
+    ----------
+    dest_registry : `lsst.daf.butler.Registry`
+        The registry to which to copy validities. Must already contain the
+        calibs in ``validities``.
+    validities : `dict` [`str`, `dict` [`lsst.daf.butler.Timespan`, `list` [`lsst.daf.butler.DatasetRef`]]]
+        For each calibration collection, the calibs certified for each
+        validity range, as returned by
+        `source_manifest.find_validities`.
+    """
+    for collection, by_timespan in validities.items():
+        dest_registry.registerCollection(collection, CollectionType.CALIBRATION)
+        for timespan, refs in by_timespan.items():
+            dest_registry.certify(collection, refs, timespan)
+        logging.debug("%d validity ranges copied from %s", len(by_timespan), collection)
+
+
 def _import(butler, export_file, base_dir):
     """Import the exported files.
 
@@ -153,14 +198,35 @@ def _import(butler, export_file, base_dir):
     butler.import_(directory=base_dir, filename=export_file, transfer="copy")
 
 
-with tempfile.NamedTemporaryFile(suffix=".yaml") as export_file:
-    src = Butler(args.src_dir, collections=args.src_collection, writeable=False)
-    calib_collections = _export(src, export_file.name)
-    dest = Butler(DATASET_REPO, writeable=True)
-    _import(dest, export_file.name, args.src_dir)
-    dest.registry.registerCollection(DATASET_CALIB_COLLECTION, CollectionType.CHAINED)
-    chain = list(dest.registry.getCollectionChain(DATASET_CALIB_COLLECTION))
-    chain.extend(calib_collections)
-    dest.registry.setCollectionChain(DATASET_CALIB_COLLECTION, chain)
-
-logging.info(f"Calibs stored in {DATASET_REPO}:{DATASET_CALIB_COLLECTION}.")
+########################################
+# Put everything together
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    lsst.log.configure_pylog_MDC("DEBUG", MDC_class=None)
+    args = _make_parser().parse_args(argv)
+
+    with tempfile.NamedTemporaryFile(suffix=".yaml") as export_file:
+        src = Butler(args.src_dir, collections=args.src_collection, writeable=False)
+        prefetched = read_section(args.manifest, "calibs", args.src_dir, src.dimensions,
+                                  collection=args.src_collection) if args.manifest else None
+        calib_collections, calibs = _export(src, export_file.name, prefetched,
+                                            save_validities=not args.trim_validities)
+        dest = Butler(DATASET_REPO, writeable=True)
+        _import(dest, export_file.name, args.src_dir)
+        if args.trim_validities:
+            if prefetched and "validities" in prefetched:
+                validities = prefetched["validities"]
+            else:
+                validities = find_validities(src.registry, calib_collections, calibs)
+            _copy_validities(dest.registry, validities)
+        dest.registry.registerCollection(DATASET_CALIB_COLLECTION, CollectionType.CHAINED)
+        chain = list(dest.registry.getCollectionChain(DATASET_CALIB_COLLECTION))
+        chain.extend(calib_collections)
+        dest.registry.setCollectionChain(DATASET_CALIB_COLLECTION, chain)
+
+    logging.info(f"Calibs stored in {DATASET_REPO}:{DATASET_CALIB_COLLECTION}.")
+
+
+if __name__ == "__main__":
+    main()
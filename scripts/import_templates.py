@@ -24,12 +24,16 @@
 
 The datasets can be from any source, including the generate_templates.sh
 script in this directory.
+The templates may optionally be warped onto this dataset's visits ahead of
+time by running ``generate_warped_templates.py`` afterward.
 
 Example:
 $ python import_templates.py -t "u/me/DM-123456-template"
 imports goodSeeing templates from u/me/DM-123456-template in /repo/main to
 templates/goodSeeing in this dataset's preloaded repo. See
-generate_templates.sh -h for more options.
+generate_templates.sh -h for more options. If the templates were already looked
+up by prefetch_source_refs.py, pass its manifest with --manifest to skip
+querying /repo/main.
 """
 
 import argparse
@@ -39,12 +43,9 @@ import sys
 import tempfile
 
 import lsst.log
-import lsst.skymap
 from lsst.daf.butler import Butler, CollectionType
 
-
-logging.basicConfig(level=logging.INFO, stream=sys.stdout)
-lsst.log.configure_pylog_MDC("DEBUG", MDC_class=None)
+from source_manifest import read_section
 
 
 # Template type **must** match that used in the dataset's pipelines.
@@ -65,12 +66,11 @@ def _make_parser():
                         help="Template collection to import from.")
     parser.add_argument("--where",
                         help="Query string for filtering templates.")
+    parser.add_argument("--manifest",
+                        help="Manifest from prefetch_source_refs.py to use instead of querying the repo.")
     return parser
 
 
-args = _make_parser().parse_args()
-
-
 ########################################
 # Export/Import
 
@@ -78,7 +78,7 @@ TEMPLATE_NAME = TEMPLATE_TYPE + "Coadd"
 TEMPLATE_COLLECT = "templates/" + TEMPLATE_TYPE
 
 
-def _export(butler, export_file, template_query):
+def _export(butler, export_file, template_query, prefetched=None):
     """Export the files to be copied.
 
     Parameters
@@ -90,12 +90,23 @@ def _export(butler, export_file, template_query):
         A path pointing to a file to contain the export results.
     template_query : `str`
         A string expression selecting which templates to export.
+    prefetched : `dict`, optional
+        The ``templates`` section of a manifest from
+        ``prefetch_source_refs.py``. If provided, ``butler`` is not queried.
 
     Returns
     -------
     runs : iterable [`str`]
         The names of the runs containing exported templates.
     """
+    import lsst.skymap
+
+    if prefetched:
+        with butler.export(filename=export_file, transfer=None) as contents:
+            contents.saveDatasets(prefetched["skymaps"], elements=set())
+            contents.saveDatasets(prefetched["refs"])
+            return {t.run for t in prefetched["refs"]}
+
     skymaps = butler.registry.queryDataIds("skymap", datasets=TEMPLATE_NAME, collections=butler.collections)
     skymap_query = " or ".join(f"skymap = '{id['skymap']}'" for id in skymaps)
     with butler.export(filename=export_file, transfer=None) as contents:
@@ -132,12 +143,26 @@ def _import(butler, export_file, base_dir):
     butler.import_(directory=base_dir, filename=export_file, transfer="copy")
 
 
-with tempfile.NamedTemporaryFile(suffix=".yaml") as export_file:
-    src = Butler(args.src_dir, collections=args.src_collection, writeable=False)
-    runs = _export(src, export_file.name, args.where)
-    dest = Butler(DATASET_REPO, writeable=True)
-    _import(dest, export_file.name, args.src_dir)
-    dest.registry.registerCollection(TEMPLATE_COLLECT, CollectionType.CHAINED)
-    dest.registry.setCollectionChain(TEMPLATE_COLLECT, runs)
+########################################
+# Put everything together
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    lsst.log.configure_pylog_MDC("DEBUG", MDC_class=None)
+    args = _make_parser().parse_args(argv)
+
+    with tempfile.NamedTemporaryFile(suffix=".yaml") as export_file:
+        src = Butler(args.src_dir, collections=args.src_collection, writeable=False)
+        prefetched = read_section(args.manifest, "templates", args.src_dir, src.dimensions,
+                                  collection=args.src_collection, where=args.where) if args.manifest else None
+        runs = _export(src, export_file.name, args.where, prefetched)
+        dest = Butler(DATASET_REPO, writeable=True)
+        _import(dest, export_file.name, args.src_dir)
+        dest.registry.registerCollection(TEMPLATE_COLLECT, CollectionType.CHAINED)
+        dest.registry.setCollectionChain(TEMPLATE_COLLECT, runs)
+
+    logging.info(f"Templates stored in {DATASET_REPO}:{TEMPLATE_COLLECT}.")
+
 
-logging.info(f"Templates stored in {DATASET_REPO}:{TEMPLATE_COLLECT}.")
+if __name__ == "__main__":
+    main()
@@ -23,7 +23,11 @@
 """Script for copying standard refcats that cover this dataset's fields.
 
 Running this script allows for updates to the refcats to be incorporated
-into the dataset.
+into the dataset. The copied shards may optionally be reduced to the columns
+used by the pipeline by running ``compact_refcats.py`` afterward.
+
+If the refcats were already looked up by ``prefetch_source_refs.py``, pass its
+manifest with ``--manifest`` to skip querying the source repository.
 """
 
 import argparse
@@ -33,8 +37,8 @@ import sys
 
 from lsst.daf.butler import Butler, CollectionType
 
-
-logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+from chunked_transfer import transfer_in_chunks
+from source_manifest import read_section
 
 
 ########################################
@@ -47,6 +51,7 @@ REFCAT_NAMES = {"gaia_dr2_20200414", "ps1_pv3_3pi_20170110"}
 
 SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
 REPO_LOCAL = os.path.normpath(os.path.join(SCRIPT_DIR, "..", "preloaded"))
+STD_REFCAT = "refcats"
 
 
 ########################################
@@ -58,12 +63,11 @@ def _make_parser():
                         help="Refcat source Butler repo, defaults to '/repo/main'.")
     parser.add_argument("-i", dest="src_collection", default="refcats",
                         help="Refcat source collection, defaults to 'refcats'.")
+    parser.add_argument("--manifest",
+                        help="Manifest from prefetch_source_refs.py to use instead of querying the repo.")
     return parser
 
 
-args = _make_parser().parse_args()
-
-
 ########################################
 # Identify all required shards
 
@@ -90,27 +94,37 @@ def _find_refcats(butler, refcats, data_ids):
     return set(butler.registry.queryDatasets(refcats, where=where))
 
 
-src_butler = Butler(args.src_dir, collections=args.src_collection, writeable=False)
-logging.info("Searching for refcats in %s:%s...", args.src_dir, args.src_collection)
-refcats = _find_refcats(src_butler, REFCAT_NAMES, DATA_IDS)
-if not refcats:
-    raise RuntimeError("No refcats found.")
-logging.debug("%d refcat shards found", len(refcats))
+########################################
+# Put everything together
 
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    args = _make_parser().parse_args(argv)
 
-########################################
-# Transfer shards
+    src_butler = Butler(args.src_dir, collections=args.src_collection, writeable=False)
+    if args.manifest:
+        refcats = read_section(args.manifest, "refcats", args.src_dir, src_butler.dimensions,
+                               collection=args.src_collection)["refs"]
+    else:
+        logging.info("Searching for refcats in %s:%s...", args.src_dir, args.src_collection)
+        refcats = _find_refcats(src_butler, REFCAT_NAMES, DATA_IDS)
+    if not refcats:
+        raise RuntimeError("No refcats found.")
+    logging.debug("%d refcat shards found", len(refcats))
 
-STD_REFCAT = "refcats"
+    dest_butler = Butler(REPO_LOCAL, writeable=True)
+
+    logging.info("Copying refcats...")
+    # Copy to ensure that dataset is portable. Shards already copied by an
+    # interrupted run are skipped.
+    transfer_in_chunks(dest_butler, src_butler, refcats, register_dataset_types=True)
 
-dest_butler = Butler(REPO_LOCAL, writeable=True)
+    dest_butler.registry.registerCollection(STD_REFCAT, CollectionType.CHAINED)
+    # We want to use these refcats, and no other.
+    dest_butler.registry.setCollectionChain(STD_REFCAT, {ref.run for ref in refcats})
 
-logging.info("Copying refcats...")
-# Copy to ensure that dataset is portable.
-dest_butler.transfer_from(src_butler, refcats, transfer="copy", register_dataset_types=True)
+    logging.info("%d refcat shards copied to %s:%s", len(refcats), REPO_LOCAL, STD_REFCAT)
 
-dest_butler.registry.registerCollection(STD_REFCAT, CollectionType.CHAINED)
-# We want to use these refcats, and no other.
-dest_butler.registry.setCollectionChain(STD_REFCAT, {ref.run for ref in refcats})
 
-logging.info("%d refcat shards copied to %s:%s", len(refcats), REPO_LOCAL, STD_REFCAT)
+if __name__ == "__main__":
+    main()
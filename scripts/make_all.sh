@@ -53,22 +53,28 @@ print_error() {
 
 usage() {
     print_error
-    print_error "Usage: $0 [-b BUTLER_REPO] [-c CALIB_COLLECTION] -t TEMPLATE_SCRATCH_COLLECTION [-h]"
+    print_error "Usage: $0 [-b BUTLER_REPO] [-c CALIB_COLLECTION] -t TEMPLATE_SCRATCH_COLLECTION [-q] [-i] [-w] [-h]"
     print_error
     print_error "Specific options:"
     print_error "   -b          Butler repo URI, defaults to /repo/main"
     print_error "   -c          calibration collection (chain) from which to draw calibs, defaults to <instrument>/calib"
     print_error "   -t          unique collection name for template generation; will also appear in final repo"
+    print_error "   -q          also create a CPU-optimized (quantized) variant of the pretrained model"
+    print_error "   -i          also store post-ISR exposures, for use with ApPipeFromPostIsr.yaml"
+    print_error "   -w          also store pre-warped templates, for use with ApPipeWithWarpedTemplates.yaml"
     print_error "   -h          show this message"
     exit 1
 }
 
 parse_args() {
-    while getopts "b:c:t:h" option $@; do
+    while getopts "b:c:t:qiwh" option $@; do
         case "$option" in
             b)  SCRATCH_REPO="$OPTARG";;
             c)  CALIB_COLLECTION="$OPTARG";;
             t)  TEMPLATE_COLLECTION="$OPTARG";;
+            q)  QUANTIZE_MODEL=1;;
+            i)  RUN_ISR=1;;
+            w)  WARP_TEMPLATES=1;;
             h)  usage;;
             *)  usage;;
         esac
@@ -108,16 +114,23 @@ REFCAT_COLLECTION=refcats
 ########################################
 # Import calibs, templates, and refcats
 
-python "${SCRIPT_DIR}/import_calibs.py" -b ${SCRATCH_REPO} -c "${CALIB_COLLECTION}"
+# Look up everything in ${SCRATCH_REPO} at once, instead of once per script.
+SOURCE_MANIFEST="$(mktemp --suffix=.json)"
+trap 'rm -f "${SOURCE_MANIFEST}"' EXIT
 # Don't need import_templates --where, because $TEMPLATE_COLLECTION has only the templates we need.
-python "${SCRIPT_DIR}/import_templates.py" -b ${SCRATCH_REPO} -t "${TEMPLATE_COLLECTION}"
-python "${SCRIPT_DIR}/ingest_refcats.py" -b ${SCRATCH_REPO} -i "${REFCAT_COLLECTION}"
+python "${SCRIPT_DIR}/dataset.py" \
+    prefetch_source_refs -b ${SCRATCH_REPO} -o "${SOURCE_MANIFEST}" \
+        -c "${CALIB_COLLECTION}" -t "${TEMPLATE_COLLECTION}" -i "${REFCAT_COLLECTION}" \
+    + import_calibs -b ${SCRATCH_REPO} -c "${CALIB_COLLECTION}" --manifest "${SOURCE_MANIFEST}" \
+        --trim-validities \
+    + import_templates -b ${SCRATCH_REPO} -t "${TEMPLATE_COLLECTION}" --manifest "${SOURCE_MANIFEST}" \
+    + ingest_refcats -b ${SCRATCH_REPO} -i "${REFCAT_COLLECTION}" --manifest "${SOURCE_MANIFEST}"
 
 
 ########################################
 # Import pretrained NN models
 
-python "${SCRIPT_DIR}/get_nn_models.py" -m "${RB_MODEL}"
+python "${SCRIPT_DIR}/dataset.py" get_nn_models -m "${RB_MODEL}"
 
 
 ########################################
@@ -139,7 +152,23 @@ butler collection-chain "${DATASET_REPO}" "${UMBRELLA_COLLECTION}" \
     templates/goodSeeing skymaps ${INSTRUMENT}/calib refcats sso dia_catalogs models \
     ${INJECTION_CATALOG_COLLECTION}
 
-python "${SCRIPT_DIR}/make_preloaded_export.py"
+# Model quantization, ISR, and template warping need the complete umbrella
+# collection as input.
+if [[ -n "${QUANTIZE_MODEL}" ]]; then
+    python "${SCRIPT_DIR}/optimize_nn_model.py"
+fi
+if [[ -n "${RUN_ISR}" ]]; then
+    python "${SCRIPT_DIR}/generate_isr_exposures.py"
+    butler collection-chain --mode extend "${DATASET_REPO}" "${UMBRELLA_COLLECTION}" isr
+fi
+if [[ -n "${WARP_TEMPLATES}" ]]; then
+    python "${SCRIPT_DIR}/generate_warped_templates.py"
+    butler collection-chain --mode extend "${DATASET_REPO}" "${UMBRELLA_COLLECTION}" templates/warped
+fi
+
+# Registry has been through many insertions and removals by now.
+python "${SCRIPT_DIR}/dataset.py" compact_registry + make_preloaded_export \
+    + make_region_cache + make_raw_manifest + checksum_manifest write
 
 echo "Preloaded repository complete."
 echo "All preloaded data products are accessible through the ${UMBRELLA_COLLECTION} collection."
@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+# This file is part of ap_verify_dataset_template.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Script for creating a reduced copy of this dataset for fast smoke tests.
+
+The reduced dataset is a complete dataset package containing only the raws
+matching a data query, and only the preloaded datasets those raws need:
+calibs for the selected detectors, templates and refcat shards that overlap
+the selected visits, and ephemerides and preloaded DIA catalogs for the
+selected groups. Datasets with no
+relationship to visits or detectors, such as skymaps and models, are kept in
+full. The export file, region cache, raw manifest, and checksum manifest of
+the reduced dataset are regenerated with its own copies of
+``make_preloaded_export.py``, ``make_region_cache.py``,
+``make_raw_manifest.py``, and ``checksum_manifest.py``.
+
+This script requires that preloaded/ be complete. It finds the sky pixels
+overlapping the selected visits in ``config/region_cache/``, if
+``make_region_cache.py`` has been run, and in the registry otherwise.
+
+Example:
+$ python make_mini_dataset.py -o ../ap_verify_mini \
+      -d "instrument='LSSTCam' and visit=982985 and detector=164"
+creates a single-detector dataset in ../ap_verify_mini. See
+make_mini_dataset.py -h for more options.
+"""
+
+import argparse
+import collections
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import lsst.log
+from lsst.daf.butler import Butler, CollectionType
+
+from chunked_transfer import transfer_in_chunks
+from region_cache import PIXELIZATIONS, REGION_CACHE_DIR, RegionCache
+from scratch_repo import RAW_DIR, RAW_RUN, make_preloaded_copy
+
+
+# Avoid explicit references to dataset package to maximize portability.
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+PACKAGE_DIR = os.path.normpath(os.path.join(SCRIPT_DIR, ".."))
+PRELOADED_DIR = os.path.join(PACKAGE_DIR, "preloaded")
+# Paths, relative to the package, that are regenerated rather than copied.
+# The files must match checksum_manifest.py, make_raw_manifest.py, and
+# region_cache.py.
+GENERATED_PATHS = {"preloaded", "raw", "scratch", ".git", "checksums.json",
+                   os.path.join("config", "raw_manifest.json"), os.path.join("config", "region_cache")}
+# Observation records needed for visit definition, in dependency order.
+OBSERVATION_ELEMENTS = ["day_obs", "group", "exposure", "visit", "visit_definition",
+                        "visit_detector_region", "visit_system_membership"]
+
+
+########################################
+# Command-line options
+
+def _make_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", dest="output_dir", required=True,
+                        help="Directory in which to create the reduced dataset. Must not exist.")
+    parser.add_argument("-d", dest="data_query", required=True,
+                        help="Query string selecting the visits and detectors to keep.")
+    return parser
+
+
+########################################
+# Selection
+
+def _copy_raws(butler, data_query, raw_dir):
+    """Copy the raws matching a query.
+
+    Parameters
+    ----------
+    butler : `lsst.daf.butler.Butler`
+        A Butler containing this dataset's raws, ingested in place.
+    data_query : `str`
+        The query selecting the raws to copy.
+    raw_dir : `str`
+        The directory into which to copy the raws.
+
+    Returns
+    -------
+    n_raws : `int`
+        The number of raws copied.
+    """
+    raws = butler.query_datasets("raw", collections=RAW_RUN, where=data_query, explain=False)
+    for ref in raws:
+        path = butler.getURI(ref).ospath
+        dest = os.path.join(raw_dir, os.path.relpath(path, RAW_DIR))
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.copy2(path, dest)
+    return len(raws)
+
+
+def _get_selection(butler, data_query):
+    """Summarize the observations selected by a query.
+
+    Parameters
+    ----------
+    butler : `lsst.daf.butler.Butler`
+        A Butler containing this dataset's raws.
+    data_query : `str`
+        The query selecting the raws to process.
+
+    Returns
+    -------
+    groups : `list` [`str`]
+        The groups containing the selected exposures.
+    detectors : `list` [`int`]
+        The selected detectors.
+    visit_detectors : `list` [`tuple` [`str`, `int`, `int`]]
+        The instrument, visit, and detector of each selected visit-detector
+        combination.
+    """
+    exposures = butler.query_dimension_records("exposure", where=data_query, explain=False)
+    data_ids = butler.query_data_ids(["visit", "detector"], where=data_query, explain=False)
+    return (sorted({record.group for record in exposures}),
+            sorted({id["detector"] for id in data_ids}),
+            sorted({(id["instrument"], id["visit"], id["detector"]) for id in data_ids}))
+
+
+def _get_pixels(butler, skypix, data_query, visit_detectors, cache):
+    """Find the sky pixels overlapping the selected visits and detectors.
+
+    Parameters
+    ----------
+    butler : `lsst.daf.butler.Butler`
+        The repository defining ``skypix``.
+    skypix : `str`
+        The name of a skypix dimension.
+    data_query : `str`
+        The query selecting the raws to process.
+    visit_detectors : iterable [`tuple` [`str`, `int`, `int`]]
+        The visit-detector combinations selected by ``data_query``, as
+        returned by `_get_selection`.
+    cache : `region_cache.RegionCache` or `None`
+        The region cache of this dataset, if any. Used only if it covers
+        ``skypix`` and all of ``visit_detectors``; otherwise, the regions are
+        read from the registry.
+
+    Returns
+    -------
+    pixels : `list` [`int`]
+        The indices of all ``skypix`` pixels overlapping the selected regions.
+    """
+    import lsst.sphgeom
+
+    if cache is not None and skypix in PIXELIZATIONS and all(id in cache for id in visit_detectors):
+        ranges = cache.pixels(skypix, visit_detectors)
+    else:
+        pixelization = butler.dimensions[skypix].pixelization
+        ranges = lsst.sphgeom.RangeSet()
+        for record in butler.query_dimension_records("visit_detector_region", where=data_query,
+                                                     explain=False):
+            ranges |= pixelization.envelope(record.region)
+    return [pixel for begin, end in ranges for pixel in range(begin, end)]
+
+
+def _load_region_cache():
+    """Read this dataset's region cache, if it has one.
+
+    Returns
+    -------
+    cache : `region_cache.RegionCache` or `None`
+        The cache written by ``make_region_cache.py``, or `None` if there is
+        none.
+    """
+    try:
+        return RegionCache(REGION_CACHE_DIR)
+    except FileNotFoundError:
+        logging.info("No region cache in %s; reading regions from the registry.", REGION_CACHE_DIR)
+        return None
+
+
+def _find_datasets(butler, data_query):
+    """Find the preloaded datasets needed by a subset of the raws.
+
+    Parameters
+    ----------
+    butler : `lsst.daf.butler.Butler`
+        A Butler containing this dataset's raws and preloaded datasets.
+    data_query : `str`
+        The query selecting the raws to process.
+
+    Returns
+    -------
+    refs : `set` [`lsst.daf.butler.DatasetRef`]
+        The datasets that are related to the selected visits and detectors,
+        or to no visits or detectors at all.
+    """
+    groups, detectors, visit_detectors = _get_selection(butler, data_query)
+    cache = _load_region_cache()
+    refs = set()
+    for dataset_type in butler.registry.queryDatasetTypes():
+        if dataset_type.name == "raw":
+            continue
+        dimensions = dataset_type.dimensions
+        # Only datasets keyed by visit or exposure can be constrained by
+        # data_query directly; for anything else, the visit and detector
+        # constraints would not be joined to the dataset's own dimensions.
+        if "visit" in dimensions.names or "exposure" in dimensions.names:
+            where, bind = data_query, {}
+        elif "group" in dimensions.names:
+            where, bind = "group IN (groups)", {"groups": groups}
+            if "detector" in dimensions.names:
+                where += " AND detector IN (detectors)"
+                bind["detectors"] = detectors
+        elif dimensions.skypix:
+            (skypix, ) = dimensions.skypix
+            pixels = _get_pixels(butler, skypix, data_query, visit_detectors, cache)
+            where, bind = f"{skypix} IN (pixels)", {"pixels": pixels}
+        elif "tract" in dimensions.names:
+            # The registry joins tracts and patches to the selected visits
+            # and detectors through their regions.
+            where, bind = data_query, {}
+        elif "detector" in dimensions.names:
+            where, bind = "detector IN (detectors)", {"detectors": detectors}
+        else:
+            where, bind = "", {}
+        if any(not value for value in bind.values()):
+            continue
+        refs.update(butler.registry.queryDatasets(dataset_type, collections=..., where=where, bind=bind,
+                                                  findFirst=False))
+    return {ref for ref in refs if ref.run != RAW_RUN}
+
+
+########################################
+# Reduced repository
+
+def _make_reduced_repo(src, refs, data_query, repo_dir):
+    """Create a preloaded repository containing only selected datasets.
+
+    Parameters
+    ----------
+    src : `lsst.daf.butler.Butler`
+        A Butler containing this dataset's raws and preloaded datasets.
+    refs : iterable [`lsst.daf.butler.DatasetRef`]
+        The preloaded datasets to keep.
+    data_query : `str`
+        The query selecting the raws to process.
+    repo_dir : `str`
+        The directory in which to create the new repository.
+    """
+    import lsst.obs.base
+
+    dest = Butler(Butler.makeRepo(repo_dir), writeable=True)
+    for id in src.registry.queryDataIds("instrument"):
+        lsst.obs.base.Instrument.fromName(id["instrument"], src.registry).register(dest.registry)
+    transfer_in_chunks(dest, src, refs, register_dataset_types=True, transfer_dimensions=True)
+    for element in OBSERVATION_ELEMENTS:
+        if element in src.dimensions.elements:
+            dest.registry.insertDimensionData(
+                element, *src.registry.queryDimensionRecords(element, where=data_query),
+                skip_existing=True)
+    _copy_collections(src, dest, refs)
+
+
+def _copy_collections(src, dest, refs):
+    """Recreate calibration and chained collections for a subset of datasets.
+
+    Parameters
+    ----------
+    src : `lsst.daf.butler.Butler`
+        The repository containing the original collections.
+    dest : `lsst.daf.butler.Butler`
+        The repository containing ``refs``.
+    refs : iterable [`lsst.daf.butler.DatasetRef`]
+        The datasets present in ``dest``.
+    """
+    kept = {ref.id for ref in refs}
+    dataset_types = {ref.datasetType for ref in refs}
+    calibs = src.registry.queryCollections(..., collectionTypes={CollectionType.CALIBRATION})
+    for collection in calibs:
+        dest.registry.registerCollection(collection, CollectionType.CALIBRATION)
+        by_timespan = collections.defaultdict(list)
+        for dataset_type in dataset_types:
+            for assoc in src.registry.queryDatasetAssociations(dataset_type, collections=[collection]):
+                if assoc.ref.id in kept:
+                    by_timespan[assoc.timespan].append(assoc.ref)
+        for timespan, calib_refs in by_timespan.items():
+            dest.registry.certify(collection, calib_refs, timespan)
+
+    chains = list(src.registry.queryCollections(..., collectionTypes={CollectionType.CHAINED}))
+    for chain in chains:
+        dest.registry.registerCollection(chain, CollectionType.CHAINED)
+    existing = set(dest.registry.queryCollections(...))
+    for chain in chains:
+        children = [c for c in src.registry.getCollectionChain(chain) if c in existing and c != RAW_RUN]
+        dest.registry.setCollectionChain(chain, children)
+
+
+########################################
+# Package files
+
+def _ignore_generated(directory, names):
+    """Select the files in a package directory that are regenerated rather
+    than copied.
+
+    Parameters
+    ----------
+    directory : `str`
+        A directory in this dataset package.
+    names : iterable [`str`]
+        The files in ``directory``.
+
+    Returns
+    -------
+    ignored : `set` [`str`]
+        The names of the files in ``directory`` not to copy, for use with
+        `shutil.copytree`.
+    """
+    return {name for name in names
+            if os.path.relpath(os.path.join(directory, name), PACKAGE_DIR) in GENERATED_PATHS}
+
+
+def _run_copied_script(output_dir, script, action, args=(), env=None):
+    """Run the copy of one of these scripts in the reduced dataset.
+
+    Parameters
+    ----------
+    output_dir : `str`
+        The directory containing the reduced dataset.
+    script : `str`
+        The file name of the script to run.
+    action : `str`
+        A description of what the script does, for error messages.
+    args : sequence [`str`], optional
+        The command-line arguments of the script.
+    env : mapping [`str`, `str`], optional
+        The environment of the script, if not the current one.
+
+    Raises
+    ------
+    RuntimeError
+        Raised if the script fails.
+    """
+    results = subprocess.run([sys.executable, os.path.join(output_dir, "scripts", script), *args],
+                             env=env, capture_output=False, shell=False, check=False)
+    if results.returncode:
+        raise RuntimeError(f"Could not {action}; see log for details.")
+
+
+########################################
+# Put everything together
+
+def main(argv=None):
+    # Ensure logs from tasks are visible
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    lsst.log.configure_pylog_MDC("DEBUG", MDC_class=None)
+
+    args = _make_parser().parse_args(argv)
+
+    logging.info("Copying package files to %s...", args.output_dir)
+    shutil.copytree(PACKAGE_DIR, args.output_dir, ignore=_ignore_generated)
+    # Keep the data directories' documentation
+    for data_dir in ("preloaded", "raw"):
+        os.makedirs(os.path.join(args.output_dir, data_dir))
+        shutil.copy2(os.path.join(PACKAGE_DIR, data_dir, "README.md"),
+                     os.path.join(args.output_dir, data_dir))
+
+    logging.info("Creating temporary repository...")
+    with tempfile.TemporaryDirectory() as workspace:
+        temp_repo = make_preloaded_copy(workspace, PRELOADED_DIR)
+        n_raws = _copy_raws(temp_repo, args.data_query, os.path.join(args.output_dir, "raw"))
+        if not n_raws:
+            raise RuntimeError(f"No raws match '{args.data_query}'.")
+        logging.info("%d raws copied.", n_raws)
+
+        refs = _find_datasets(temp_repo, args.data_query)
+        logging.info("Copying %d preloaded datasets...", len(refs))
+        output_repo = os.path.join(args.output_dir, "preloaded")
+        _make_reduced_repo(temp_repo, refs, args.data_query, output_repo)
+
+        logging.info("Exporting reduced repository...")
+        _run_copied_script(args.output_dir, "make_preloaded_export.py", "export reduced repository")
+        logging.info("Caching regions of reduced repository...")
+        _run_copied_script(args.output_dir, "make_region_cache.py", "cache regions of reduced repository")
+        logging.info("Recording raws of reduced dataset...")
+        # Keep the reduced dataset's scratch repository out of the dataset.
+        _run_copied_script(args.output_dir, "make_raw_manifest.py", "record raws of reduced dataset",
+                           env=dict(os.environ, AP_VERIFY_DATASET_SCRATCH=os.path.join(workspace, "scratch")))
+        logging.info("Checksumming reduced dataset...")
+        _run_copied_script(args.output_dir, "checksum_manifest.py", "checksum reduced dataset", ["write"])
+
+    logging.info("Reduced dataset created in %s.", args.output_dir)
+
+
+if __name__ == "__main__":
+    main()
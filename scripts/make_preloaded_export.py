@@ -26,12 +26,12 @@ This script must be run after **any** change to the preloaded repository;
 otherwise, ingestion may fail or the changes may not be visible.
 """
 
+import argparse
 import logging
 import os
 import sys
 
 import lsst.log
-import lsst.skymap
 import lsst.daf.butler as daf_butler
 
 
@@ -41,10 +41,15 @@ REPO_DIR = os.path.normpath(os.path.join(SCRIPT_DIR, "..", "preloaded"))
 CONFIG_DIR = os.path.normpath(os.path.join(SCRIPT_DIR, "..", "config"))
 
 
-def main():
+def _make_parser():
+    return argparse.ArgumentParser()
+
+
+def main(argv=None):
     # Ensure logs from tasks are visible
     logging.basicConfig(level=logging.INFO, stream=sys.stdout)
     lsst.log.configure_pylog_MDC("DEBUG", MDC_class=None)
+    _make_parser().parse_args(argv)
 
     logging.info("Exporting registry to configure new repos...")
     _export_for_copy(REPO_DIR, CONFIG_DIR)
@@ -60,6 +65,8 @@ def _export_for_copy(repo, export_dir):
     export_dir : `str`
         The location at which to create the export file.
     """
+    import lsst.skymap
+
     butler = daf_butler.Butler(repo)
     with butler.export(directory=export_dir, format="yaml") as contents:
         # Need all detectors, even those without data, for visit definition
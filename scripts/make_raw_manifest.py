@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# This file is part of ap_verify_dataset_template.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Script for recording which exposures and detectors each raw file contains.
+
+The manifest, ``config/raw_manifest.json``, maps each file in raw/ to its
+Git LFS object ID (SHA-256), size, and the data IDs of the raws it contains.
+``fetch_raws.py`` uses it to materialize only the raws a run needs, without
+the Science Pipelines.
+
+This script requires that all files in raw/ have been fetched. It must be
+rerun whenever raw/ changes.
+
+Example:
+$ python make_raw_manifest.py
+"""
+
+import argparse
+import collections
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+
+import lsst.log
+from lsst.daf.butler import Butler
+
+from scratch_repo import PRELOADED_DIR, RAW_DIR, RAW_RUN, make_scratch_copy
+
+
+# Avoid explicit references to dataset package to maximize portability.
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+# Must match fetch_raws.py
+MANIFEST_FILE = os.path.normpath(os.path.join(SCRIPT_DIR, "..", "config", "raw_manifest.json"))
+
+
+########################################
+# Command-line options
+
+def _make_parser():
+    return argparse.ArgumentParser()
+
+
+########################################
+# Manifest
+
+def _hash_file(path):
+    """Return the Git LFS object ID and size of a file.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+            size += len(block)
+    return digest.hexdigest(), size
+
+
+def _make_manifest(butler, raw_dir, run):
+    """Map each raw file to its contents.
+
+    Parameters
+    ----------
+    butler : `lsst.daf.butler.Butler`
+        A Butler to a repository in which the raws have been ingested in
+        place.
+    raw_dir : `str`
+        The directory containing the raw files.
+    run : `str`
+        The run containing the raws.
+
+    Returns
+    -------
+    manifest : `dict` [`str`, `dict`]
+        A mapping from file path, relative to ``raw_dir``, to the file's
+        ``oid``, ``size``, and ``data_ids``.
+    """
+    data_ids = collections.defaultdict(list)
+    for ref in butler.query_datasets("raw", collections=run, explain=False):
+        path = butler.getURI(ref).ospath
+        data_ids[os.path.relpath(path, raw_dir)].append(dict(ref.dataId.required))
+
+    manifest = {}
+    for path, ids in sorted(data_ids.items()):
+        oid, size = _hash_file(os.path.join(raw_dir, path))
+        manifest[path] = dict(oid=oid, size=size,
+                              data_ids=sorted(ids, key=lambda id: sorted(id.items())))
+    return manifest
+
+
+########################################
+# Put everything together
+
+def main(argv=None):
+    import lsst.obs.base
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    lsst.log.configure_pylog_MDC("DEBUG", MDC_class=None)
+    _make_parser().parse_args(argv)
+
+    preloaded = Butler(PRELOADED_DIR)
+    instruments = [lsst.obs.base.Instrument.fromName(id["instrument"], preloaded.registry)
+                   for id in preloaded.registry.queryDataIds("instrument")]
+    with tempfile.TemporaryDirectory() as workspace:
+        butler = make_scratch_copy(workspace, instruments)
+        manifest = _make_manifest(butler, RAW_DIR, RAW_RUN)
+
+    with open(MANIFEST_FILE, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+        f.write("\n")
+    logging.info("%d raw files recorded in %s.", len(manifest), MANIFEST_FILE)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# This file is part of ap_verify_dataset_template.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Script for caching the visit-detector regions of preloaded/.
+
+The cache, ``config/region_cache/``, holds each visit-detector region and the
+HTM and HEALPix pixels covering it, in Parquet files. ``make_mini_dataset.py``
+uses it to find the refcat shards and other sky-pixel datasets overlapping the
+selected visits. The cache is not part of the export file; readers fall back
+to the registry for any region it does not contain.
+
+If preloaded/ has no visit_detector_region records, any existing cache is
+removed and no new one is written. This script must be rerun whenever the
+visits in preloaded/ change.
+
+Example:
+$ python make_region_cache.py
+"""
+
+import argparse
+import logging
+import sys
+
+import lsst.log
+from lsst.daf.butler import Butler
+
+from region_cache import REGION_CACHE_DIR, write_region_cache
+from scratch_repo import PRELOADED_DIR
+
+
+########################################
+# Command-line options
+
+def _make_parser():
+    return argparse.ArgumentParser()
+
+
+########################################
+# Put everything together
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    lsst.log.configure_pylog_MDC("DEBUG", MDC_class=None)
+    _make_parser().parse_args(argv)
+
+    n_regions = write_region_cache(Butler(PRELOADED_DIR), REGION_CACHE_DIR)
+    if n_regions:
+        logging.info("%d visit-detector regions cached in %s.", n_regions, REGION_CACHE_DIR)
+    else:
+        logging.info("No visit-detector regions in %s; not writing a region cache.", PRELOADED_DIR)
+
+
+if __name__ == "__main__":
+    main()
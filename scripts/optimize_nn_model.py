@@ -0,0 +1,431 @@
+#!/usr/bin/env python
+# This file is part of ap_verify_dataset_template.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Script for creating a CPU-optimized variant of this dataset's
+pretrained model.
+
+The variant is an int8 copy of the model package in the ``models``
+collection, made by post-training static quantization in PyTorch's FX graph
+mode, which covers the convolutions as well as the fully connected layers.
+The quantization is calibrated, and the variant compared to the original,
+on real cutouts: the script runs ApPipe up to real/bogus classification in a
+scratch copy of preloaded/ (see ``scratch_repo.py``), and cuts out the
+detected DIA sources the same way ``RBTransiNetTask`` does.
+
+The variant is a normal model package, but is stored under a separate
+dataset type so that ``config/rbClassifyCpu.py`` can select it without
+changing the collections searched by ``RBTransiNetTask``. Its architecture
+file is generated: it holds the original architecture source verbatim, and
+quantizes the model on construction so that the package loader can load the
+int8 checkpoint.
+
+This script must be run after all other inputs are in preloaded/, and after
+``get_nn_models.py``; rerunning the latter removes the variant.
+
+Example:
+$ python optimize_nn_model.py
+quantizes the model in this dataset's preloaded repo. See
+optimize_nn_model.py -h for more options.
+"""
+
+import argparse
+import io
+import logging
+import os
+import sys
+import tempfile
+import time
+import zipfile
+
+import lsst.log
+from lsst.daf.butler import Butler, DatasetType
+
+from pipeline_runner import run_pipeline
+from scratch_repo import RAW_RUN, make_preloaded_copy
+
+
+MODEL_CHAIN = "models"  # Interface to make_all.sh
+# Must match config/rbClassifyCpu.py
+CPU_MODEL_TYPE = "pretrainedModelPackageCpu"
+CPU_SUFFIX = "int8"
+# Must match the label in ApPipe.yaml
+CLASSIFY_LABEL = "rbClassify"
+CUTOUT_RUN = "optimize_nn_model/cutouts"
+
+# Avoid explicit references to dataset package to maximize portability.
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+DATASET_REPO = os.path.normpath(os.path.join(SCRIPT_DIR, "..", "preloaded"))
+PIPE_DIR = os.path.normpath(os.path.join(SCRIPT_DIR, "..", "pipelines"))
+
+# Architecture file of the quantized package. Rebuilding the model with the
+# same (uncalibrated) FX passes gives a module whose state dict matches the
+# calibrated one stored in the checkpoint.
+_QUANTIZED_ARCHITECTURE = '''"""Int8 variant of {model_class}, created by optimize_nn_model.py.
+
+The original architecture source is in _FLOAT_SOURCE, unchanged.
+"""
+
+import types
+
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+_FLOAT_SOURCE = {source!r}
+_float = types.ModuleType("_float")
+exec(compile(_FLOAT_SOURCE, "<float architecture>", "exec"), _float.__dict__)
+
+
+def {model_class}(*args, **kwargs):
+    model = _float.{model_class}(*args, **kwargs).eval()
+    example = (torch.zeros((1, *{input_shape!r})), )
+    return convert_fx(prepare_fx(model, get_default_qconfig_mapping(), example))
+'''
+
+
+########################################
+# Command-line options
+
+def _make_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", dest="n_cutouts", type=int, default=2048,
+                        help="Maximum number of real cutouts to use, half for calibration and half for the "
+                             "comparison; defaults to 2048.")
+    parser.add_argument("--batch-size", type=int, default=64,
+                        help="Batch size for the comparison, defaults to 64.")
+    parser.add_argument("-j", dest="processes", type=int, default=6,
+                        help="Number of processes for pipetask, defaults to 6.")
+    return parser
+
+
+########################################
+# Real cutouts
+
+def _get_classify_task():
+    """Return the real/bogus task of ApPipe and the tasks it depends on.
+
+    Returns
+    -------
+    task : `lsst.pipe.base.pipeline_graph.TaskNode`
+        The real/bogus classification task.
+    upstream : `list` [`str`]
+        The labels of all tasks upstream of ``task``, in no particular order.
+    """
+    import lsst.pipe.base
+
+    pipeline = lsst.pipe.base.Pipeline.fromFile(os.path.join(PIPE_DIR, "ApPipe.yaml"))
+    pipeline.addConfigOverride("parameters", "apdb_config", "foo")
+    graph = pipeline.to_graph()
+
+    upstream = set()
+    pending = [CLASSIFY_LABEL]
+    while pending:
+        for edge in graph.tasks[pending.pop()].inputs.values():
+            producer = graph.producer_of(edge.parent_dataset_type_name)
+            if producer is not None and producer.label not in upstream:
+                upstream.add(producer.label)
+                pending.append(producer.label)
+    return graph.tasks[CLASSIFY_LABEL], sorted(upstream)
+
+
+def _make_cutouts(payload, n_cutouts, processes):
+    """Create model inputs from this dataset's DIA sources.
+
+    Parameters
+    ----------
+    payload : `lsst.meas.transiNet.modelPackages.formatters.NNModelPackagePayload`
+        The model package whose inputs to create.
+    n_cutouts : `int`
+        The maximum number of cutouts to create.
+    processes : `int`
+        The number of processes for pipetask.
+
+    Returns
+    -------
+    cutouts : `torch.Tensor`
+        The model inputs, with the first axis indexing cutouts, in a
+        reproducible random order.
+    """
+    import torch
+    import lsst.obs.base
+    from lsst.meas.transiNet import RBTransiNetTask, TransiNetInterface
+
+    task_node, upstream = _get_classify_task()
+    inputs = {name: edge.parent_dataset_type_name for name, edge in task_node.inputs.items()}
+    task = RBTransiNetTask(config=task_node.config)
+    interface = TransiNetInterface(None, "butler", device="cpu", butler_loaded_package=payload)
+
+    cutouts = []
+    with tempfile.TemporaryDirectory() as workspace:
+        temp_repo = make_preloaded_copy(workspace, DATASET_REPO)
+        inst_name = temp_repo.query_data_ids("instrument")[0]["instrument"]
+        instrument = lsst.obs.base.Instrument.fromName(inst_name, temp_repo.registry)
+        logging.info("Running ApPipe up to %s...", CLASSIFY_LABEL)
+        run_pipeline(workspace, "ApPipe.yaml#" + ",".join(upstream),
+                     [RAW_RUN, instrument.makeUmbrellaCollectionName()], CUTOUT_RUN, "", processes)
+        temp_repo.registry.refresh()    # Pipeline added dataset types
+
+        for ref in temp_repo.query_datasets(inputs["diaSources"], collections=CUTOUT_RUN, explain=False):
+            images = {name: temp_repo.get(inputs[name], ref.dataId, collections=CUTOUT_RUN)
+                      for name in ("template", "science", "difference")}
+            # Same cutouts as RBTransiNetTask.run
+            cutouts.extend(task._make_cutouts(images["template"], images["science"], images["difference"],
+                                              source)
+                           for source in temp_repo.get(ref))
+            if len(cutouts) >= n_cutouts:
+                break
+    if not cutouts:
+        raise RuntimeError("No DIA sources detected; cannot calibrate the quantized model.")
+
+    blob, _ = interface.prepare_input(cutouts[:n_cutouts])
+    generator = torch.Generator().manual_seed(42)
+    return blob[torch.randperm(len(blob), generator=generator)]
+
+
+########################################
+# Model conversion
+
+def load_model(payload):
+    """Load a model from a Butler model package.
+
+    Parameters
+    ----------
+    payload : `lsst.meas.transiNet.modelPackages.formatters.NNModelPackagePayload`
+        The model package, as read from the Butler.
+
+    Returns
+    -------
+    model : `torch.nn.Module`
+        The model, in evaluation mode on the CPU.
+    input_shape : `tuple` [`int`]
+        The shape of a single model input.
+    """
+    from lsst.meas.transiNet.modelPackages.nnModelPackage import NNModelPackage
+
+    package = NNModelPackage(model_package_name=None, package_storage_mode="butler",
+                             butler_loaded_package=payload)
+    model = package.load("cpu")
+    model.eval()
+    return model, tuple(package.get_model_input_shape())
+
+
+def _quantize(model, calibration, batch_size):
+    """Quantize a model to int8, calibrating it on real inputs.
+
+    Parameters
+    ----------
+    model : `torch.nn.Module`
+        The model to quantize, in evaluation mode.
+    calibration : `torch.Tensor`
+        The calibration inputs, with the first axis indexing cutouts.
+    batch_size : `int`
+        The number of cutouts per model call.
+
+    Returns
+    -------
+    quantized : `torch.fx.GraphModule`
+        The quantized model.
+    """
+    import torch
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    prepared = prepare_fx(model, get_default_qconfig_mapping(), (calibration[:1], ))
+    with torch.inference_mode():
+        for batch in torch.split(calibration, batch_size):
+            prepared(batch)
+    return convert_fx(prepared)
+
+
+def _quantize_package(payload, model, quantized, input_shape):
+    """Create a model package for a quantized model.
+
+    Parameters
+    ----------
+    payload : `lsst.meas.transiNet.modelPackages.formatters.NNModelPackagePayload`
+        The original model package.
+    model : `torch.nn.Module`
+        The model loaded from ``payload``.
+    quantized : `torch.fx.GraphModule`
+        The quantized version of ``model``.
+    input_shape : `tuple` [`int`]
+        The shape of a single model input.
+
+    Returns
+    -------
+    quantized_payload : `lsst.meas.transiNet.modelPackages.formatters.NNModelPackagePayload`
+        A model package with a generated architecture that builds the
+        quantized model, and a checkpoint that holds the quantized weights.
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(io.BytesIO(payload.bytes)) as original, \
+            zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as copy:
+        for item in original.infolist():
+            content = original.read(item)
+            if item.filename.startswith("architecture/") and item.filename.endswith(".py"):
+                content = _QUANTIZED_ARCHITECTURE.format(model_class=type(model).__name__,
+                                                         source=content.decode(),
+                                                         input_shape=input_shape).encode()
+            elif item.filename.startswith("checkpoint/"):
+                content = _quantize_checkpoint(content, quantized)
+            copy.writestr(item, content)
+
+    quantized_payload = type(payload)()
+    quantized_payload.bytes = buffer.getvalue()
+    return quantized_payload
+
+
+def _quantize_checkpoint(content, quantized):
+    """Replace the weights in a serialized checkpoint.
+
+    Parameters
+    ----------
+    content : `bytes`
+        The original checkpoint file.
+    quantized : `torch.nn.Module`
+        The quantized model whose weights to store.
+
+    Returns
+    -------
+    content : `bytes`
+        A checkpoint file in the same format as the original.
+    """
+    import torch
+
+    checkpoint = torch.load(io.BytesIO(content), map_location="cpu", weights_only=False)
+    if isinstance(checkpoint, dict) and "state_dict" in checkpoint:
+        checkpoint["state_dict"] = quantized.state_dict()
+    else:
+        checkpoint = quantized.state_dict()
+    buffer = io.BytesIO()
+    torch.save(checkpoint, buffer)
+    return buffer.getvalue()
+
+
+########################################
+# Comparison
+
+def _time_model(model, cutouts, batch_size):
+    """Run a model over a set of cutouts.
+
+    Parameters
+    ----------
+    model : `torch.nn.Module`
+        The model to run.
+    cutouts : `torch.Tensor`
+        The model inputs, with the first axis indexing cutouts.
+    batch_size : `int`
+        The number of cutouts per model call.
+
+    Returns
+    -------
+    outputs : `torch.Tensor`
+        The model outputs for all cutouts.
+    rate : `float`
+        The throughput, in cutouts per second.
+    """
+    import torch
+
+    outputs = []
+    with torch.inference_mode():
+        model(cutouts[:batch_size])  # warm-up
+        start = time.perf_counter()
+        for batch in torch.split(cutouts, batch_size):
+            outputs.append(model(batch))
+        elapsed = time.perf_counter() - start
+    return torch.cat(outputs), len(cutouts) / elapsed
+
+
+def _compare(original, optimized, cutouts, batch_size):
+    """Log how closely and quickly an optimized model reproduces the original.
+
+    Parameters
+    ----------
+    original, optimized : `torch.nn.Module`
+        The models to compare.
+    cutouts : `torch.Tensor`
+        The real cutouts to classify, with the first axis indexing cutouts.
+        Must not include the cutouts used for calibration.
+    batch_size : `int`
+        The number of cutouts per model call.
+    """
+    import torch
+
+    expected, original_rate = _time_model(original, cutouts, batch_size)
+    actual, optimized_rate = _time_model(optimized, cutouts, batch_size)
+    max_diff = (actual - expected).abs().max().item()
+    agreement = ((actual > 0.5) == (expected > 0.5)).float().mean().item()
+    logging.info("Comparison on %d real cutouts (%d threads, batch size %d):",
+                 len(cutouts), torch.get_num_threads(), batch_size)
+    logging.info("    original:  %8.1f cutouts/s", original_rate)
+    logging.info("    optimized: %8.1f cutouts/s (%.2fx)", optimized_rate, optimized_rate / original_rate)
+    logging.info("    max score difference %.4g, classification agreement %.2f%%", max_diff, 100*agreement)
+
+
+########################################
+# Put everything together
+
+def main(argv=None):
+    import torch
+    from lsst.meas.transiNet.modelPackages.storageAdapterButler import StorageAdapterButler
+
+    # Ensure logs from tasks are visible
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    lsst.log.configure_pylog_MDC("DEBUG", MDC_class=None)
+
+    args = _make_parser().parse_args(argv)
+
+    butler = Butler(DATASET_REPO, writeable=True)
+    ref = butler.find_dataset(StorageAdapterButler.dataset_type_name, collections=MODEL_CHAIN)
+    if ref is None:
+        raise RuntimeError(f"No model found in {DATASET_REPO}:{MODEL_CHAIN}; run get_nn_models.py first.")
+    payload = butler.get(ref)
+    original, input_shape = load_model(payload)
+
+    cutouts = _make_cutouts(payload, args.n_cutouts, args.processes)
+    if len(cutouts) < 2:
+        raise RuntimeError("Too few DIA sources to both calibrate and check the quantized model.")
+    calibration, evaluation = torch.split(cutouts, (len(cutouts) + 1) // 2)
+
+    logging.info("Quantizing model from %s on %d cutouts...", ref.run, len(calibration))
+    quantized = _quantize(original, calibration, args.batch_size)
+    quantized_payload = _quantize_package(payload, original, quantized, input_shape)
+    optimized, _ = load_model(quantized_payload)
+    _compare(original, optimized, evaluation, args.batch_size)
+
+    cpu_run = f"{ref.run}-{CPU_SUFFIX}"
+    chain = [c for c in butler.registry.getCollectionChain(MODEL_CHAIN) if c != cpu_run]
+    butler.registry.setCollectionChain(MODEL_CHAIN, chain)
+    if butler.registry.registerRun(cpu_run) is False:
+        # Replace the variant from a previous run of this script
+        butler.removeRuns([cpu_run], unstore=True)
+        butler.registry.registerRun(cpu_run)
+    butler.registry.registerDatasetType(DatasetType(CPU_MODEL_TYPE, ref.datasetType.dimensions,
+                                                    ref.datasetType.storageClass))
+    butler.put(quantized_payload, CPU_MODEL_TYPE, run=cpu_run)
+    butler.registry.setCollectionChain(MODEL_CHAIN, chain + [cpu_run])
+
+    logging.info(f"Optimized model stored in {DATASET_REPO}:{MODEL_CHAIN} as {CPU_MODEL_TYPE}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+# This file is part of ap_verify_dataset_template.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Script for rewriting the preloaded DIA catalogs into a compact, spatially
+sorted form.
+
+Each ``preloaded_*`` catalog created by ``generate_self_preload.py`` is
+sorted by HTM index. The catalogs that ``diaPipe`` reads, found from its input
+connections in ApPipe, are also stripped of columns that it does not use. The
+catalog is written with one Parquet row group per coarse HTM trixel,
+and each row is tagged with its trixel, so that readers can load only the rows
+near a region by filtering on that column. DIAObjects are written back to the
+APDB and therefore keep exactly their original columns: they are sorted and
+grouped by trixel, but not tagged. The rewritten catalogs are prepended to the
+``dia_catalogs`` collection, and the script logs the size and read-time change
+for each dataset type. Because ``diaPipe`` still reads whole catalogs, the
+read time of a single trixel, as a filtering reader would see it, is logged
+separately.
+
+This script must be run after ``generate_self_preload.py``.
+
+Example:
+$ python partition_preloaded_catalogs.py
+rewrites the catalogs in this dataset's preloaded repo. See
+partition_preloaded_catalogs.py -h for more options.
+"""
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import lsst.log
+from lsst.daf.butler import Butler, DatasetRef, FileDataset
+
+
+# Avoid explicit references to dataset package to maximize portability.
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+DATASET_REPO = os.path.normpath(os.path.join(SCRIPT_DIR, "..", "preloaded"))
+# Must match generate_self_preload.py
+PRELOAD_TYPES = ["preloaded_*"]
+PIPE_DIR = os.path.join(SCRIPT_DIR, "..", "pipelines")
+# The ApPipe task that reads the preloaded catalogs; must match the label in
+# ApPipe.yaml.
+CONSUMER_LABEL = "diaPipe"
+DEST_COLLECTION = "dia_catalogs"
+SRC_RUN = DEST_COLLECTION + "/apdb"
+DEST_RUN = DEST_COLLECTION + "/partitioned"
+
+# Sort key resolution, and the coarser level used to tag rows.
+SORT_LEVEL = 16
+PARTITION_LEVEL = 7
+PARTITION_COLUMN = "htm7"
+# Columns read by diaPipe from the catalog of each of its input connections;
+# None means all columns are kept. Catalogs that diaPipe does not read are
+# sorted, but keep all their columns.
+CONSUMED_COLUMNS = {
+    "preloadedDiaObjects": None,
+    "preloadedDiaSources": ["diaSourceId", "diaObjectId", "ssObjectId", "parentDiaSourceId",
+                            "visit", "detector", "band", "ra", "dec", "midpointMjdTai",
+                            "psfFlux", "psfFluxErr", "scienceFlux", "scienceFluxErr"],
+    "preloadedDiaForcedSources": ["diaForcedSourceId", "diaObjectId", "visit", "detector", "band",
+                                  "midpointMjdTai", "psfFlux", "psfFluxErr",
+                                  "scienceFlux", "scienceFluxErr"],
+}
+# The connection whose catalogs give the positions of the others' rows.
+OBJECT_CONNECTION = "preloadedDiaObjects"
+
+
+########################################
+# Command-line options
+
+def _make_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--keep-all-columns", action="store_true",
+                        help="Sort catalogs without removing any columns.")
+    parser.add_argument("--remove-original", action="store_true",
+                        help=f"Delete {SRC_RUN} after rewriting. By default, it is kept in {DEST_COLLECTION} "
+                             "behind the rewritten catalogs.")
+    return parser
+
+
+########################################
+# Rewriting
+
+def _htm_index(ra, dec, level):
+    """Compute HTM indices of a set of positions.
+
+    Parameters
+    ----------
+    ra, dec : array-like [`float`]
+        The positions, in degrees.
+    level : `int`
+        The HTM level.
+
+    Returns
+    -------
+    index : `numpy.ndarray` [`int`]
+        The HTM index of each position.
+    """
+    import numpy
+    import lsst.sphgeom
+
+    pixelization = lsst.sphgeom.HtmPixelization(level)
+    return numpy.array([pixelization.index(lsst.sphgeom.UnitVector3d(lsst.sphgeom.LonLat.fromDegrees(r, d)))
+                        for r, d in zip(ra, dec)], dtype=numpy.int64)
+
+
+def _partition(catalog, columns, object_index=None):
+    """Sort a catalog spatially and remove unused columns.
+
+    Parameters
+    ----------
+    catalog : `pandas.DataFrame`
+        The catalog to rewrite.
+    columns : iterable [`str`] or `None`
+        The columns to keep, or `None` to keep all columns.
+    object_index : `pandas.Series`, optional
+        The fine HTM index of each DIAObject, indexed by ``diaObjectId``.
+        Used for catalogs without positions of their own.
+
+    Returns
+    -------
+    catalog : `pandas.DataFrame`
+        The rewritten catalog. If ``columns`` is not `None`, it has an extra
+        ``PARTITION_COLUMN`` column.
+    fine : `numpy.ndarray` [`int`] or `None`
+        The ``SORT_LEVEL`` HTM index of each row of ``catalog``, or `None` if
+        the catalog could not be sorted.
+    """
+    import numpy
+
+    if {"ra", "dec"} <= set(catalog.columns):
+        fine = _htm_index(catalog["ra"], catalog["dec"], SORT_LEVEL)
+    elif object_index is not None and "diaObjectId" in catalog.columns:
+        fine = catalog["diaObjectId"].map(object_index).fillna(0).to_numpy(dtype=numpy.int64)
+    else:
+        return (catalog if columns is None else catalog[[c for c in catalog.columns if c in columns]]), None
+
+    # Catalogs that keep all columns may be written back to the APDB, so
+    # must not gain any.
+    if columns is not None:
+        catalog = catalog[[c for c in catalog.columns if c in columns]]
+        catalog = catalog.assign(**{PARTITION_COLUMN: _to_partition(fine)})
+    order = numpy.argsort(fine, kind="stable")
+    return catalog.iloc[order].reset_index(drop=True), fine[order]
+
+
+def _to_partition(fine):
+    """Convert ``SORT_LEVEL`` HTM indices to ``PARTITION_LEVEL`` indices.
+    """
+    return fine >> (2 * (SORT_LEVEL - PARTITION_LEVEL))
+
+
+def _write_partitioned(catalog, fine, path):
+    """Write a catalog from `_partition` with one row group per trixel.
+
+    Parameters
+    ----------
+    catalog : `pandas.DataFrame`
+        The catalog to write.
+    fine : `numpy.ndarray` [`int`] or `None`
+        The sort index of each row, as returned by `_partition`.
+    path : `str`
+        The Parquet file to create.
+
+    Returns
+    -------
+    n_groups : `int`
+        The number of row groups written.
+    """
+    import numpy
+    import pyarrow
+    import pyarrow.parquet
+
+    table = pyarrow.Table.from_pandas(catalog, preserve_index=False)
+    if fine is None:
+        pyarrow.parquet.write_table(table, path)
+        return 1
+
+    # The catalog is sorted, so each trixel is a contiguous slice.
+    trixels = _to_partition(fine)
+    bounds = numpy.flatnonzero(numpy.diff(trixels)) + 1
+    starts = numpy.concatenate([[0], bounds])
+    ends = numpy.concatenate([bounds, [len(trixels)]])
+    with pyarrow.parquet.ParquetWriter(path, table.schema) as writer:
+        for start, end in zip(starts, ends):
+            writer.write_table(table.slice(start, end - start))
+    return len(starts)
+
+
+def _timed_get(butler, ref):
+    """Read a dataset and measure how long it took.
+    """
+    start = time.perf_counter()
+    data = butler.get(ref)
+    return data, time.perf_counter() - start
+
+
+def _timed_region_read(butler, ref):
+    """Read the rows of one trixel of a catalog from `_write_partitioned`, as a
+    reader that filters on ``PARTITION_COLUMN`` would, and measure how long it
+    took.
+
+    Returns
+    -------
+    read_time : `float` or `None`
+        The time to read the first trixel's rows, in seconds, or `None` if the
+        catalog has no ``PARTITION_COLUMN``.
+    """
+    import pyarrow.parquet
+
+    path = butler.getURI(ref).ospath
+    parquet_file = pyarrow.parquet.ParquetFile(path)
+    if PARTITION_COLUMN not in parquet_file.schema_arrow.names or not parquet_file.metadata.num_rows:
+        return None
+    trixel = parquet_file.read_row_group(0, columns=[PARTITION_COLUMN])[PARTITION_COLUMN][0].as_py()
+    start = time.perf_counter()
+    pyarrow.parquet.read_table(path, filters=[(PARTITION_COLUMN, "=", trixel)])
+    return time.perf_counter() - start
+
+
+def _get_consumed_types():
+    """Find the dataset types of the preloaded catalogs that diaPipe reads.
+
+    Returns
+    -------
+    dataset_types : `dict` [`str`, `str`]
+        The dataset type name of each input connection in `CONSUMED_COLUMNS`.
+
+    Raises
+    ------
+    RuntimeError
+        Raised if ``CONSUMER_LABEL`` does not have all the connections in
+        `CONSUMED_COLUMNS`.
+    """
+    import lsst.pipe.base
+
+    pipeline = lsst.pipe.base.Pipeline.fromFile(os.path.join(PIPE_DIR, "ApPipe.yaml"))
+    pipeline.addConfigOverride("parameters", "apdb_config", "foo")
+    inputs = pipeline.to_graph().tasks[CONSUMER_LABEL].inputs
+    missing = CONSUMED_COLUMNS.keys() - inputs.keys()
+    if missing:
+        raise RuntimeError(f"{CONSUMER_LABEL} has no inputs named {', '.join(sorted(missing))}; "
+                           "update CONSUMED_COLUMNS.")
+    return {connection: inputs[connection].parent_dataset_type_name for connection in CONSUMED_COLUMNS}
+
+
+def _rewrite(butler, keep_all_columns):
+    """Rewrite all preloaded catalogs into ``DEST_RUN``.
+
+    Parameters
+    ----------
+    butler : `lsst.daf.butler.Butler`
+        A writeable Butler pointing to this repository.
+    keep_all_columns : `bool`
+        Whether to skip column removal.
+
+    Returns
+    -------
+    stats : `dict` [`str`, `dict`]
+        For each dataset type, the number of catalogs (``n_catalogs``) and row
+        groups (``n_groups``), the total ``size`` (bytes) and ``read_time``
+        (seconds) of the catalogs ``before`` and ``after`` rewriting, and the
+        total ``region_read_time`` (seconds) of reading one trixel from each
+        rewritten catalog, or `None` if the catalogs have no trixel column.
+
+    Raises
+    ------
+    RuntimeError
+        Raised if ``SRC_RUN`` has no catalogs of a type that diaPipe reads.
+    """
+    import pandas
+
+    consumed = _get_consumed_types()
+    consumed_columns = {name: CONSUMED_COLUMNS[connection] for connection, name in consumed.items()}
+    dataset_types = sorted(butler.registry.queryDatasetTypes(PRELOAD_TYPES),
+                           # DIAObjects first, so their positions are available to other catalogs.
+                           key=lambda t: (t.name != consumed[OBJECT_CONNECTION], t.name))
+    found = {t.name for t in dataset_types
+             if butler.query_datasets(t, collections=SRC_RUN, limit=1, explain=False)}
+    unmatched = consumed_columns.keys() - found
+    if unmatched:
+        raise RuntimeError(f"{CONSUMER_LABEL} reads {', '.join(sorted(unmatched))}, but {SRC_RUN} has no "
+                           "such catalogs; check that generate_self_preload.py used the same pipeline.")
+
+    butler.registry.registerRun(DEST_RUN)
+    stats = {}
+    object_indices = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for dataset_type in dataset_types:
+            columns = None if keep_all_columns else consumed_columns.get(dataset_type.name)
+            type_stats = dict(n_catalogs=0, n_groups=0,
+                              before=dict(size=0, read_time=0.0), after=dict(size=0, read_time=0.0),
+                              region_read_time=None)
+            for ref in butler.query_datasets(dataset_type, collections=SRC_RUN, explain=False):
+                catalog, read_time = _timed_get(butler, ref)
+                type_stats["before"]["size"] += butler.getURI(ref).size()
+                type_stats["before"]["read_time"] += read_time
+
+                rewritten, fine = _partition(catalog, columns, object_indices.get(ref.dataId))
+                if dataset_type.name == consumed[OBJECT_CONNECTION] and fine is not None:
+                    object_indices[ref.dataId] = pandas.Series(fine, index=rewritten["diaObjectId"])
+                # The Parquet formatter does not support row groups, so write
+                # the file directly and ingest it.
+                path = os.path.join(temp_dir, f"{ref.id}.parq")
+                type_stats["n_groups"] += _write_partitioned(rewritten, fine, path)
+                new_ref = DatasetRef(dataset_type, ref.dataId, run=DEST_RUN)
+                butler.ingest(FileDataset(path=path, refs=[new_ref]), transfer="move")
+                type_stats["n_catalogs"] += 1
+
+                _, read_time = _timed_get(butler, new_ref)
+                type_stats["after"]["size"] += butler.getURI(new_ref).size()
+                type_stats["after"]["read_time"] += read_time
+                region_time = _timed_region_read(butler, new_ref)
+                if region_time is not None:
+                    type_stats["region_read_time"] = (type_stats["region_read_time"] or 0.0) + region_time
+            stats[dataset_type.name] = type_stats
+    return stats
+
+
+def _report(stats):
+    """Log the size and read-time changes from rewriting.
+    """
+    logging.info("%-30s %8s %8s %12s %12s %11s %11s", "dataset type", "catalogs", "groups",
+                 "size before", "size after", "read before", "read after")
+    for name, type_stats in stats.items():
+        before, after = type_stats["before"], type_stats["after"]
+        logging.info("%-30s %8d %8d %9.1f MB %9.1f MB %9.3f s %9.3f s", name,
+                     type_stats["n_catalogs"], type_stats["n_groups"],
+                     before["size"] / 1e6, after["size"] / 1e6, before["read_time"], after["read_time"])
+        if before["size"] and before["read_time"]:
+            logging.info("%-30s size reduced by %.0f%%, read time by %.0f%%.", name,
+                         100.0 * (1.0 - after["size"] / before["size"]),
+                         100.0 * (1.0 - after["read_time"] / before["read_time"]))
+        if type_stats["region_read_time"] is not None:
+            logging.info("%-30s one trixel per catalog read in %.3f s.", name, type_stats["region_read_time"])
+
+
+########################################
+# Put everything together
+
+def main(argv=None):
+    # Ensure logs from tasks are visible
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    lsst.log.configure_pylog_MDC("DEBUG", MDC_class=None)
+
+    args = _make_parser().parse_args(argv)
+
+    butler = Butler(DATASET_REPO, writeable=True)
+    runs = set(butler.collections.query(DEST_COLLECTION + "/*"))
+    if SRC_RUN not in runs:
+        raise RuntimeError(f"{SRC_RUN} not found; run generate_self_preload.py first.")
+    if DEST_RUN in runs:
+        # Left over from a previous rewrite
+        butler.collections.redefine_chain(DEST_COLLECTION, [SRC_RUN])
+        butler.removeRuns([DEST_RUN], unstore=True)
+
+    logging.info("Rewriting preloaded catalogs...")
+    stats = _rewrite(butler, args.keep_all_columns)
+    _report(stats)
+
+    butler.collections.redefine_chain(DEST_COLLECTION, [DEST_RUN] if args.remove_original
+                                      else [DEST_RUN, SRC_RUN])
+    if args.remove_original:
+        butler.removeRuns([SRC_RUN], unstore=True)
+
+    logging.info("Rewritten catalogs stored in %s:%s.", DATASET_REPO, DEST_COLLECTION)
+
+
+if __name__ == "__main__":
+    main()
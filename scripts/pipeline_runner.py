@@ -0,0 +1,270 @@
+# This file is part of ap_verify_dataset_template.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Running this dataset's pipelines on a repository made from it.
+
+`run_pipeline` runs one of the pipelines in ``pipelines/`` with ``pipetask``,
+against a fresh APDB in the repository, and can profile every quantum (see
+``quantum_profiler.py``).
+
+The QuantumGraph of each run is stored in ``GRAPH_DIR``, a subdirectory of
+the scratch directory (see ``scratch_repo.py``), and later runs load it
+instead of generating it again. A graph refers to its inputs by dataset ID,
+so it is keyed by the pipeline, the dataset's config files, the versions of
+all setup packages, the run's collections and data query, and the IDs of all
+datasets in the input collections. A graph is therefore reused only by runs
+on copies of the same scratch repository (which keep the raws' dataset IDs)
+that would have generated the same graph. ``generate_quantum_graphs.py``
+fills the cache ahead of time. ap_verify always generates its own graphs.
+
+Graphs record the configs they were built with, so the APDB config and the
+APDB itself are given by paths relative to the repository, in which
+``pipetask`` is run.
+
+This module is shared by the dataset scripts in this directory; it is not a
+script itself.
+"""
+
+__all__ = ["GRAPH_DIR", "GRAPH_EXTENSION", "PIPE_DIR", "build_graph", "get_graph_file", "get_graph_key",
+           "run_pipeline"]
+
+import glob
+import hashlib
+import logging
+import os
+import re
+import subprocess
+
+from quantum_profiler import pipetask_command
+from scratch_repo import SCRATCH_DIR
+
+
+# Avoid explicit references to dataset package to maximize portability.
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+PIPE_DIR = os.path.normpath(os.path.join(SCRIPT_DIR, "..", "pipelines"))
+CONFIG_DIR = os.path.normpath(os.path.join(SCRIPT_DIR, "..", "config"))
+GRAPH_DIR = os.path.join(SCRATCH_DIR, "qgraphs")
+GRAPH_EXTENSION = ".qgraph"
+# Relative to the repository directory.
+APDB_FILE = "apdb.db"
+APDB_CONFIG_FILE = "apdb.py"
+
+
+########################################
+# Graph cache
+
+def get_graph_key(butler, pipeline_name, input_collections, output_run, data_query):
+    """Compute the key identifying the graph of a pipeline run.
+
+    Parameters
+    ----------
+    butler : `lsst.daf.butler.Butler`
+        A Butler pointing to the repository on which the pipeline will run.
+    pipeline_name : `str`
+        The file name of a pipeline in ``PIPE_DIR``, including any subset.
+    input_collections : iterable [`str`]
+        The collections containing inputs.
+    output_run : `str`
+        The run into which to write outputs.
+    data_query : `str`
+        The query restricting the data to process.
+
+    Returns
+    -------
+    key : `str`
+        A hex digest that changes whenever anything that goes into the graph
+        changes.
+    """
+    import lsst.utils.packages
+
+    digest = hashlib.sha256()
+    for value in [pipeline_name, ",".join(input_collections), output_run, data_query]:
+        digest.update(f"{value}\n".encode())
+    pipeline_file = os.path.join(PIPE_DIR, pipeline_name.split("#")[0])
+    # Pipelines read configs from CONFIG_DIR.
+    for path in [pipeline_file] + sorted(glob.glob(os.path.join(CONFIG_DIR, "**", "*"), recursive=True)):
+        if os.path.isfile(path):
+            digest.update(os.path.relpath(path, SCRIPT_DIR).encode())
+            with open(path, "rb") as f:
+                digest.update(f.read())
+    # Pipelines import their task definitions from other packages, so any
+    # change in the environment can change the graph.
+    packages = lsst.utils.packages.getEnvironmentPackages(include_all=True)
+    for name, version in sorted(packages.items()):
+        digest.update(f"{name}={version}\n".encode())
+    refs = butler.registry.queryDatasets(..., collections=list(input_collections))
+    for dataset_id in sorted(str(ref.id) for ref in refs):
+        digest.update(dataset_id.encode())
+    return digest.hexdigest()[:16]
+
+
+def get_graph_file(pipeline_name, key):
+    """Return the location of the stored graph of a pipeline run.
+
+    Parameters
+    ----------
+    pipeline_name : `str`
+        The file name of a pipeline in ``PIPE_DIR``, including any subset.
+    key : `str`
+        The graph key from `get_graph_key`.
+
+    Returns
+    -------
+    graph_file : `str`
+        The path at which the graph is or would be stored.
+    """
+    stem = re.sub(r"[^\w-]+", "_", pipeline_name)
+    return os.path.join(GRAPH_DIR, f"{stem}-{key}{GRAPH_EXTENSION}")
+
+
+def build_graph(repo_dir, pipeline_name, input_collections, output_run, data_query, graph_file):
+    """Generate and save the QuantumGraph of a pipeline run.
+
+    Parameters
+    ----------
+    repo_dir : `str`
+        The repository on which the pipeline will run.
+    pipeline_name : `str`
+        The file name of a pipeline in ``PIPE_DIR``, including any subset.
+    input_collections : iterable [`str`]
+        The collections containing inputs.
+    output_run : `str`
+        The run into which to write outputs.
+    data_query : `str`
+        The query restricting the data to process.
+    graph_file : `str`
+        The file to which to save the graph.
+
+    Raises
+    ------
+    RuntimeError
+        Raised if the graph could not be generated.
+    """
+    os.makedirs(os.path.dirname(graph_file), exist_ok=True)
+    # Save atomically, so that an interrupted run never leaves a partial graph.
+    temp_file = os.path.splitext(graph_file)[0] + ".partial" + GRAPH_EXTENSION
+    pipeline_args = ["pipetask", "qgraph",
+                     "--butler-config", os.path.abspath(repo_dir),
+                     "--pipeline", os.path.join(PIPE_DIR, pipeline_name),
+                     "--config", f"parameters:apdb_config='{APDB_CONFIG_FILE}'",
+                     "--input", ",".join(input_collections),
+                     "--output-run", output_run,
+                     "--data-query", data_query,
+                     "--save-qgraph", temp_file,
+                     ]
+    results = subprocess.run(pipeline_args, cwd=repo_dir, capture_output=False, shell=False, check=False)
+    if results.returncode:
+        raise RuntimeError(f"Could not generate graph for {pipeline_name}; see log for details.")
+    os.replace(temp_file, graph_file)
+
+
+########################################
+# Pipeline execution
+
+def _make_apdb(repo_dir):
+    """Create an empty APDB in a repository.
+
+    Parameters
+    ----------
+    repo_dir : `str`
+        The repository in which to create the APDB, as ``APDB_FILE``. Its
+        config is written to ``APDB_CONFIG_FILE``.
+    """
+    import lsst.dax.apdb
+
+    apdb_location = f"sqlite:///{os.path.join(repo_dir, APDB_FILE)}"
+    logging.debug("Creating apdb at %s...", apdb_location)
+    apdb_config = lsst.dax.apdb.ApdbSql.init_database(db_url=apdb_location)
+    # Relative to the directory pipetask runs in, so that stored graphs work
+    # in any repository.
+    apdb_config.db_url = f"sqlite:///{APDB_FILE}"
+    apdb_config.save(os.path.join(repo_dir, APDB_CONFIG_FILE))
+
+
+def run_pipeline(repo_dir, pipeline_name, input_collections, output_run, data_query, processes,
+                 profile_dir=None, use_graph_cache=True):
+    """Run a pipeline, optionally with per-quantum profiling.
+
+    Parameters
+    ----------
+    repo_dir : `str`
+        The repository on which to run the pipeline.
+    pipeline_name : `str`
+        The file name of a pipeline in ``PIPE_DIR``.
+    input_collections : iterable [`str`]
+        The collections containing inputs.
+    output_run : `str`
+        The run into which to write outputs.
+    data_query : `str`
+        The query restricting the data to process.
+    processes : `int`
+        The number of processes to use. Ignored if ``profile_dir`` is
+        provided.
+    profile_dir : `str`, optional
+        The directory in which to write profiles. If not provided, the
+        pipeline is not profiled. If provided, the pipeline is run in a
+        single process, as quanta in worker processes cannot be profiled.
+    use_graph_cache : `bool`, optional
+        Whether to run from a stored graph, generating and storing it first
+        if there is none for this run (see `get_graph_key`).
+
+    Raises
+    ------
+    RuntimeError
+        Raised on any pipeline failure.
+    """
+    from lsst.daf.butler import Butler
+
+    repo_dir = os.path.abspath(repo_dir)
+    _make_apdb(repo_dir)
+
+    if use_graph_cache:
+        key = get_graph_key(Butler(repo_dir), pipeline_name, input_collections, output_run, data_query)
+        graph_file = get_graph_file(pipeline_name, key)
+        if os.path.exists(graph_file):
+            logging.info("Using stored graph %s.", graph_file)
+        else:
+            logging.info("Generating graph for %s...", pipeline_name)
+            build_graph(repo_dir, pipeline_name, input_collections, output_run, data_query, graph_file)
+        graph_args = ["--qgraph", graph_file]
+    else:
+        graph_args = ["--pipeline", os.path.join(PIPE_DIR, pipeline_name),
+                      "--config", f"parameters:apdb_config='{APDB_CONFIG_FILE}'",
+                      "--data-query", data_query,
+                      ]
+
+    if profile_dir:
+        pipetask = pipetask_command(profile_dir)
+        processes = 1
+    else:
+        pipetask = ["pipetask"]
+    pipeline_args = pipetask + [
+        "run",
+        "--butler-config", repo_dir,
+        *graph_args,
+        "--input", ",".join(input_collections),
+        "--output-run", output_run,
+        "--processes", str(processes),
+        "--register-dataset-types",
+    ]
+    results = subprocess.run(pipeline_args, cwd=repo_dir, capture_output=False, shell=False, check=False)
+    if results.returncode:
+        raise RuntimeError("Pipeline failed to run; see log for details.")
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# This file is part of ap_verify_dataset_template.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Script for resolving all source-repository queries of the import scripts
+at once.
+
+The calib, template, skymap, refcat, and model queries are run concurrently
+over a single connection pool, and their results saved to a manifest. Passing
+the manifest to ``import_calibs.py``, ``import_templates.py``,
+``ingest_refcats.py``, or ``get_nn_models.py`` with ``--manifest`` makes them
+use the prefetched results instead of querying the source repository
+themselves. Only the queries whose collection is given are run.
+
+Example:
+$ python prefetch_source_refs.py -o refs.json -c LSSTCam/calib -t u/me/DM-123456-template
+$ python import_calibs.py -c LSSTCam/calib --manifest refs.json
+See prefetch_source_refs.py -h for more options.
+"""
+
+import argparse
+import logging
+import sys
+import time
+
+import lsst.log
+from lsst.daf.butler import Butler
+
+from source_manifest import prefetch, write_manifest
+
+
+########################################
+# Command-line options
+
+def _make_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-b", dest="src_dir", default="/repo/main",
+                        help="Repo to query, defaults to '/repo/main'.")
+    parser.add_argument("-o", dest="manifest", required=True,
+                        help="Manifest file to write.")
+    parser.add_argument("-c", dest="calib_collection",
+                        help="Calib collection, as for import_calibs.py -c.")
+    parser.add_argument("-t", dest="template_collection",
+                        help="Template collection, as for import_templates.py -t.")
+    parser.add_argument("--where",
+                        help="Query string for filtering templates, as for import_templates.py --where.")
+    parser.add_argument("-i", dest="refcat_collection",
+                        help="Refcat collection, as for ingest_refcats.py -i.")
+    parser.add_argument("-m", dest="model_name",
+                        help="Model package, as for get_nn_models.py -m.")
+    parser.add_argument("-j", dest="max_workers", type=int, default=4,
+                        help="Maximum number of concurrent queries, defaults to 4.")
+    return parser
+
+
+def _get_params(args):
+    """Convert command-line arguments into parameters for
+    `source_manifest.prefetch`.
+    """
+    params = {}
+    if args.calib_collection:
+        params["calibs"] = dict(collection=args.calib_collection)
+    if args.template_collection:
+        params["templates"] = dict(collection=args.template_collection, where=args.where)
+    if args.refcat_collection:
+        params["refcats"] = dict(collection=args.refcat_collection)
+    if args.model_name:
+        from lsst.meas.transiNet.modelPackages.storageAdapterButler import StorageAdapterButler
+
+        params["models"] = dict(
+            collection=f"{StorageAdapterButler.packages_parent_collection}/{args.model_name}")
+    return params
+
+
+########################################
+# Put everything together
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    lsst.log.configure_pylog_MDC("DEBUG", MDC_class=None)
+
+    args = _make_parser().parse_args(argv)
+    params = _get_params(args)
+    if not params:
+        raise RuntimeError("No queries requested; see -h for options.")
+
+    src = Butler(args.src_dir, writeable=False)
+    logging.info("Querying %s for %s...", args.src_dir, ", ".join(params))
+    start = time.perf_counter()
+    manifest = prefetch(src, params, max_workers=args.max_workers)
+    logging.info("Queries took %.1f s.", time.perf_counter() - start)
+    write_manifest(manifest, args.src_dir, args.manifest)
+    logging.info("Manifest written to %s.", args.manifest)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# This file is part of ap_verify_dataset_template.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Script for profiling one of this dataset's pipelines on its own data.
+
+Every quantum is run under `cProfile`, in a single process. The profiles are merged by task, and
+the hottest functions of each task are stored in the output run as a
+``quantum_profile_report`` dataset and written to ``report.txt`` in the
+workspace.
+
+This script requires that preloaded/ be complete.
+
+Example:
+$ python profile_pipeline.py -p ApVerify.yaml -w /scratch/me/profile
+profiles ApVerify.yaml over all visits. See profile_pipeline.py -h for more
+options.
+"""
+
+import argparse
+import logging
+import os
+import sys
+
+import lsst.log
+
+from pipeline_runner import run_pipeline
+from quantum_profiler import aggregate_profiles, clear_profiles, format_report, write_report
+from scratch_repo import RAW_RUN, make_preloaded_copy
+
+
+# Avoid explicit references to dataset package to maximize portability.
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+PIPELINES = ["ApPipe.yaml", "ApPipeFromPostIsr.yaml", "ApPipeWithWarpedTemplates.yaml",
+             "ApVerify.yaml", "ApVerifyWithFakes.yaml"]
+
+
+########################################
+# Command-line options
+
+def _make_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", dest="pipeline", choices=PIPELINES, default="ApPipe.yaml",
+                        help="Pipeline to profile, defaults to ApPipe.yaml.")
+    parser.add_argument("-w", dest="workspace", required=True,
+                        help="Directory in which to create the repository, APDB, and profiles. "
+                             "Must be empty or not exist.")
+    parser.add_argument("-d", dest="data_query", default="",
+                        help="Query string restricting the data to process.")
+    parser.add_argument("-o", dest="output_run", default="profile",
+                        help="Output run for pipeline outputs and the report, defaults to 'profile'.")
+    parser.add_argument("--top", type=int, default=25,
+                        help="Number of functions to report per task, defaults to 25.")
+    return parser
+
+
+########################################
+# Put everything together
+
+def main(argv=None):
+    import lsst.obs.base
+
+    # Ensure logs from tasks are visible
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    lsst.log.configure_pylog_MDC("DEBUG", MDC_class=None)
+
+    args = _make_parser().parse_args(argv)
+
+    repo_dir = os.path.join(args.workspace, "repo")
+    profile_dir = os.path.join(args.workspace, "profiles")
+    logging.info("Creating repository in %s...", repo_dir)
+    repo = make_preloaded_copy(repo_dir)
+    inst_name = repo.query_data_ids("instrument")[0]["instrument"]
+    instrument = lsst.obs.base.Instrument.fromName(inst_name, repo.registry)
+
+    clear_profiles(profile_dir)
+    logging.info("Running %s with profiling...", args.pipeline)
+    run_pipeline(repo_dir, args.pipeline, [RAW_RUN, instrument.makeUmbrellaCollectionName()],
+                 args.output_run, args.data_query, 1, profile_dir)
+
+    repo.registry.refresh()
+    report = aggregate_profiles(profile_dir, top=args.top)
+    write_report(report, repo, args.output_run)
+    report_file = os.path.join(args.workspace, "report.txt")
+    with open(report_file, "w") as f:
+        f.write(format_report(report))
+    logging.info("Profiling report stored in %s:%s and %s.", repo_dir, args.output_run, report_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+# This file is part of ap_verify_dataset_template.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Per-quantum profiling of pipetask runs.
+
+`pipetask_command` returns a command that runs ``pipetask`` with each quantum
+executed under `cProfile`, writing one profile per quantum to a directory.
+`aggregate_profiles` merges those profiles by task, and `write_report` stores
+the merged hot-function report in a Butler run.
+
+Profiling is opt-in: scripts that run pipelines enable it when the
+``AP_VERIFY_DATASET_PROFILE_DIR`` environment variable is set, or through
+``profile_pipeline.py``. Only quanta run in the ``pipetask`` process itself
+are profiled, so profiled runs must use ``--processes 1``; the worker
+processes started for ``--processes > 1`` are not patched.
+
+This module is shared by the dataset scripts in this directory; it is not a
+script itself.
+"""
+
+__all__ = ["PROFILE_ENV", "REPORT_DATASET", "aggregate_profiles", "clear_profiles", "format_report",
+           "install", "pipetask_command", "write_report"]
+
+import cProfile
+import functools
+import glob
+import os
+import pstats
+import re
+import shutil
+import sys
+
+
+PROFILE_ENV = "AP_VERIFY_DATASET_PROFILE_DIR"
+REPORT_DATASET = "quantum_profile_report"
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+
+
+########################################
+# Collection
+
+def _get_executor_class():
+    """Return the class that runs individual quanta in this stack version.
+    """
+    try:
+        from lsst.pipe.base.single_quantum_executor import SingleQuantumExecutor
+    except ImportError:
+        from lsst.ctrl.mpexec import SingleQuantumExecutor
+    return SingleQuantumExecutor
+
+
+def install(profile_dir):
+    """Profile every quantum executed by this process.
+
+    Quanta executed by worker processes, as started by ``pipetask
+    --processes``, are not profiled.
+
+    Parameters
+    ----------
+    profile_dir : `str`
+        The directory in which to write profiles, as
+        ``<profile_dir>/<task label>/<data ID>.prof``.
+    """
+    executor_class = _get_executor_class()
+    original = executor_class.execute
+
+    @functools.wraps(original)
+    def execute(self, task_node, quantum, *args, **kwargs):
+        label = getattr(task_node, "label", None) or type(task_node).__name__
+        data_id = re.sub(r"[^\w=-]+", "_", str(quantum.dataId)).strip("_")
+        task_dir = os.path.join(profile_dir, label)
+        os.makedirs(task_dir, exist_ok=True)
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(original, self, task_node, quantum, *args, **kwargs)
+        finally:
+            profiler.dump_stats(os.path.join(task_dir, f"{data_id}-{os.getpid()}.prof"))
+
+    executor_class.execute = execute
+
+
+def clear_profiles(profile_dir):
+    """Delete the profiles left in a directory by a previous run.
+
+    Parameters
+    ----------
+    profile_dir : `str`
+        A directory written by `install`. Files not written by `install`
+        are left alone.
+    """
+    for task_dir in glob.glob(os.path.join(profile_dir, "*")):
+        for profile in glob.glob(os.path.join(task_dir, "*.prof")):
+            os.remove(profile)
+        if os.path.isdir(task_dir) and not os.listdir(task_dir):
+            shutil.rmtree(task_dir)
+
+
+def pipetask_command(profile_dir):
+    """Return a command prefix that runs ``pipetask`` with profiling.
+
+    The command must be run with ``--processes 1``, or most quanta will not
+    be profiled.
+
+    Parameters
+    ----------
+    profile_dir : `str`
+        The directory in which to write profiles.
+
+    Returns
+    -------
+    command : `list` [`str`]
+        A replacement for ``["pipetask"]`` in a subprocess command line.
+    """
+    bootstrap = ("import sys; "
+                 f"sys.path.insert(0, {SCRIPT_DIR!r}); "
+                 "import quantum_profiler; "
+                 f"quantum_profiler.install({os.path.abspath(profile_dir)!r}); "
+                 "from lsst.ctrl.mpexec.cli.pipetask import main; "
+                 "sys.argv[0] = 'pipetask'; "
+                 "sys.exit(main())")
+    return [sys.executable, "-c", bootstrap]
+
+
+########################################
+# Reporting
+
+def aggregate_profiles(profile_dir, top=25):
+    """Merge per-quantum profiles by task.
+
+    Parameters
+    ----------
+    profile_dir : `str`
+        A directory written by `install`.
+    top : `int`, optional
+        The number of functions to report per task.
+
+    Returns
+    -------
+    report : `dict` [`str`, `dict`]
+        A mapping from task label to a summary with the keys ``n_quanta``,
+        ``total_time`` (seconds), and ``functions``, a list of the hottest
+        functions by internal time. Each function has the keys ``function``,
+        ``ncalls``, ``tottime``, and ``cumtime``.
+    """
+    report = {}
+    for task_dir in sorted(glob.glob(os.path.join(profile_dir, "*"))):
+        files = sorted(glob.glob(os.path.join(task_dir, "*.prof")))
+        if not files:
+            continue
+        stats = pstats.Stats(*files)
+        rows = []
+        for (filename, line, name), (_, ncalls, tottime, cumtime, _) in stats.stats.items():
+            rows.append(dict(function=f"{filename}:{line}({name})", ncalls=ncalls,
+                             tottime=tottime, cumtime=cumtime))
+        rows.sort(key=lambda r: r["tottime"], reverse=True)
+        report[os.path.basename(task_dir)] = dict(n_quanta=len(files), total_time=stats.total_tt,
+                                                  functions=rows[:top])
+    return report
+
+
+def format_report(report):
+    """Format a report from `aggregate_profiles` as text.
+
+    Parameters
+    ----------
+    report : `dict` [`str`, `dict`]
+        The report to format.
+
+    Returns
+    -------
+    text : `str`
+        A human-readable report, with tasks in decreasing order of total time.
+    """
+    lines = []
+    for label, summary in sorted(report.items(), key=lambda item: item[1]["total_time"], reverse=True):
+        lines.append(f"{label}: {summary['total_time']:.1f} s over {summary['n_quanta']} quanta")
+        lines.append(f"    {'tottime':>10} {'cumtime':>10} {'ncalls':>10}  function")
+        for row in summary["functions"]:
+            lines.append(f"    {row['tottime']:10.3f} {row['cumtime']:10.3f} {row['ncalls']:10d}  "
+                         f"{row['function']}")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def write_report(report, butler, run):
+    """Store a report from `aggregate_profiles` in a repository.
+
+    Parameters
+    ----------
+    report : `dict` [`str`, `dict`]
+        The report to store.
+    butler : `lsst.daf.butler.Butler`
+        A writeable Butler for the repository to store the report in.
+    run : `str`
+        The run in which to store the report, usually the pipeline output run.
+    """
+    from lsst.daf.butler import DatasetType
+
+    butler.registry.registerDatasetType(
+        DatasetType(REPORT_DATASET, butler.dimensions.empty, "StructuredDataDict"))
+    butler.put(report, REPORT_DATASET, run=run)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# This file is part of ap_verify_dataset_template.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Parquet cache of this dataset's visit-detector regions.
+
+`write_region_cache` stores the visit_detector_region records of a repository
+in a Parquet file, together with a table of HTM and HEALPix pixel ranges
+covering each region. `RegionCache` reads these files, so that the sky pixels
+overlapping a set of visits and detectors (such as the refcat shards they
+need) can be found without querying and pixelizing each region again.
+
+The cache lives in ``config/region_cache/``, outside of the export file, and
+is rewritten by ``make_region_cache.py``. Readers must fall back to the
+registry for any visit and detector that is not in the cache.
+
+This module is shared by the dataset scripts in this directory; it is not a
+script itself.
+"""
+
+__all__ = ["PIXELIZATIONS", "REGION_CACHE_DIR", "RegionCache", "write_region_cache"]
+
+import os
+import shutil
+
+import numpy
+import pandas
+
+import lsst.sphgeom
+
+
+# Avoid explicit references to dataset package to maximize portability.
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+REGION_CACHE_DIR = os.path.normpath(os.path.join(SCRIPT_DIR, "..", "config", "region_cache"))
+# Keys must match the skypix dimension names; HTM level 7 matches the refcat
+# shards.
+PIXELIZATIONS = {"htm7": lsst.sphgeom.HtmPixelization(7),
+                 "healpix8": lsst.sphgeom.HealpixPixelization(8),
+                 }
+_REGION_FILE = "visit_detector_region.parquet"
+_INDEX_FILE = "pixel_index.parquet"
+
+
+########################################
+# Writing
+
+def _make_pixel_index(regions):
+    """Compute the pixel ranges covering each of a list of regions.
+
+    Parameters
+    ----------
+    regions : sequence [`lsst.sphgeom.Region`]
+        The regions to index.
+
+    Returns
+    -------
+    index : `pandas.DataFrame`
+        A table with one row per pixel range, with columns ``pixelization``,
+        ``begin``, ``end`` (exclusive), and ``row`` (the position of the
+        region in ``regions``).
+    """
+    pieces = []
+    for name, pixelization in PIXELIZATIONS.items():
+        for i, region in enumerate(regions):
+            ranges = numpy.array(list(pixelization.envelope(region)), dtype=numpy.int64).reshape(-1, 2)
+            pieces.append(pandas.DataFrame({"pixelization": name,
+                                            "begin": ranges[:, 0],
+                                            "end": ranges[:, 1],
+                                            "row": numpy.full(len(ranges), i, dtype=numpy.int32),
+                                            }))
+    return pandas.concat(pieces, ignore_index=True)
+
+
+def write_region_cache(butler, cache_dir):
+    """Write the visit-detector regions of a repository to Parquet files.
+
+    Parameters
+    ----------
+    butler : `lsst.daf.butler.Butler`
+        The repository whose regions to cache.
+    cache_dir : `str`
+        The directory in which to write the cache. Any existing cache is
+        replaced.
+
+    Returns
+    -------
+    n_regions : `int`
+        The number of regions cached. If 0, no cache is written, and any
+        existing cache is removed.
+    """
+    records = butler.query_dimension_records("visit_detector_region", explain=False)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    if not records:
+        return 0
+
+    table = pandas.DataFrame({"instrument": [record.instrument for record in records],
+                              "visit": [record.visit for record in records],
+                              "detector": [record.detector for record in records],
+                              "region": [record.region.encode() for record in records],
+                              })
+    os.makedirs(cache_dir)
+    table.to_parquet(os.path.join(cache_dir, _REGION_FILE), index=False)
+    _make_pixel_index([record.region for record in records]).to_parquet(
+        os.path.join(cache_dir, _INDEX_FILE), index=False)
+    return len(records)
+
+
+########################################
+# Reading
+
+class RegionCache:
+    """Read-only view of a cache made by `write_region_cache`.
+
+    Parameters
+    ----------
+    cache_dir : `str`
+        The directory containing the cache.
+
+    Raises
+    ------
+    FileNotFoundError
+        Raised if ``cache_dir`` does not contain a cache.
+    """
+
+    def __init__(self, cache_dir):
+        regions = pandas.read_parquet(os.path.join(cache_dir, _REGION_FILE),
+                                      columns=["instrument", "visit", "detector"])
+        self._rows = {(instrument, int(visit), int(detector)): row for row, (instrument, visit, detector)
+                      in enumerate(regions.itertuples(index=False))}
+        index = pandas.read_parquet(os.path.join(cache_dir, _INDEX_FILE))
+        self._index = {name: (group["begin"].to_numpy(), group["end"].to_numpy(), group["row"].to_numpy())
+                       for name, group in index.groupby("pixelization")}
+
+    def __contains__(self, data_id):
+        """Test whether a visit-detector combination is in the cache.
+
+        Parameters
+        ----------
+        data_id : `tuple` [`str`, `int`, `int`]
+            The instrument, visit, and detector.
+        """
+        return data_id in self._rows
+
+    def pixels(self, pixelization, data_ids):
+        """Return the pixels overlapping a set of visit-detector regions.
+
+        Parameters
+        ----------
+        pixelization : `str`
+            One of the keys of `PIXELIZATIONS`, e.g. ``"htm7"`` for refcat
+            shards.
+        data_ids : iterable [`tuple` [`str`, `int`, `int`]]
+            The instrument, visit, and detector of each region. All must be in
+            the cache.
+
+        Returns
+        -------
+        pixels : `lsst.sphgeom.RangeSet`
+            The pixels covering the regions. May include pixels that do not
+            actually overlap the regions, exactly as for
+            `lsst.sphgeom.Pixelization.envelope`.
+
+        Raises
+        ------
+        KeyError
+            Raised if any of ``data_ids`` is not in the cache.
+        """
+        rows = [self._rows[data_id] for data_id in data_ids]
+        begin, end, row = self._index[pixelization]
+        selected = numpy.isin(row, rows)
+        pixels = lsst.sphgeom.RangeSet()
+        for b, e in zip(begin[selected], end[selected]):
+            pixels |= lsst.sphgeom.RangeSet(int(b), int(e))
+        return pixels
@@ -0,0 +1,241 @@
+# This file is part of ap_verify_dataset_template.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Persistent scratch repository with this dataset's raws already ingested.
+
+Several scripts need a repository in which the raws have been ingested and
+visits defined, often together with the contents of preloaded/. This module
+keeps one such repository in a subdirectory of ``SCRATCH_DIR``, keyed by a
+fingerprint of the raw files and the dimension universe, and rebuilds it only
+when the fingerprint changes. Raws are ingested in place
+(``transfer="direct"``), so the repository consists of little more than its
+registry, and scripts can cheaply make private copies to write into.
+
+This module is shared by the dataset scripts in this directory; it is not a
+script itself.
+"""
+
+__all__ = ["PRELOADED_DIR", "RAW_DIR", "RAW_RUN", "SCRATCH_DIR", "get_fingerprint", "make_preloaded_copy",
+           "make_scratch_copy"]
+
+import glob
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+
+from lsst.daf.butler import Butler, DimensionUniverse
+
+
+_log = logging.getLogger(__name__)
+
+# Avoid explicit references to dataset package to maximize portability.
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+RAW_DIR = os.path.normpath(os.path.join(SCRIPT_DIR, "..", "raw"))
+RAW_RUN = "raw"
+PRELOADED_DIR = os.path.normpath(os.path.join(SCRIPT_DIR, "..", "preloaded"))
+# May be overridden to put the (potentially large) registry on faster disk.
+SCRATCH_DIR = os.environ.get("AP_VERIFY_DATASET_SCRATCH",
+                             os.path.normpath(os.path.join(SCRIPT_DIR, "..", "scratch")))
+_FINGERPRINT_FILE = "fingerprint"
+# Names of the repository directories created by this module.
+_FINGERPRINT_PATTERN = re.compile(r"[0-9a-f]{16}")
+
+
+def _find_raws(raw_dir):
+    """Return all raw files in a directory, in a consistent order.
+    """
+    return sorted(glob.glob(os.path.join(raw_dir, '**', '*.fits*'), recursive=True))
+
+
+def get_fingerprint(raw_dir=RAW_DIR):
+    """Compute the fingerprint identifying the scratch repository.
+
+    Parameters
+    ----------
+    raw_dir : `str`, optional
+        The directory containing raw files.
+
+    Returns
+    -------
+    fingerprint : `str`
+        A hex digest of the raw file names, sizes, and modification times and
+        of the default dimension universe.
+    """
+    digest = hashlib.sha256()
+    universe = DimensionUniverse()
+    digest.update(f"{universe.namespace}:{universe.version}\n".encode())
+    for raw in _find_raws(raw_dir):
+        # Hashing file contents would read the entire dataset on every call.
+        stat = os.stat(raw)
+        digest.update(f"{os.path.relpath(raw, raw_dir)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()[:16]
+
+
+def _build_base_repo(repo_dir, instruments, raw_dir, run):
+    """Create a repository containing this dataset's raws and visits.
+
+    Parameters
+    ----------
+    repo_dir : `str`
+        The directory in which to create the new repository.
+    instruments : iterable [`lsst.obs.base.Instrument`]
+        The instruments to register in the new repository.
+    raw_dir : `str`
+        The directory containing raw files.
+    run : `str`
+        The name of the run into which to ingest the raws.
+    """
+    import lsst.obs.base
+
+    config = Butler.makeRepo(repo_dir)
+    repo = Butler(config, writeable=True)
+    _log.debug("Scratch repo has universe version %d.", repo.dimensions.version)
+    for instrument in instruments:
+        instrument.register(repo.registry)
+
+    ingest_config = lsst.obs.base.RawIngestConfig()
+    # Keep raws in place, so copying the repo only copies the registry.
+    ingest_config.transfer = "direct"
+    ingester = lsst.obs.base.RawIngestTask(butler=repo, config=ingest_config)
+    ingester.run(_find_raws(raw_dir), run=run)
+    exposures = set(repo.registry.queryDataIds(["exposure"]))
+    definer = lsst.obs.base.DefineVisitsTask(butler=repo, config=lsst.obs.base.DefineVisitsConfig())
+    definer.run(exposures)
+
+
+def _remove_stale_repos():
+    """Delete any scratch repositories not matching the current fingerprint.
+
+    Only directories created by this module are deleted; anything else in
+    ``SCRATCH_DIR`` is left alone.
+    """
+    if not os.path.isdir(SCRATCH_DIR):
+        return
+    # Any other repos are out of date, and a repo without a marker was not
+    # completed.
+    for name in os.listdir(SCRATCH_DIR):
+        path = os.path.join(SCRATCH_DIR, name)
+        if _FINGERPRINT_PATTERN.fullmatch(name) and os.path.isdir(path):
+            _log.info("Removing out-of-date scratch repository %s.", path)
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def _get_base_repo(instruments, raw_dir, run):
+    """Return an up-to-date scratch repository, building it if necessary.
+
+    Parameters
+    ----------
+    instruments : iterable [`lsst.obs.base.Instrument`]
+        The instruments to register in the repository.
+    raw_dir : `str`
+        The directory containing raw files.
+    run : `str`
+        The name of the run containing the raws.
+
+    Returns
+    -------
+    repo_dir : `str`
+        The location of the scratch repository.
+    """
+    fingerprint = get_fingerprint(raw_dir)
+    repo_dir = os.path.join(SCRATCH_DIR, fingerprint)
+    marker = os.path.join(repo_dir, _FINGERPRINT_FILE)
+    if os.path.exists(marker):
+        _log.info("Reusing scratch repository %s.", repo_dir)
+        return repo_dir
+
+    _remove_stale_repos()
+    _log.info("Building scratch repository %s...", repo_dir)
+    _build_base_repo(repo_dir, instruments, raw_dir, run)
+    # Written last, so that an interrupted build is not reused.
+    with open(marker, "w") as f:
+        f.write(fingerprint + "\n")
+    return repo_dir
+
+
+def make_scratch_copy(repo_dir, instruments, raw_dir=RAW_DIR, run=RAW_RUN):
+    """Create a repository in which this dataset's raws have been ingested.
+
+    The new repository is a private copy of the persistent scratch
+    repository, and may be freely modified.
+
+    Parameters
+    ----------
+    repo_dir : `str`
+        The (empty or nonexistent) directory in which to create the new
+        repository.
+    instruments : iterable [`lsst.obs.base.Instrument`]
+        The instruments to register in the new repository.
+    raw_dir : `str`, optional
+        The directory containing raw files.
+    run : `str`, optional
+        The name of the run into which to ingest the raws.
+
+    Returns
+    -------
+    butler : `lsst.daf.butler.Butler`
+        A writeable Butler to the new repo.
+    """
+    base_dir = _get_base_repo(instruments, raw_dir, run)
+    shutil.copytree(base_dir, repo_dir, dirs_exist_ok=True,
+                    ignore=shutil.ignore_patterns(_FINGERPRINT_FILE))
+    return Butler(repo_dir, writeable=True)
+
+
+def make_preloaded_copy(repo_dir, preloaded_dir=PRELOADED_DIR):
+    """Create a repository that's a copy of the preloaded repository, plus
+    this dataset's raws.
+
+    Parameters
+    ----------
+    repo_dir : `str`
+        The (empty or nonexistent) directory in which to create the new
+        repository.
+    preloaded_dir : `str`, optional
+        The repository to copy.
+
+    Returns
+    -------
+    butler : `lsst.daf.butler.Butler`
+        A writeable Butler to the new repo.
+    """
+    import lsst.obs.base
+
+    src_butler = Butler(preloaded_dir)
+    # Don't use ap_verify code, to avoid dependency on potentially out-of-date export.yaml
+    instruments = [lsst.obs.base.Instrument.fromName(id["instrument"], src_butler.registry)
+                   for id in src_butler.registry.queryDataIds("instrument")]
+    dest_butler = make_scratch_copy(repo_dir, instruments)
+    _log.debug("Temporary repo has universe version %d.", dest_butler.dimensions.version)
+    # Use export/import to preserve chained and calibration collections
+    with tempfile.NamedTemporaryFile(suffix=".yaml") as export_file:
+        with src_butler.export(filename=export_file.name, transfer=None) as contents:
+            for t in src_butler.registry.queryDatasetTypes():
+                contents.saveDatasets(
+                    src_butler.query_datasets(t, collections="*", find_first=False, explain=False))
+            # runs and dimensions included automatically
+            for coll in src_butler.collections.query("*", include_chains=True):
+                contents.saveCollection(coll)
+        dest_butler.import_(directory=preloaded_dir, filename=export_file.name, transfer="auto")
+    return dest_butler
@@ -0,0 +1,477 @@
+#!/usr/bin/env python
+# This file is part of ap_verify_dataset_template.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Script for setting up a repository from this dataset, with the setup steps
+overlapped.
+
+Setting up a run (as done by ap_verify) copies the datastore of preloaded/,
+imports the export file, ingests the raws, and defines visits, each step
+waiting for the previous one. Most of these steps touch disjoint files, so
+this script instead:
+
+- copies the datastore files in a background thread pool, in the order that
+  the export file lists them;
+- meanwhile imports the dimension records and collections of the export
+  file, then ingests the raws, extracting their metadata in a process pool;
+- imports each group of datasets as soon as its files have been copied;
+- defines visits once everything else is done.
+
+Only the main thread writes to the registry. With ``--serial``, the steps are
+run one after another instead, as ap_verify does. With ``--benchmark``, the
+script sets up a repository from a synthetic preloaded repository (of the
+given number of files) and this dataset's raws both ways, and reports both
+wall times. Because the second setup of a trial may read files the first left
+in the page cache, the order alternates between trials (``--trials``), and
+the results are reported separately for each order.
+
+Example:
+$ python setup_workspace.py -w /tmp/workspace
+creates a repository in /tmp/workspace equivalent to the one ap_verify would
+create. See setup_workspace.py -h for more options.
+"""
+
+import argparse
+import concurrent.futures
+import glob
+import io
+import logging
+import multiprocessing
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import yaml
+
+import lsst.log
+from lsst.daf.butler import Butler, DatasetType
+from lsst.resources import ResourcePath
+
+
+# Avoid explicit references to dataset package to maximize portability.
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+DATASET_DIR = os.path.normpath(os.path.join(SCRIPT_DIR, ".."))
+PRELOADED_DIR = os.path.join(DATASET_DIR, "preloaded")
+EXPORT_FILE = os.path.join(DATASET_DIR, "config", "export.yaml")
+RAW_DIR = os.path.join(DATASET_DIR, "raw")
+SYNTHETIC_TYPE = "syntheticPreload"
+
+
+########################################
+# Command-line options
+
+def _make_parser():
+    parser = argparse.ArgumentParser()
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument("-w", dest="workspace",
+                      help="Directory in which to create the repository; must be empty or nonexistent.")
+    mode.add_argument("--benchmark", dest="n_files", type=int,
+                      help="Compare overlapped and serial setup on a synthetic preloaded repository "
+                           "with this many files.")
+    parser.add_argument("--file-size", type=int, default=1 << 20,
+                        help="Size in bytes of each synthetic file, defaults to 1 MiB.")
+    parser.add_argument("--trials", dest="n_trials", type=int, default=2,
+                        help="With --benchmark, number of times to run both setups, alternating which "
+                             "runs first; defaults to 2.")
+    parser.add_argument("--serial", action="store_true",
+                        help="Run the setup steps one after another.")
+    parser.add_argument("-j", dest="processes", type=int, default=4,
+                        help="Number of threads for copying and processes for raw metadata, defaults to 4.")
+    return parser
+
+
+########################################
+# Export file handling
+
+def _read_export(export_file):
+    """Split an export file into independently importable parts.
+
+    Parameters
+    ----------
+    export_file : `str`
+        A YAML export file, as written by ``make_preloaded_export.py``.
+
+    Returns
+    -------
+    header : `dict` [`str`]
+        The top-level keys of the export file, other than its contents.
+    registry_entries : `list` [`dict`]
+        The entries that do not refer to files: dimension records,
+        collections, runs, and dataset types.
+    dataset_entries : `list` [`dict`]
+        The dataset entries, each describing the datasets of one type in
+        one run.
+    association_entries : `list` [`dict`]
+        The entries associating datasets with tagged or calibration
+        collections.
+    """
+    with open(export_file) as f:
+        contents = yaml.safe_load(f)
+    header = {key: value for key, value in contents.items() if key != "data"}
+    registry_entries = []
+    dataset_entries = []
+    association_entries = []
+    for entry in contents["data"]:
+        match entry["type"]:
+            case "dataset":
+                dataset_entries.append(entry)
+            case "associations":
+                association_entries.append(entry)
+            case _:
+                registry_entries.append(entry)
+    return header, registry_entries, dataset_entries, association_entries
+
+
+def _import(butler, root, header, entries):
+    """Import part of an export file, with the files already in place.
+
+    Parameters
+    ----------
+    butler : `lsst.daf.butler.Butler`
+        A writeable Butler to the repository to import into.
+    root : `str`
+        The root of the repository's datastore.
+    header : `dict` [`str`]
+        The header returned by `_read_export`.
+    entries : `list` [`dict`]
+        The entries to import.
+    """
+    if entries:
+        stream = io.StringIO(yaml.safe_dump(dict(header, data=entries)))
+        butler.import_(directory=root, filename=stream, format="yaml", transfer=None)
+
+
+def _get_paths(entry):
+    """Return the files of a dataset entry.
+
+    Parameters
+    ----------
+    entry : `dict`
+        A dataset entry from the ``data`` section of an export file.
+
+    Returns
+    -------
+    paths : `list` [`str`]
+        The files of the datasets in ``entry``, relative to the datastore
+        root.
+    """
+    return [record["path"] for record in entry["records"] if "path" in record]
+
+
+########################################
+# Setup steps
+
+def _copy_files(src_root, dest_root, paths):
+    """Copy datastore files into a repository.
+
+    Parameters
+    ----------
+    src_root, dest_root : `str`
+        The roots of the source and destination datastores.
+    paths : iterable [`str`]
+        The files to copy, relative to the datastore roots.
+    """
+    for path in paths:
+        dest = os.path.join(dest_root, path)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.copy2(os.path.join(src_root, path), dest)
+
+
+def _find_raws(raw_dir):
+    """Return all raw files in a directory, in a consistent order.
+
+    Parameters
+    ----------
+    raw_dir : `str`
+        The directory containing raw files.
+
+    Returns
+    -------
+    raws : `list` [`lsst.resources.ResourcePath`]
+        The raw files.
+    """
+    return sorted(ResourcePath(f) for f in glob.glob(os.path.join(raw_dir, "**", "*.fits*"), recursive=True))
+
+
+def _get_instruments(preloaded_dir):
+    """Return the instruments of a repository.
+
+    Parameters
+    ----------
+    preloaded_dir : `str`
+        The repository to search.
+
+    Returns
+    -------
+    instruments : `list` [`lsst.obs.base.Instrument`]
+        The instruments registered in ``preloaded_dir``.
+    """
+    import lsst.obs.base
+
+    src = Butler(preloaded_dir)
+    return [lsst.obs.base.Instrument.fromName(id["instrument"], src.registry)
+            for id in src.registry.queryDataIds("instrument")]
+
+
+def _make_repo(workspace, preloaded_dir):
+    """Create an empty repository with the dataset's instruments registered.
+
+    Parameters
+    ----------
+    workspace : `str`
+        The (empty or nonexistent) directory in which to create the
+        repository.
+    preloaded_dir : `str`
+        The repository whose instruments to register.
+
+    Returns
+    -------
+    butler : `lsst.daf.butler.Butler`
+        A writeable Butler to the new repository.
+    instruments : `list` [`lsst.obs.base.Instrument`]
+        The instruments of the dataset.
+    """
+    instruments = _get_instruments(preloaded_dir)
+    butler = Butler(Butler.makeRepo(workspace), writeable=True)
+    for instrument in instruments:
+        instrument.register(butler.registry)
+    return butler, instruments
+
+
+def _define_visits(butler):
+    """Define visits for all exposures in a repository.
+
+    Parameters
+    ----------
+    butler : `lsst.daf.butler.Butler`
+        A writeable Butler to a repository in which raws have been ingested.
+    """
+    import lsst.obs.base
+
+    exposures = set(butler.registry.queryDataIds(["exposure"]))
+    definer = lsst.obs.base.DefineVisitsTask(butler=butler, config=lsst.obs.base.DefineVisitsConfig())
+    definer.run(exposures)
+
+
+def _setup_serial(workspace, preloaded_dir, export_file, raw_dir, processes):
+    """Set up a repository one step at a time.
+
+    Parameters
+    ----------
+    workspace : `str`
+        The (empty or nonexistent) directory in which to create the
+        repository.
+    preloaded_dir : `str`
+        The preloaded repository whose datastore to copy.
+    export_file : `str`
+        The export file of ``preloaded_dir``.
+    raw_dir : `str`
+        The directory containing raw files.
+    processes : `int`
+        The number of processes for raw ingestion.
+
+    Returns
+    -------
+    butler : `lsst.daf.butler.Butler`
+        A writeable Butler to the new repository.
+    """
+    import lsst.obs.base
+
+    butler, instruments = _make_repo(workspace, preloaded_dir)
+    header, registry_entries, dataset_entries, association_entries = _read_export(export_file)
+    _copy_files(preloaded_dir, workspace, [p for entry in dataset_entries for p in _get_paths(entry)])
+    _import(butler, workspace, header, registry_entries + dataset_entries + association_entries)
+
+    ingester = lsst.obs.base.RawIngestTask(butler=butler, config=lsst.obs.base.RawIngestConfig())
+    ingester.run(_find_raws(raw_dir), processes=processes, run=instruments[0].makeDefaultRawIngestRunName())
+    _define_visits(butler)
+    return butler
+
+
+def _setup_overlapped(workspace, preloaded_dir, export_file, raw_dir, processes):
+    """Set up a repository with the datastore copy overlapped with the
+    import and raw ingestion.
+
+    Parameters
+    ----------
+    workspace : `str`
+        The (empty or nonexistent) directory in which to create the
+        repository.
+    preloaded_dir : `str`
+        The preloaded repository whose datastore to copy.
+    export_file : `str`
+        The export file of ``preloaded_dir``.
+    raw_dir : `str`
+        The directory containing raw files.
+    processes : `int`
+        The number of processes for raw ingestion, and of threads for
+        copying.
+
+    Returns
+    -------
+    butler : `lsst.daf.butler.Butler`
+        A writeable Butler to the new repository.
+    """
+    import lsst.obs.base
+
+    butler, instruments = _make_repo(workspace, preloaded_dir)
+    header, registry_entries, dataset_entries, association_entries = _read_export(export_file)
+    raws = _find_raws(raw_dir)
+    ingester = lsst.obs.base.RawIngestTask(butler=butler, config=lsst.obs.base.RawIngestConfig())
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=processes) as copier, \
+            multiprocessing.Pool(processes) as extractors:
+        # One copy job per dataset entry, so that each entry can be imported
+        # as soon as its own files are in place.
+        copies = [copier.submit(_copy_files, preloaded_dir, workspace, _get_paths(entry))
+                  for entry in dataset_entries]
+
+        _import(butler, workspace, header, registry_entries)
+        # Raws don't depend on any preloaded datasets, so they can be ingested
+        # while the datastore is still being copied.
+        ingester.run(raws, pool=extractors, run=instruments[0].makeDefaultRawIngestRunName())
+        for entry, copy in zip(dataset_entries, copies):
+            copy.result()
+            _import(butler, workspace, header, [entry])
+        _import(butler, workspace, header, association_entries)
+
+    _define_visits(butler)
+    return butler
+
+
+########################################
+# Benchmark
+
+def _make_synthetic(directory, n_files, file_size, instruments):
+    """Create a synthetic preloaded repository and its export file.
+
+    Parameters
+    ----------
+    directory : `str`
+        The (empty) directory in which to create the repository.
+    n_files : `int`
+        The number of datastore files to create.
+    file_size : `int`
+        The approximate size of each file, in bytes.
+    instruments : iterable [`lsst.obs.base.Instrument`]
+        The instruments to register; the synthetic datasets are spread over
+        the detectors of the first one.
+
+    Returns
+    -------
+    preloaded_dir : `str`
+        The synthetic repository.
+    export_file : `str`
+        The export file of ``preloaded_dir``.
+    """
+    preloaded_dir = os.path.join(directory, "preloaded")
+    butler = Butler(Butler.makeRepo(preloaded_dir), writeable=True)
+    for instrument in instruments:
+        instrument.register(butler.registry)
+    inst_name = instruments[0].getName()
+    dataset_type = DatasetType(SYNTHETIC_TYPE, ["instrument", "detector"], "StructuredDataDict",
+                               universe=butler.dimensions)
+    butler.registry.registerDatasetType(dataset_type)
+
+    detectors = [id["detector"] for id in butler.registry.queryDataIds("detector", instrument=inst_name)]
+    payload = dict(data="x" * file_size)
+    for i in range(n_files):
+        run, detector = divmod(i, len(detectors))
+        butler.put(payload, dataset_type, instrument=inst_name, detector=detectors[detector],
+                   run=f"synthetic/{run}")
+
+    export_file = os.path.join(directory, "export.yaml")
+    with butler.export(filename=export_file, format="yaml") as contents:
+        contents.saveDataIds(butler.registry.queryDataIds({"detector"}).expanded())
+        contents.saveDatasets(butler.registry.queryDatasets(SYNTHETIC_TYPE, collections=...))
+    return preloaded_dir, export_file
+
+
+def _benchmark(n_files, file_size, processes, n_trials):
+    """Time overlapped and serial setup on a synthetic dataset.
+
+    The two setups read the same files, so whichever runs second may find
+    them in the page cache. The order is alternated between trials, and the
+    speedup is reported separately for each order.
+
+    Parameters
+    ----------
+    n_files : `int`
+        The number of synthetic datastore files.
+    file_size : `int`
+        The approximate size of each file, in bytes.
+    processes : `int`
+        The number of threads and processes for each setup.
+    n_trials : `int`
+        The number of times to run both setups.
+    """
+    instruments = _get_instruments(PRELOADED_DIR)
+    setups = [("serial", _setup_serial), ("overlapped", _setup_overlapped)]
+    # Maps the method run first to the times of each trial.
+    times = {name: [] for name, _ in setups}
+    with tempfile.TemporaryDirectory() as directory:
+        logging.info("Creating %d synthetic files of %d bytes...", n_files, file_size)
+        preloaded_dir, export_file = _make_synthetic(directory, n_files, file_size, instruments)
+        for trial in range(n_trials):
+            order = setups if trial % 2 == 0 else setups[::-1]
+            trial_times = {}
+            for name, setup in order:
+                workspace = os.path.join(directory, name)
+                start = time.perf_counter()
+                setup(workspace, preloaded_dir, export_file, RAW_DIR, processes)
+                trial_times[name] = time.perf_counter() - start
+                logging.info("Trial %d: %s setup took %.1f s.", trial + 1, name, trial_times[name])
+                shutil.rmtree(workspace)
+            times[order[0][0]].append(trial_times)
+
+    for first, trials in times.items():
+        if not trials:
+            continue
+        serial = statistics.median(t["serial"] for t in trials)
+        overlapped = statistics.median(t["overlapped"] for t in trials)
+        logging.info("With %s setup first (%d trials): serial %.1f s, overlapped %.1f s; "
+                     "overlapped setup is %.2fx as fast as serial setup.",
+                     first, len(trials), serial, overlapped, serial / overlapped)
+
+
+########################################
+# Put everything together
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    lsst.log.configure_pylog_MDC("DEBUG", MDC_class=None)
+    args = _make_parser().parse_args(argv)
+
+    if args.n_files:
+        _benchmark(args.n_files, args.file_size, args.processes, args.n_trials)
+        return
+
+    setup = _setup_serial if args.serial else _setup_overlapped
+    start = time.perf_counter()
+    setup(args.workspace, PRELOADED_DIR, EXPORT_FILE, RAW_DIR, args.processes)
+    logging.info("Repository created in %s in %.1f s.", args.workspace, time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+# This file is part of ap_verify_dataset_template.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Prefetched source-repository queries for the import scripts.
+
+`prefetch` runs the calib, template, skymap, refcat, and model queries of
+``import_calibs.py``, ``import_templates.py``, ``ingest_refcats.py``, and
+``get_nn_models.py`` concurrently against a single source Butler, whose
+connection pool is shared by all queries. `write_manifest` saves the resolved
+datasets to a JSON manifest, which the import scripts accept through their
+``--manifest`` option in place of querying the source repository themselves.
+
+This module is shared by the dataset scripts in this directory; it is not a
+script itself.
+"""
+
+__all__ = ["SECTIONS", "find_validities", "prefetch", "read_section", "write_manifest"]
+
+import collections
+import concurrent.futures
+import json
+import logging
+
+from lsst.daf.butler import CollectionType, DatasetRef, Timespan
+
+
+_log = logging.getLogger(__name__)
+
+SECTIONS = ["calibs", "templates", "refcats", "models"]
+
+
+########################################
+# Queries
+
+def _find_calib_collections(registry, collection):
+    """Return the calibration collections in a collection or any of its
+    sub-collections.
+    """
+    match registry.getCollectionType(collection):
+        case CollectionType.CALIBRATION:
+            return {collection}
+        case CollectionType.CHAINED:
+            calib_collections = set()
+            for child in registry.getCollectionChain(collection):
+                calib_collections.update(_find_calib_collections(registry, child))
+            return calib_collections
+        case _:
+            return set()
+
+
+def find_validities(registry, calib_collections, calibs):
+    """Find the validity ranges of specific calibs.
+
+    Parameters
+    ----------
+    registry : `lsst.daf.butler.Registry`
+        The registry containing the calibs.
+    calib_collections : iterable [`str`]
+        The calibration collections whose validities to find.
+    calibs : iterable [`lsst.daf.butler.DatasetRef`]
+        The calibs whose validities to find. Validities of other calibs in
+        ``calib_collections`` are ignored.
+
+    Returns
+    -------
+    validities : `dict` [`str`, `dict` [`lsst.daf.butler.Timespan`, `list` [`lsst.daf.butler.DatasetRef`]]]
+        For each calibration collection, the calibs certified for each
+        validity range.
+    """
+    ids = {ref.id for ref in calibs}
+    dataset_types = {ref.datasetType for ref in calibs}
+    validities = {}
+    for collection in calib_collections:
+        by_timespan = validities[collection] = collections.defaultdict(list)
+        for dataset_type in dataset_types:
+            for association in registry.queryDatasetAssociations(dataset_type, collections=[collection]):
+                if association.ref.id in ids:
+                    by_timespan[association.timespan].append(association.ref)
+    return validities
+
+
+# Each query takes its constants from the script whose query it replaces. They
+# are imported on use, because those scripts import this module.
+def _query_calibs(butler, collection):
+    from import_calibs import CALIB_NAMES, DATA_IDS
+
+    refs = set()
+    for data_id in DATA_IDS:
+        refs.update(butler.registry.queryDatasets(CALIB_NAMES, dataId=data_id, collections=collection))
+    calib_collections = sorted(_find_calib_collections(butler.registry, collection))
+    # For import_calibs.py --trim-validities, which would otherwise have to
+    # scan every calib association in the source repository.
+    validities = find_validities(butler.registry, calib_collections, refs)
+    return dict(refs=refs, calib_collections=calib_collections, validities=validities)
+
+
+def _query_templates(butler, collection, where):
+    import lsst.skymap
+    from import_templates import TEMPLATE_NAME
+
+    templates = set(butler.registry.queryDatasets(TEMPLATE_NAME, collections=collection, where=where,
+                                                  findFirst=True))
+    skymaps = butler.registry.queryDataIds("skymap", datasets=TEMPLATE_NAME, collections=collection)
+    skymap_query = " or ".join(f"skymap = '{id['skymap']}'" for id in skymaps)
+    skymap_refs = set(butler.registry.queryDatasets(
+        "skyMap", collections=lsst.skymap.BaseSkyMap.SKYMAP_RUN_COLLECTION_NAME,
+        findFirst=True, where=skymap_query))
+    return dict(refs=templates, skymaps=skymap_refs)
+
+
+def _query_refcats(butler, collection):
+    from ingest_refcats import DATA_IDS, REFCAT_NAMES
+
+    subquery = "(instrument='{instrument}' and detector={detector} and visit={visit})"
+    where = " or ".join(subquery.format(**id) for id in DATA_IDS)
+    return dict(refs=set(butler.registry.queryDatasets(REFCAT_NAMES, collections=collection, where=where)))
+
+
+def _query_models(butler, collection):
+    return dict(refs=set(butler.registry.queryDatasets(..., collections=collection)))
+
+
+_QUERIES = {"calibs": _query_calibs,
+            "templates": _query_templates,
+            "refcats": _query_refcats,
+            "models": _query_models,
+            }
+
+
+def prefetch(butler, params, max_workers=4):
+    """Run the import scripts' source queries concurrently.
+
+    Parameters
+    ----------
+    butler : `lsst.daf.butler.Butler`
+        A Butler pointing to the source repository. Each query uses its own
+        clone, sharing this Butler's connection pool.
+    params : `dict` [`str`, `dict`]
+        A mapping from section name (one of `SECTIONS`) to the parameters
+        of that section's query: ``collection`` for all sections, and
+        ``where`` for ``templates``. Sections not in ``params`` are not
+        queried.
+    max_workers : `int`, optional
+        The maximum number of concurrent queries.
+
+    Returns
+    -------
+    manifest : `dict` [`str`, `dict`]
+        A mapping from section name to the parameters and results of that
+        section's query. Results are sets of `~lsst.daf.butler.DatasetRef`,
+        except for ``calib_collections`` (a list of collection names) and
+        ``validities`` (as returned by `find_validities`).
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {section: executor.submit(_QUERIES[section], butler.clone(), **section_params)
+                   for section, section_params in params.items()}
+        manifest = {}
+        for section, future in futures.items():
+            manifest[section] = dict(params=params[section], **future.result())
+            _log.info("Prefetched %d %s.", len(manifest[section]["refs"]), section)
+    return manifest
+
+
+########################################
+# Manifest files
+
+def write_manifest(manifest, src_dir, filename):
+    """Save prefetched query results to a file.
+
+    Parameters
+    ----------
+    manifest : `dict` [`str`, `dict`]
+        The output of `prefetch`.
+    src_dir : `str`
+        The source repository that was queried.
+    filename : `str`
+        The JSON file to write.
+    """
+    serialized = dict(src_dir=src_dir, sections={})
+    for section, contents in manifest.items():
+        serialized["sections"][section] = {
+            key: [ref.to_json() for ref in value] if key in ("refs", "skymaps") else value
+            for key, value in contents.items() if key != "validities"}
+        if "validities" in contents:
+            # Timespans can't be JSON keys, and the refs are already in "refs".
+            serialized["sections"][section]["validities"] = {
+                collection: [[timespan.to_simple(), [str(ref.id) for ref in refs]]
+                             for timespan, refs in by_timespan.items()]
+                for collection, by_timespan in contents["validities"].items()}
+    with open(filename, "w") as f:
+        json.dump(serialized, f, indent=1)
+
+
+def read_section(filename, section, src_dir, universe, **params):
+    """Load one section of a manifest, checking that it matches the query
+    the caller would have run.
+
+    Parameters
+    ----------
+    filename : `str`
+        A file written by `write_manifest`.
+    section : `str`
+        The section to load, one of `SECTIONS`.
+    src_dir : `str`
+        The source repository the caller would have queried.
+    universe : `lsst.daf.butler.DimensionUniverse`
+        The dimension universe of the source repository.
+    **params
+        The parameters of the caller's query.
+
+    Returns
+    -------
+    contents : `dict` [`str`]
+        The results of the query, in the same form as returned by `prefetch`.
+
+    Raises
+    ------
+    RuntimeError
+        Raised if the manifest does not contain results for this query.
+    """
+    with open(filename) as f:
+        serialized = json.load(f)
+    if serialized["src_dir"] != src_dir:
+        raise RuntimeError(f"Manifest {filename} is for {serialized['src_dir']}, not {src_dir}.")
+    if section not in serialized["sections"]:
+        raise RuntimeError(f"Manifest {filename} has no {section}.")
+    contents = serialized["sections"][section]
+    if contents["params"] != params:
+        raise RuntimeError(f"Manifest {filename} has {section} for {contents['params']}, not {params}.")
+    result = {key: {DatasetRef.from_json(ref, universe=universe) for ref in value}
+              if key in ("refs", "skymaps") else value
+              for key, value in contents.items()}
+    if "validities" in contents:
+        refs = {str(ref.id): ref for ref in result["refs"]}
+        result["validities"] = {
+            collection: {Timespan.from_simple(timespan): [refs[id] for id in ids]
+                         for timespan, ids in entries}
+            for collection, entries in contents["validities"].items()}
+    return result
@@ -0,0 +1,103 @@
+# This file is part of ap_verify_dataset_template.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Tests of the resumable transfers in scripts/chunked_transfer.py, between
+small local repositories.
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+try:
+    from lsst.daf.butler import Butler, DatasetType
+
+    from chunked_transfer import transfer_in_chunks
+except ImportError:
+    transfer_in_chunks = None
+
+
+INSTRUMENT = "DummyCam"
+DETECTORS = range(5)
+RUN = "test/run"
+
+
+@unittest.skipIf(transfer_in_chunks is None, "Science Pipelines are not set up.")
+class TransferInChunksTestSuite(unittest.TestCase):
+    """Test that `transfer_in_chunks` copies datasets into new and partly
+    filled repositories, and skips datasets that are already present.
+    """
+
+    CHUNK_SIZE = 2
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        self.src = Butler(Butler.makeRepo(os.path.join(directory.name, "src")), writeable=True)
+        self.src.registry.insertDimensionData("instrument", {"name": INSTRUMENT})
+        self.src.registry.insertDimensionData(
+            "detector", *[{"instrument": INSTRUMENT, "id": detector, "full_name": f"det{detector}"}
+                          for detector in DETECTORS])
+        dataset_type = DatasetType("testData", ["instrument", "detector"], "StructuredDataDict",
+                                   universe=self.src.dimensions)
+        self.src.registry.registerDatasetType(dataset_type)
+        self.src.registry.registerRun(RUN)
+        self.refs = [self.src.put({"detector": detector}, dataset_type,
+                                  instrument=INSTRUMENT, detector=detector, run=RUN)
+                     for detector in DETECTORS]
+
+        # Nothing registered: no dimension records, runs, or dataset types.
+        self.dest = Butler(Butler.makeRepo(os.path.join(directory.name, "dest")), writeable=True)
+
+    def _transfer(self, refs):
+        return transfer_in_chunks(self.dest, self.src, refs, chunk_size=self.CHUNK_SIZE,
+                                  register_dataset_types=True, transfer_dimensions=True)
+
+    def _assertTransferred(self, refs):
+        found = self.dest.query_datasets("testData", collections=RUN, explain=False)
+        self.assertEqual({ref.id for ref in found}, {ref.id for ref in refs})
+        for ref in refs:
+            self.assertEqual(self.dest.get(ref), {"detector": ref.dataId["detector"]})
+
+    def testEmptyDestination(self):
+        self.assertEqual(self._transfer(self.refs), len(self.refs))
+        self._assertTransferred(self.refs)
+
+    def testRerun(self):
+        self._transfer(self.refs)
+        self.assertEqual(self._transfer(self.refs), 0)
+        self._assertTransferred(self.refs)
+
+    def testResume(self):
+        self.assertEqual(self._transfer(self.refs[:3]), 3)
+        self._assertTransferred(self.refs[:3])
+        self.assertEqual(self._transfer(self.refs), len(self.refs) - 3)
+        self._assertTransferred(self.refs)
+
+    def testNothing(self):
+        self.assertEqual(self._transfer([]), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
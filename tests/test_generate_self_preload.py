@@ -0,0 +1,338 @@
+# This file is part of ap_verify_dataset_template.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Tests of the visit scheduling and catalog comparison in
+scripts/generate_self_preload.py, without running any pipelines.
+"""
+
+import collections
+import os
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+try:
+    import pandas
+
+    import generate_self_preload
+except ImportError:
+    generate_self_preload = None
+
+
+FakeRef = collections.namedtuple("FakeRef", ["dataId"])
+FakeDatasetType = collections.namedtuple("FakeDatasetType", ["name"])
+# Task labels for the fake ApPipe, split as _split_pipeline would.
+INDEPENDENT_LABELS = ["isr", "detection"]
+DEPENDENT_LABELS = ["diaPipe"]
+
+
+def _patch_pipeline(test_case):
+    """Replace the parts of `generate_self_preload` that need a real
+    pipeline or repository, for the duration of a test.
+    """
+    patchers = [
+        mock.patch.object(generate_self_preload, "_split_pipeline",
+                          return_value=(INDEPENDENT_LABELS, DEPENDENT_LABELS)),
+        mock.patch.object(generate_self_preload, "Butler"),
+    ]
+    for patcher in patchers:
+        patcher.start()
+        test_case.addCleanup(patcher.stop)
+
+
+def _get_step(pipeline_file):
+    """Return which part of the fake ApPipe a pipeline file runs.
+    """
+    if pipeline_file.endswith("#" + ",".join(DEPENDENT_LABELS)):
+        return "associate"
+    elif pipeline_file.endswith("#" + ",".join(INDEPENDENT_LABELS)):
+        return "prepare"
+    else:
+        return "all"
+
+
+class FakeRepo:
+    """A stand-in for a Butler that holds in-memory catalogs.
+
+    Parameters
+    ----------
+    catalogs : `dict` [`str`, `dict` [`int`, `pandas.DataFrame`]]
+        The catalogs in the repository, keyed by dataset type and data ID.
+    """
+
+    def __init__(self, catalogs):
+        self.catalogs = catalogs
+        self.registry = self
+
+    def queryDatasetTypes(self, expression):
+        return [FakeDatasetType(name) for name in self.catalogs]
+
+    def query_datasets(self, dataset_type, collections, explain):
+        return [FakeRef((dataset_type.name, data_id)) for data_id in self.catalogs[dataset_type.name]]
+
+    def get(self, ref):
+        dataset_type, data_id = ref.dataId
+        return self.catalogs[dataset_type][data_id]
+
+
+@unittest.skipIf(generate_self_preload is None, "Science Pipelines are not set up.")
+class RunOverlappedTestSuite(unittest.TestCase):
+    """Test that `_run_overlapped` associates visits in order, and only after
+    their APDB-independent tasks have finished.
+    """
+
+    VISITS = [411371, 411420, 411633, 411671, 411772]
+    LOOKAHEAD = 2
+
+    def setUp(self):
+        self.events = []
+        self.lock = threading.Lock()
+        _patch_pipeline(self)
+
+    def _record(self, *event):
+        with self.lock:
+            self.events.append(event)
+
+    def run_visit(self, visit, pipeline_file, input_collections, output_run, extend_run=False,
+                  processes=None):
+        step = _get_step(pipeline_file)
+        self._record("start", step, visit, output_run, extend_run, processes)
+        # Long enough that later visits are prepared during association.
+        time.sleep(0.05)
+        self._record("end", step, visit)
+
+    def _run(self, visits):
+        generate_self_preload._run_overlapped("repo", self.run_visit, visits, ["inputs"], "output",
+                                              self.LOOKAHEAD)
+
+    def _index(self, *event):
+        return next(i for i, e in enumerate(self.events) if e[:len(event)] == event)
+
+    def testAssociationOrder(self):
+        self._run(self.VISITS)
+        associated = [e[2] for e in self.events if e[:2] == ("start", "associate")]
+        self.assertEqual(associated, self.VISITS)
+        extend_runs = [e[4] for e in self.events if e[:2] == ("start", "associate")]
+        self.assertEqual(extend_runs, [False] + [True] * (len(self.VISITS) - 1))
+
+    def testAssociationWaits(self):
+        self._run(self.VISITS)
+        for visit in self.VISITS:
+            self.assertLess(self._index("end", "prepare", visit), self._index("start", "associate", visit))
+        for previous, visit in zip(self.VISITS, self.VISITS[1:]):
+            self.assertLess(self._index("end", "associate", previous),
+                            self._index("start", "associate", visit))
+
+    def testOverlap(self):
+        self._run(self.VISITS)
+        # The next visit is prepared while the first is associated.
+        self.assertLess(self._index("start", "prepare", self.VISITS[1]),
+                        self._index("end", "associate", self.VISITS[0]))
+        # Each visit is prepared exactly once, into its own run.
+        prepared = [e for e in self.events if e[:2] == ("start", "prepare")]
+        self.assertEqual(sorted(e[2] for e in prepared), sorted(self.VISITS))
+        for _, _, visit, output_run, _, _ in prepared:
+            self.assertEqual(output_run, f"output{generate_self_preload.PREP_SUFFIX}/{visit}")
+
+    def testProcesses(self):
+        self._run(self.VISITS)
+        running = 0
+        most_running = 0
+        for event in self.events:
+            if event[0] == "start":
+                running += event[5]
+                most_running = max(most_running, running)
+            else:
+                running -= next(e[5] for e in self.events if e[0] == "start" and e[1:3] == event[1:3])
+        self.assertLessEqual(most_running, generate_self_preload.PROCESSES)
+
+    def testShareProcesses(self):
+        for lookahead in range(1, generate_self_preload.PROCESSES):
+            with self.subTest(lookahead=lookahead):
+                prep, association = generate_self_preload._share_processes(lookahead)
+                self.assertGreaterEqual(prep, 1)
+                self.assertGreaterEqual(association, 1)
+                self.assertLessEqual(lookahead * prep + association, generate_self_preload.PROCESSES)
+
+    def testNoVisits(self):
+        self._run([])
+        self.assertEqual(self.events, [])
+
+
+@unittest.skipIf(generate_self_preload is None, "Science Pipelines are not set up.")
+class CompareCatalogsTestSuite(unittest.TestCase):
+    """Test that `_compare_catalogs` reports exactly the catalogs that
+    differ.
+    """
+
+    def setUp(self):
+        self.table = pandas.DataFrame({"diaObjectId": [1, 2, 3],
+                                       "ra": [10.0, 10.1, 10.2],
+                                       "time_processed": [1.0, 2.0, 3.0]})
+
+    def _compare(self, expected, actual):
+        return generate_self_preload._compare_catalogs(["preloaded_*"], FakeRepo(expected),
+                                                       FakeRepo(actual), "run")
+
+    def testIdentical(self):
+        catalogs = {"preloaded_DiaObject": {1: self.table}}
+        self.assertEqual(self._compare(catalogs, catalogs), [])
+
+    def testVolatileColumns(self):
+        reprocessed = self.table.assign(time_processed=[4.0, 5.0, 6.0])
+        self.assertEqual(self._compare({"preloaded_DiaObject": {1: self.table}},
+                                       {"preloaded_DiaObject": {1: reprocessed}}),
+                         [])
+
+    def testContents(self):
+        changed = self.table.assign(ra=[10.0, 10.1, 10.3])
+        differences = self._compare({"preloaded_DiaObject": {1: self.table, 2: self.table}},
+                                    {"preloaded_DiaObject": {1: self.table, 2: changed}})
+        self.assertEqual(len(differences), 1)
+        self.assertIn("different contents", differences[0])
+
+    def testColumns(self):
+        differences = self._compare({"preloaded_DiaObject": {1: self.table}},
+                                    {"preloaded_DiaObject": {1: self.table.drop(columns="ra")}})
+        self.assertEqual(len(differences), 1)
+        self.assertIn("different columns", differences[0])
+
+    def testMissing(self):
+        differences = self._compare({"preloaded_DiaObject": {1: self.table, 2: self.table}},
+                                    {"preloaded_DiaObject": {1: self.table}})
+        self.assertEqual(len(differences), 1)
+        self.assertIn("only in one run", differences[0])
+
+
+@unittest.skipIf(generate_self_preload is None, "Science Pipelines are not set up.")
+class OverlapEquivalenceTestSuite(unittest.TestCase):
+    """Test that overlapped and serial processing give the same catalogs,
+    using fake pipeline stages whose output depends on the order in which
+    visits are associated.
+    """
+
+    VISITS = [411371, 411420, 411633, 411671, 411772, 411774]
+    LOOKAHEAD = 3
+    # Close enough that sources of different visits associate.
+    MATCH_RADIUS = 0.05
+
+    def setUp(self):
+        _patch_pipeline(self)
+
+    def _detect(self, visit):
+        """Return the fake DIA sources of a visit.
+        """
+        # Vary the duration, so that overlapped visits finish out of order.
+        time.sleep(0.01 * (visit % 4))
+        offset = (visit % 7) * 0.01
+        return pandas.DataFrame({"diaSourceId": [visit * 10 + i for i in range(3)],
+                                 "visit": visit,
+                                 "ra": [10.0 + offset, 10.5 - offset, 11.0 + 0.2 * offset],
+                                 "dec": [-5.0, -5.0 + offset, -4.5]})
+
+    def _associate(self, sources):
+        """Associate sources with the fake APDB, returning the catalogs that
+        diaPipe would write.
+        """
+        object_ids = []
+        for ra, dec in zip(sources["ra"], sources["dec"]):
+            matches = self.apdb[((self.apdb["ra"] - ra)**2 + (self.apdb["dec"] - dec)**2)
+                                < self.MATCH_RADIUS**2]
+            if matches.empty:
+                object_id = len(self.apdb) + 1
+                self.apdb.loc[len(self.apdb)] = [object_id, ra, dec, 1]
+            else:
+                object_id = matches["diaObjectId"].iloc[0]
+                self.apdb.loc[matches.index[0], "nDiaSources"] += 1
+            object_ids.append(object_id)
+        return {"preloaded_DiaSource": sources.assign(diaObjectId=object_ids),
+                # time_processed must be ignored by the comparison.
+                "preloaded_DiaObject": self.apdb.assign(time_processed=time.time())}
+
+    def run_visit(self, visit, pipeline_file, input_collections, output_run, extend_run=False,
+                  processes=None):
+        step = _get_step(pipeline_file)
+        if step in ("prepare", "all"):
+            sources = self._detect(visit)
+            with self.lock:
+                self.runs[output_run][visit] = sources
+        if step in ("associate", "all"):
+            if step == "associate":
+                # Like a Butler query, only find the inputs in the given collections.
+                sources = next(self.runs[run][visit] for run in input_collections
+                               if visit in self.runs[run])
+            with self.lock:
+                for dataset_type, catalog in self._associate(sources).items():
+                    self.outputs[output_run].setdefault(dataset_type, {})[visit] = catalog
+
+    def _simulate(self, run):
+        """Run the fake pipeline on all visits, and return the catalogs it
+        wrote.
+
+        Parameters
+        ----------
+        run : callable
+            A function that takes `run_visit` and the visits, and runs the
+            pipeline.
+        """
+        self.lock = threading.Lock()
+        self.runs = collections.defaultdict(dict)
+        self.outputs = collections.defaultdict(dict)
+        self.apdb = pandas.DataFrame({"diaObjectId": pandas.Series(dtype=int),
+                                      "ra": pandas.Series(dtype=float),
+                                      "dec": pandas.Series(dtype=float),
+                                      "nDiaSources": pandas.Series(dtype=int)})
+        run(self.run_visit)
+        return FakeRepo(self.outputs["output"])
+
+    def _run_serial(self, visits):
+        return self._simulate(lambda run_visit: generate_self_preload._run_in_order(
+            run_visit, visits, "ApPipe.yaml", ["inputs"], "output"))
+
+    def _run_overlapped(self, visits):
+        return self._simulate(lambda run_visit: generate_self_preload._run_overlapped(
+            "repo", run_visit, visits, ["inputs"], "output", self.LOOKAHEAD))
+
+    def testSameCatalogs(self):
+        serial = self._run_serial(self.VISITS)
+        overlapped = self._run_overlapped(self.VISITS)
+        self.assertEqual(set(overlapped.catalogs), {"preloaded_DiaSource", "preloaded_DiaObject"})
+        self.assertEqual(
+            generate_self_preload._compare_catalogs(generate_self_preload.PRELOAD_TYPES, serial,
+                                                    overlapped, "output"),
+            [])
+
+    def testOrderMatters(self):
+        # Check that the fake stages can tell the difference, so that
+        # testSameCatalogs is meaningful.
+        serial = self._run_serial(self.VISITS)
+        reversed_ = self._run_serial(self.VISITS[::-1])
+        self.assertNotEqual(
+            generate_self_preload._compare_catalogs(generate_self_preload.PRELOAD_TYPES, serial,
+                                                    reversed_, "output"),
+            [])
+
+
+if __name__ == "__main__":
+    unittest.main()